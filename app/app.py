@@ -6,10 +6,9 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from src.db_utils import get_record_by_id
-from src.program_utils import eval_program, program_tokenization
-from src import config
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+from src.program_utils import eval_program, program_tokenization, repair_program
+from src.grounding_utils import build_numeric_index, find_ungrounded_args
+from src import config, metrics_utils
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -31,6 +30,14 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# --- Model Client ---
+# LangChain is imported only once the chat is used, so the password page renders without loading it.
+@st.cache_resource
+def get_llm():
+    """Creates the fine-tuned chat model once per server process."""
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model=config.FINETUNED_OPENAI_MODEL, temperature=config.TEMPERATURE)
+
 # --- Password Protection ---
 def check_password():
     """Returns `True` if the user has the correct password."""
@@ -89,6 +96,7 @@ if check_password():
                     st.error(f"Error: Record with ID '{st.session_state.record_id}' not found.")
                     st.session_state.record_loaded = False
                 else:
+                    from langchain_core.messages import SystemMessage
                     st.success(f"Successfully loaded record: {st.session_state.record_id}")
                     doc = record.get('doc', {})
                     system_prompt = (
@@ -97,6 +105,8 @@ if check_password():
                         f"{doc.get('post_text', '')}"
                     )
                     st.session_state.history = [SystemMessage(content=system_prompt)]
+                    metrics_utils.record_cache("numeric_index", bool(doc.get('numeric_index')))
+                    st.session_state.numeric_index = doc.get('numeric_index') or build_numeric_index(doc)
                     st.session_state.record_loaded = True
         
         st.markdown("---")
@@ -110,6 +120,8 @@ if check_password():
     if not st.session_state.record_loaded:
         st.info("Please load a record using the sidebar to begin the chat.")
     else:
+        from langchain_core.messages import HumanMessage, AIMessage
+
         for message in st.session_state.history:
             if isinstance(message, HumanMessage):
                 with st.chat_message("user"):
@@ -127,18 +139,28 @@ if check_password():
             with st.chat_message("assistant"):
                 with st.spinner("Generating response..."):
                     try:
-                        llm = ChatOpenAI(model=config.FINETUNED_OPENAI_MODEL, temperature=config.TEMPERATURE)
-                        response = llm.invoke(st.session_state.history)
-                        program_str = response.content.strip()
+                        llm = get_llm()
+                        with metrics_utils.span("llm_call", model=config.FINETUNED_OPENAI_MODEL):
+                            response = llm.invoke(st.session_state.history)
+                        metrics_utils.record_llm_usage(config.FINETUNED_OPENAI_MODEL, response.usage_metadata)
+                        program_str, repairs = repair_program(response.content.strip())
                         
                         st.session_state.history.append(AIMessage(content=program_str))
 
-                        tokenized_prog = program_tokenization(program_str)
-                        _, final_answer = eval_program(tokenized_prog)
+                        with metrics_utils.span("execution"):
+                            tokenized_prog = program_tokenization(program_str)
+                            _, final_answer = eval_program(tokenized_prog)
                         
                         st.markdown(f"**Answer:** {final_answer}")
+                        ungrounded_args = find_ungrounded_args(program_str, st.session_state.get('numeric_index', {}))
+                        if ungrounded_args:
+                            st.warning(f"Arguments not found in the document: {', '.join(ungrounded_args)}")
                         with st.expander("View Generated Program"):
                             st.code(program_str, language="text")
+                            if repairs:
+                                st.caption(f"Repairs applied: {', '.join(repairs)}")
+                        # Refresh the textfile export after every answer (no-op unless CONVFINQA_METRICS=1)
+                        metrics_utils.export("app")
 
                     except Exception as e:
                         st.error(f"An error occurred: {e}")
@@ -0,0 +1,73 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# Add the project root to the Python path to allow for module imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import config
+from src.profile_utils import add_profile_arguments, profiled
+
+# Modules that must only be imported on the command paths that need them
+HEAVY_MODULES = ["langchain_openai", "langchain_core", "sympy", "pymongo"]
+
+def parse_importtime(stderr_text):
+    """
+    Parses `python -X importtime` output into {module: cumulative_us} for every import
+    and the total time (sum of the top-level imports' cumulative time, in microseconds).
+    """
+    cumulative, total_us = {}, 0
+    for line in stderr_text.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        cumulative[name.strip()] = int(cumulative_us.strip())
+        # Top-level imports have exactly one space after the separator; nested ones are indented further
+        if name.startswith(" ") and not name.startswith("  "):
+            total_us += int(cumulative_us.strip())
+    return cumulative, total_us
+
+def check_command(cli_args, budget_ms, runs):
+    """Runs `python -m src.main <cli_args>` under -X importtime and checks it against the budget."""
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    best_import_ms, best_wall_ms, heavy = float("inf"), float("inf"), []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-m", "src.main", *cli_args],
+            cwd=config.ROOT_DIR, env=env, capture_output=True, text=True
+        )
+        wall_ms = (time.perf_counter() - start) * 1000
+        if proc.returncode != 0:
+            print(f"Error: 'main {' '.join(cli_args)}' exited with code {proc.returncode}")
+            return False
+
+        cumulative, total_us = parse_importtime(proc.stderr)
+        best_import_ms = min(best_import_ms, total_us / 1000)
+        best_wall_ms = min(best_wall_ms, wall_ms)
+        heavy = [m for m in HEAVY_MODULES if m in cumulative]
+
+    ok = best_import_ms <= budget_ms and not heavy
+    status = "OK" if ok else "FAIL"
+    print(f"[{status}] main {' '.join(cli_args)}: imports {best_import_ms:.0f} ms, wall {best_wall_ms:.0f} ms (budget {budget_ms} ms)")
+    if heavy:
+        print(f"  Heavy modules imported at startup: {', '.join(heavy)}")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the main CLI starts within an import-time budget.")
+    parser.add_argument("--budget_ms", type=float, default=500, help="Maximum cumulative import time for a cold start, in milliseconds.")
+    parser.add_argument("--runs", type=int, default=3, help="Number of runs per command; the best run is reported.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiled("check_startup_time", args.profile, args.profile_top):
+        results = [check_command(cli_args, args.budget_ms, args.runs) for cli_args in (["--help"], ["myfunc"])]
+        if not all(results):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import json
+import argparse
+import csv
+import itertools
+import sys
+import os
+import time
+
+# Add the project root to the Python path to allow for module imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.eval_utils import PreparedGold, score_sample
+from src import config
+from src.profile_utils import add_profile_arguments, profiled
+
+def load_gold(gold_path):
+    with open(gold_path, 'r', encoding='utf-8') as f:
+        gold_data = json.load(f)
+    if isinstance(gold_data, dict):
+        return [item for split in gold_data.values() for item in split]
+    return gold_data
+
+def score_run(prepared, predictions_path):
+    """
+    Scores one prediction file with the shared gold preprocessing. Returns the run's summary
+    (same counting rules as run_evaluation.py) and {(id, turn): turn result}.
+    """
+    with open(predictions_path, 'r', encoding='utf-8') as f:
+        pred_data = json.load(f)
+
+    summary = {"samples": len(pred_data), "turns": 0, "turn_exe_correct": 0, "turn_prog_correct": 0,
+               "sample_exe_correct": 0, "sample_prog_correct": 0, "ungrounded_turns": 0}
+    turn_results = {}
+    for pred_item in pred_data:
+        if 'error' in pred_item or pred_item['id'] not in prepared.items:
+            continue
+        result = score_sample(prepared.items[pred_item['id']], pred_item, prepared)
+        if result is None:
+            continue
+        for turn in result['turns']:
+            summary["turns"] += 1
+            summary["turn_exe_correct"] += turn['exe_correct']
+            summary["turn_prog_correct"] += turn['prog_correct']
+            summary["ungrounded_turns"] += bool(turn['ungrounded_args'])
+            turn_results[(pred_item['id'], turn['turn'])] = turn
+        summary["sample_exe_correct"] += result['last_turn_exe_correct']
+        summary["sample_prog_correct"] += result['last_turn_prog_correct']
+
+    def pct(correct, total):
+        return correct / total * 100 if total else 0.0
+    summary["turn_exe_acc"] = pct(summary["turn_exe_correct"], summary["turns"])
+    summary["turn_prog_acc"] = pct(summary["turn_prog_correct"], summary["turns"])
+    summary["sample_exe_acc"] = pct(summary["sample_exe_correct"], summary["samples"])
+    summary["sample_prog_acc"] = pct(summary["sample_prog_correct"], summary["samples"])
+    return summary, turn_results
+
+def disagreement_matrix(names, turn_results_by_run):
+    """Counts, for every pair of runs, the turns scored by both whose execution correctness differs."""
+    matrix = {a: {b: 0 for b in names} for a in names}
+    for a, b in itertools.combinations(names, 2):
+        results_a, results_b = turn_results_by_run[a], turn_results_by_run[b]
+        count = sum(1 for key in results_a.keys() & results_b.keys() if results_a[key]['exe_correct'] != results_b[key]['exe_correct'])
+        matrix[a][b] = matrix[b][a] = count
+    return matrix
+
+def main():
+    parser = argparse.ArgumentParser(description="Score several prediction files against the same gold set in one pass.")
+    parser.add_argument("--gold_path", type=str, default=config.TEST_SET_PATH, help="Path to the gold standard JSON file.")
+    parser.add_argument("--predictions_paths", type=str, nargs="+", required=True, help="Prediction files to compare.")
+    parser.add_argument("--names", type=str, nargs="+", help="Run names, in the order of --predictions_paths (default: file names).")
+    parser.add_argument("--output_dir", type=str, default=config.ANALYSIS_DIR / "comparison", help="Directory for the summary, per-turn and disagreement CSVs.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiled("compare_runs", args.profile, args.profile_top):
+        names = args.names or [os.path.splitext(os.path.basename(p))[0] for p in args.predictions_paths]
+        if len(names) != len(args.predictions_paths) or len(set(names)) != len(names):
+            parser.error("--names must give one unique name per prediction file")
+
+        # --- 1. Score every run against the shared gold preprocessing ---
+        prepared = PreparedGold(load_gold(args.gold_path))
+        summaries, turn_results_by_run = {}, {}
+        for name, path in zip(names, args.predictions_paths):
+            start = time.perf_counter()
+            summaries[name], turn_results_by_run[name] = score_run(prepared, path)
+            print(f"Scored {name} in {time.perf_counter() - start:.2f}s")
+        print(f"Equivalence checks: {prepared.equivalence_computed} computed, {prepared.equivalence_reused} reused across runs")
+
+        # --- 2. Side-by-side summary ---
+        columns = ["samples", "turns", "turn_exe_acc", "turn_prog_acc", "sample_exe_acc", "sample_prog_acc", "ungrounded_turns"]
+        width = max(len(name) for name in names)
+        print("\n--- Comparison ---")
+        print(f"{'run':<{width}}  " + "  ".join(f"{c:>16}" for c in columns))
+        for name in names:
+            row = summaries[name]
+            print(f"{name:<{width}}  " + "  ".join(f"{row[c]:>16.2f}" if isinstance(row[c], float) else f"{row[c]:>16}" for c in columns))
+
+        matrix = disagreement_matrix(names, turn_results_by_run)
+        print("\n--- Turns with different execution correctness (pairwise) ---")
+        print(f"{'':<{width}}  " + "  ".join(f"{name:>{width}}" for name in names))
+        for a in names:
+            print(f"{a:<{width}}  " + "  ".join(f"{matrix[a][b]:>{width}}" for b in names))
+
+        # --- 3. Save CSVs ---
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, "summary.csv"), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["run"] + columns)
+            for name in names:
+                writer.writerow([name] + [summaries[name][c] for c in columns])
+
+        with open(os.path.join(args.output_dir, "disagreement_matrix.csv"), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["run"] + names)
+            for a in names:
+                writer.writerow([a] + [matrix[a][b] for b in names])
+
+        # One row per gold turn scored by any run, with how many runs got it right and each run's result
+        with open(os.path.join(args.output_dir, "turn_matrix.csv"), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "turn", "gold_program", "runs_exe_correct"]
+                            + [f"{name}_{field}" for name in names for field in ("exe_correct", "prog_correct", "program")])
+            for sample_id, item in prepared.items.items():
+                for i, gold_program in enumerate(item.get('dialogue', {}).get('turn_program', [])):
+                    turns = [turn_results_by_run[name].get((sample_id, i + 1)) for name in names]
+                    if all(turn is None for turn in turns):
+                        continue
+                    num_correct = sum(1 for turn in turns if turn and turn['exe_correct'])
+                    row = [sample_id, i + 1, gold_program, num_correct]
+                    for turn in turns:
+                        row += [int(turn['exe_correct']), int(turn['prog_correct']), turn['predicted_program']] if turn else ["", "", ""]
+                    writer.writerow(row)
+        print(f"\nComparison saved to {args.output_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -2,58 +2,167 @@ import json
 import os
 import argparse
 import sys
+from contextlib import ExitStack
+from functools import partial
+from pathlib import Path
+from tqdm import tqdm
 
 # Add the project root to the Python path to allow for module imports
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from src.program_utils import dict_to_markdown_table
+from src.program_utils import dict_to_markdown_table, str_to_num
+from src.grounding_utils import SENTENCE_SPLIT_PATTERN, build_numeric_index, program_literals, value_bucket
+from src.history_utils import MESSAGE_TOKEN_OVERHEAD, count_tokens, has_exact_tokenizer, tokenizer_name
+from src.io_utils import batched, iter_records, map_bounded
+from src.schedule_utils import document_key
+from src.shard_utils import shard_of, shard_path
 from src import config
+from src.profile_utils import add_profile_arguments, profiled
 
 
-def convert_to_openai_format(source_path, output_path):
+def build_system_content(pre_text, table_str, post_text):
+    return f"{pre_text}\n\nTABLE:\n{table_str}\n\n{post_text}"
+
+
+def message_tokens(content):
+    return count_tokens(content) + MESSAGE_TOKEN_OVERHEAD
+
+
+def grounding_sentences(doc, programs):
+    """Returns the (source, sentence index) pairs of pre/post text holding a number the gold programs use."""
+    numeric_index = build_numeric_index(doc)
+    needed = set()
+    for program in programs:
+        for literal in program_literals(program):
+            num = str_to_num(literal)
+            if num == "n/a":
+                continue
+            for location in numeric_index.get(value_bucket(num), []):
+                if location["source"] in ("pre_text", "post_text"):
+                    needed.add((location["source"], location["sentence"]))
+    return needed
+
+
+def convert_sample(sample, max_tokens=None):
+    """
+    Converts one sample into a fine-tuning example and counts its tokens. Over `max_tokens`, the
+    pre/post text sentences no gold program draws a number from are dropped first, farthest from
+    the table first; if that is not enough, the dialogue is cut to its longest prefix that fits and
+    the later turns are left out of the training data (counted in `dropped_turns`). The example is
+    None, and the whole sample is left out, when not even the first turn fits.
+    """
+    doc = sample.get('doc', {})
+    dialogue = sample.get('dialogue', {})
+    programs = dialogue.get('turn_program', [])
+    turns = [(question, programs[i]) for i, question in enumerate(dialogue.get('conv_questions', [])) if i < len(programs)]
+    table_str = dict_to_markdown_table(doc.get('table', {}))
+    pre_text, post_text = doc.get('pre_text', ''), doc.get('post_text', '')
+
+    system_tokens = message_tokens(build_system_content(pre_text, table_str, post_text))
+    turn_tokens = [message_tokens(question) + message_tokens(program) for question, program in turns]
+    num_turns, trimmed_sentences = len(turns), 0
+
+    if max_tokens and system_tokens + sum(turn_tokens) > max_tokens:
+        # --- 1. Trim text the programs do not need, starting far from the table ---
+        sentences = {"pre_text": SENTENCE_SPLIT_PATTERN.split(pre_text), "post_text": SENTENCE_SPLIT_PATTERN.split(post_text)}
+        needed = grounding_sentences(doc, programs)
+        candidates = [("pre_text", i) for i in range(len(sentences["pre_text"]))] + [("post_text", i) for i in range(len(sentences["post_text"]))]
+        candidates.sort(key=lambda c: c[1] if c[0] == "pre_text" else len(sentences["post_text"]) - 1 - c[1])
+        removed = set()
+        for candidate in candidates:
+            if system_tokens + sum(turn_tokens) <= max_tokens:
+                break
+            if candidate in needed:
+                continue
+            removed.add(candidate)
+            pre_text, post_text = (" . ".join(s for i, s in enumerate(sentences[source]) if (source, i) not in removed) for source in ("pre_text", "post_text"))
+            system_tokens = message_tokens(build_system_content(pre_text, table_str, post_text))
+        trimmed_sentences = len(removed)
+
+        # --- 2. Keep the longest prefix of the dialogue that fits ---
+        while num_turns > 0 and system_tokens + sum(turn_tokens[:num_turns]) > max_tokens:
+            num_turns -= 1
+
+    example = None
+    if num_turns > 0 or not turns:
+        messages = [{"role": "system", "content": build_system_content(pre_text, table_str, post_text)}]
+        for question, program in turns[:num_turns]:
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": program})
+        example = {"messages": messages}
+
+    return {
+        "id": sample.get('id'),
+        "example": example,
+        "tokens": system_tokens + sum(turn_tokens[:num_turns]) if example is not None else 0,
+        "trimmed_sentences": trimmed_sentences,
+        "dropped_turns": len(turns) - num_turns,
+    }
+
+
+def convert_batch(samples, max_tokens=None):
+    """Worker task: converts a batch of samples."""
+    return [convert_sample(sample, max_tokens) for sample in samples]
+
+
+def summarize_tokens(entries):
+    """Totals and distribution of the example token counts in a conversion report."""
+    tokens = sorted(entry["tokens"] for entry in entries if entry["tokens"])
+    return {
+        "examples": len(tokens),
+        "skipped": sum(1 for entry in entries if not entry["tokens"]),
+        "trimmed": sum(1 for entry in entries if entry["trimmed_sentences"]),
+        "truncated": sum(1 for entry in entries if entry["tokens"] and entry["dropped_turns"]),
+        "total_tokens": sum(tokens),
+        "mean_tokens": sum(tokens) / len(tokens) if tokens else 0,
+        "p95_tokens": tokens[int(0.95 * (len(tokens) - 1))] if tokens else 0,
+        "max_example_tokens": tokens[-1] if tokens else 0,
+    }
+
+
+def convert_to_openai_format(source_path, output_path, max_tokens=None, num_shards=1, workers=1, batch_size=64, report_path=None):
     """
     Converts the sampled ConvFinQA data into the JSONL format required
     for OpenAI fine-tuning, preserving the order for traceability.
+    Samples are streamed from `source_path` and converted by `workers` processes. Every example's
+    tokens are counted, examples over `max_tokens` are trimmed (see `convert_sample`), and with
+    `num_shards` > 1 the examples are split by document into `<stem>.shard-<i>-of-<N>.jsonl` files.
+    The per-example token counts and their totals are saved to `report_path` (default:
+    config.ANALYSIS_DIR/<stem>.tokens.json), marked approximate when tiktoken is unavailable.
     """
-    try:
-        with open(source_path, 'r', encoding='utf-8') as f:
-            samples = json.load(f)
-    except FileNotFoundError:
+    if not os.path.exists(source_path):
         print(f"Error: Source file not found at {source_path}")
         return
+
+    output_paths = [shard_path(output_path, (i, num_shards) if num_shards > 1 else None) for i in range(num_shards)]
+    report_path = report_path or config.ANALYSIS_DIR / f"{Path(output_path).stem}.tokens.json"
+    entries = []
+    try:
+        with ExitStack() as stack:
+            outputs = [stack.enter_context(open(path, 'w', encoding='utf-8')) for path in output_paths]
+            samples = tqdm(iter_records(source_path), desc=f"Converting {Path(source_path).name}", unit="sample")
+            for results in map_bounded(partial(convert_batch, max_tokens=max_tokens), batched(samples, batch_size), workers):
+                for result in results:
+                    example = result.pop("example")
+                    if example is not None:
+                        outputs[shard_of(document_key(result["id"]), num_shards)].write(json.dumps(example) + '\n')
+                    entries.append(result)
     except json.JSONDecodeError:
         print(f"Error: Could not decode JSON from {source_path}")
         return
 
-    # Prepare to write to a .jsonl file
-    with open(output_path, 'w', encoding='utf-8') as f_out:
-        for sample in samples:
-            # 1. Construct the System message
-            doc = sample.get('doc', {})
-            table_str = dict_to_markdown_table(doc.get('table', {}))
-            system_content = (
-                f"{doc.get('pre_text', '')}\n\n"
-                f"TABLE:\n{table_str}\n\n"
-                f"{doc.get('post_text', '')}"
-            )
-            
-            messages = [{"role": "system", "content": system_content}]
-            
-            # 2. Construct the User/Assistant messages
-            dialogue = sample.get('dialogue', {})
-            questions = dialogue.get('conv_questions', [])
-            programs = dialogue.get('turn_program', []) 
-
-            for i, question in enumerate(questions):
-                if i < len(programs):
-                    messages.append({"role": "user", "content": question})
-                    messages.append({"role": "assistant", "content": programs[i]})
-            
-            # 3. Write the final JSON object to a new line
-            final_json_object = {"messages": messages}
-            f_out.write(json.dumps(final_json_object) + '\n')
-
-    print(f"Successfully converted {len(samples)} samples from {source_path} to {output_path}")
+    summary = summarize_tokens(entries)
+    approximate = not has_exact_tokenizer()
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({"tokenizer": tokenizer_name(), "approximate": approximate, "max_tokens": max_tokens, "summary": summary, "examples": entries}, f, indent=4)
+
+    print(f"Successfully converted {len(entries)} samples from {source_path} to {', '.join(map(str, output_paths))}")
+    print(f"  - Tokens ({tokenizer_name()}): {summary['total_tokens']} total, {summary['mean_tokens']:.0f} mean, "
+          f"{summary['p95_tokens']} p95, {summary['max_example_tokens']} max per example")
+    if max_tokens:
+        print(f"  - Over {max_tokens} tokens: {summary['trimmed']} trimmed, {summary['truncated']} cut to a dialogue prefix, {summary['skipped']} skipped")
+    print(f"  - Token report saved to {report_path}")
 
 
 if __name__ == '__main__':
@@ -62,9 +171,20 @@ if __name__ == '__main__':
     parser.add_argument("--train_output", type=str, default=config.TRAIN_SET_JSONL_PATH, help="Path to save the output training JSONL file.")
     parser.add_argument("--test_source", type=str, default=config.TEST_SET_PATH, help="Path to the source test JSON file.")
     parser.add_argument("--test_output", type=str, default=config.TEST_SET_JSONL_PATH, help="Path to save the output test JSONL file.")
+    parser.add_argument("--max_tokens", type=int, help="Maximum tokens per example. Longer examples first lose text sentences no program uses, "
+                             "then are cut to the longest dialogue prefix that fits: the turns after it, and samples whose first turn "
+                             "does not fit, are dropped from the output (counted in the token report).")
+    parser.add_argument("--num_shards", type=int, default=1, help="Split each output into this many JSONL files, by document.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes converting samples.")
+    parser.add_argument("--batch_size", type=int, default=64, help="Samples per worker task.")
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    if args.max_tokens and not has_exact_tokenizer():
+        print("Warning: tiktoken's o200k_base encoding is not available offline (see TIKTOKEN_CACHE_DIR); "
+              "--max_tokens is applied to estimated token counts and the reports are marked approximate.")
 
-    print("--- Preparing datasets in jsonl format for OpenAI Finetuning ---")
-    convert_to_openai_format(args.train_source, args.train_output)
-    convert_to_openai_format(args.test_source, args.test_output)
-    print("\nData preparation complete.")
+    with profiled("convert_datasets_for_finetuning", args.profile, args.profile_top):
+        print("--- Preparing datasets in jsonl format for OpenAI Finetuning ---")
+        convert_to_openai_format(args.train_source, args.train_output, args.max_tokens, args.num_shards, args.workers, args.batch_size)
+        convert_to_openai_format(args.test_source, args.test_output, args.max_tokens, args.num_shards, args.workers, args.batch_size)
+        print("\nData preparation complete.")
@@ -0,0 +1,344 @@
+import json
+import argparse
+import math
+import random
+import re
+import string
+import sys
+import os
+from tqdm import tqdm
+
+# Add the project root to the Python path to allow for module imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.program_utils import eval_program, program_tokenization
+from src import config
+from src.profile_utils import add_profile_arguments, profiled
+
+# Dialogue lengths and type II share as observed in the final test set
+TURN_WEIGHTS = {1: 1, 2: 48, 3: 40, 4: 51, 5: 38, 6: 9, 7: 9, 8: 3, 9: 1}
+TYPE2_RATIO = 0.33
+
+LINE_ITEMS = [
+    "net revenues", "cost of sales", "gross margin", "operating income", "net income",
+    "interest expense", "depreciation and amortization", "total assets", "total liabilities",
+    "long-term debt", "cash and cash equivalents", "accounts receivable", "inventories",
+    "capital expenditures", "research and development", "selling general and administrative expenses",
+    "income tax expense", "goodwill", "deferred revenue", "shareholders' equity",
+]
+TOPICS = [
+    "results of operations", "consolidated balance sheet data", "liquidity and capital resources",
+    "segment information", "selected financial data", "contractual obligations",
+]
+TEXT_FACTS = [
+    "total borrowings under the revolving credit facility", "aggregate purchase consideration",
+    "share repurchases", "restructuring charges", "pension contributions", "dividends paid",
+]
+
+# Every chain starts from bare values and extends its program turn by turn, like the real dialogues
+CHAIN_WEIGHTS = {"change": 50, "sum": 15, "ratio": 20, "text": 10, "greater": 3, "exp": 2}
+
+STEP_PATTERN = re.compile(r"\w+\([^)]*\)")
+
+
+def format_literal(value):
+    """Formats a number the way it appears in programs (`8763`, `72.7`)."""
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+def render_program(steps):
+    """Renders a list of steps; a step is a bare literal or an (op, arg1, arg2) tuple."""
+    if len(steps) == 1 and isinstance(steps[0], str):
+        return steps[0]
+    return ", ".join(f"{op}({a}, {b})" for op, a, b in steps)
+
+
+def format_answer(value, percent=False):
+    """Formats an executed value the way `conv_answers` does (rounded, `%` for percentages)."""
+    if isinstance(value, str):
+        return value
+    text = f"{value:.2f}".rstrip("0").rstrip(".")
+    return f"{text}%" if percent else text
+
+
+def make_table(rng):
+    """Returns (table, years, rows): line items by fiscal year, with values drifting across years."""
+    first_year = rng.randint(2004, 2019)
+    years = [str(first_year - i) for i in range(rng.randint(2, 4))]
+    rows = rng.sample(LINE_ITEMS, rng.randint(3, 8))
+    table = {year: {} for year in years}
+    for row in rows:
+        value = 10 ** rng.uniform(1, 5)
+        decimals = rng.choice([0, 0, 1])
+        for year in years:
+            table[year][row] = round(value, decimals) or 1.0
+            value *= rng.uniform(0.8, 1.2)
+    return table, years, rows
+
+
+def make_text(rng, company, years, facts):
+    """Returns tokenized, lower-cased pre/post text in the style of the source filings."""
+    topic = rng.choice(TOPICS)
+    pre = [
+        f"the following table presents {company.lower()} 's {topic} for the years ended december 31 , {' , '.join(years)} ( in millions ) .",
+        f"management believes that the {topic} provide a meaningful comparison of our performance across periods .",
+    ]
+    for label, value in facts:
+        pre.append(f"during {years[0]} , {label} were $ {format_literal(value)} million .")
+    post = [
+        f"the increase in {rng.choice(LINE_ITEMS)} was primarily driven by higher volumes and favorable pricing .",
+        f"see note {rng.randint(2, 20)} to the consolidated financial statements for additional information .",
+    ]
+    return " ".join(pre), " ".join(post)
+
+
+def build_chain(rng, kind, table, years, rows, facts):
+    """Returns the (question, steps, percent) turns of one chain, each extending the previous program."""
+    y1, y2 = years[0], years[1]
+    r1, r2, r3 = rng.sample(rows, 3)
+    a, b = format_literal(table[y1][r1]), format_literal(table[y2][r1])
+
+    if kind == "change":
+        turns = [
+            (f"what was the {r1} in {y1}?", [a], False),
+            (f"and what was it in {y2}?", [b], False),
+            ("what was, then, the change over the year?", [("subtract", a, b)], False),
+            (f"and how much does this change represent in relation to the {y2} value?", [("subtract", a, b), ("divide", "#0", b)], False),
+        ]
+        if rng.random() < 0.4:
+            turns.append(("and what is that as a percentage?", [("subtract", a, b), ("divide", "#0", b), ("multiply", "#1", "const_100")], True))
+        return turns
+    if kind == "sum":
+        c, d, e = (format_literal(table[y1][r]) for r in (r1, r2, r3))
+        return [
+            (f"what was the {r1} in {y1}?", [c], False),
+            (f"what is the sum of the {r1} and the {r2} in that year?", [("add", c, d)], False),
+            (f"including the {r3}, what becomes that total?", [("add", c, d), ("add", "#0", e)], False),
+            (f"what fraction of this total does the {r1} represent?", [("add", c, d), ("add", "#0", e), ("divide", c, "#1")], False),
+        ]
+    if kind == "ratio":
+        c, d = format_literal(table[y1][r1]), format_literal(table[y1][r2])
+        return [
+            (f"what was the {r1} in {y1}?", [c], False),
+            (f"and the {r2}?", [d], False),
+            (f"what is the ratio of the {r1} to the {r2}?", [("divide", c, d)], False),
+        ]
+    if kind == "text" and facts:
+        label, value = rng.choice(facts)
+        v, c = format_literal(value), format_literal(table[y1][r1])
+        return [
+            (f"what were the {label} in {y1}, in millions?", [v], False),
+            (f"and what was the {r1} in that year?", [c], False),
+            (f"how much do the {label} represent in relation to the {r1}?", [("divide", v, c)], False),
+        ]
+    if kind == "greater":
+        return [(f"was the {r1} greater in {y1} than in {y2}?", [("greater", a, b)], False)]
+    if kind == "exp":
+        return [
+            (f"what was the growth rate of the {r1} from {y2} to {y1}?", [("subtract", a, b), ("divide", "#0", b)], False),
+            ("if this rate persisted for two more years, what would be the compounded growth factor?",
+             [("subtract", a, b), ("divide", "#0", b), ("add", "#1", "const_1"), ("exp", "#2", "const_2")], False),
+        ]
+    return build_chain(rng, "change", table, years, rows, facts)
+
+
+def build_turns(rng, num_turns, table, years, rows, facts):
+    """Concatenates chains until the conversation has `num_turns` turns."""
+    turns = []
+    kinds, weights = list(CHAIN_WEIGHTS), list(CHAIN_WEIGHTS.values())
+    while len(turns) < num_turns:
+        kind = rng.choices(kinds, weights)[0]
+        turns.extend(build_chain(rng, kind, table, years, rows, facts)[:num_turns - len(turns)])
+    return turns
+
+
+def make_record(record_id, rng, document, is_type2):
+    """Builds one conversation over `document` with valid chained programs and executed answers."""
+    table, years, rows, facts = document["table"], document["years"], document["rows"], document["facts"]
+    turn_choices = [t for t in TURN_WEIGHTS if t >= 2] if is_type2 else list(TURN_WEIGHTS)
+    num_turns = rng.choices(turn_choices, [TURN_WEIGHTS[t] for t in turn_choices])[0]
+
+    if is_type2:
+        first = math.ceil(num_turns / 2)
+        turns = build_turns(rng, first, table, years, rows, facts) + build_turns(rng, num_turns - first, table, years, rows, facts)
+        qa_split = [False] * first + [True] * (num_turns - first)
+    else:
+        turns = build_turns(rng, num_turns, table, years, rows, facts)
+        qa_split = [False] * num_turns
+
+    questions, programs, answers, executed = [], [], [], []
+    for question, steps, percent in turns:
+        program = render_program(steps)
+        _, value = eval_program(program_tokenization(program))
+        questions.append(question)
+        programs.append(program)
+        executed.append(value)
+        answers.append(format_answer(value, percent))
+
+    return {
+        "id": record_id,
+        "doc": {"pre_text": document["pre_text"], "post_text": document["post_text"], "table": table},
+        "dialogue": {
+            "conv_questions": questions,
+            "conv_answers": answers,
+            "turn_program": programs,
+            "executed_answers": executed,
+            "qa_split": qa_split,
+        },
+        "features": {
+            "num_dialogue_turns": num_turns,
+            "has_type2_question": is_type2,
+            "has_duplicate_columns": False,
+            "has_non_numeric_values": False,
+        },
+    }
+
+
+def make_document(rng, doc_index):
+    """
+    Returns a synthetic filing page: company ticker, table and text (with a few values only in
+    the text). The page number is the document index, so ids are unique however many are drawn.
+    """
+    company = "".join(rng.choices(string.ascii_uppercase, k=rng.randint(2, 4)))
+    table, years, rows = make_table(rng)
+    facts = [(label, round(10 ** rng.uniform(1, 4), rng.choice([0, 1]))) for label in rng.sample(TEXT_FACTS, rng.randint(0, 2))]
+    pre_text, post_text = make_text(rng, company, years, facts)
+    return {
+        "company": company, "year": years[0], "page": doc_index + 1,
+        "table": table, "years": years, "rows": rows, "facts": facts,
+        "pre_text": pre_text, "post_text": post_text,
+    }
+
+
+def generate_records(num_records, seed, max_conversations_per_doc):
+    """
+    Yields `num_records` synthetic records. Each document is seeded independently from
+    (seed, document index), so the corpus is identical however it is consumed. Single
+    documents carry 1..N conversations (`-1`, `-2`, ... ids), type II documents one.
+    """
+    emitted, doc_index = 0, 0
+    while emitted < num_records:
+        rng = random.Random(f"{seed}-{doc_index}")
+        document = make_document(rng, doc_index)
+        prefix = f"{document['company']}/{document['year']}/page_{document['page']}.pdf"
+        if rng.random() < TYPE2_RATIO:
+            yield make_record(f"Double_{prefix}", rng, document, True)
+            emitted += 1
+        else:
+            for k in range(1, min(rng.randint(1, max_conversations_per_doc), num_records - emitted) + 1):
+                yield make_record(f"Single_{prefix}-{k}", rng, document, False)
+                emitted += 1
+        doc_index += 1
+
+
+def corrupt_program(rng, program, table_values):
+    """Returns a wrong variant of `program`: swapped arguments, a wrong operation, a wrong value or a dropped step."""
+    steps = STEP_PATTERN.findall(program)
+    if not steps:
+        return format_literal(rng.choice(table_values))
+    op, args = steps[-1][:-1].split("(")
+    arg1, arg2 = args.split(", ")
+    mode = rng.choice(["swap", "op", "value", "drop"] if len(steps) > 1 else ["swap", "op", "value"])
+    if mode == "swap":
+        steps[-1] = f"{op}({arg2}, {arg1})"
+    elif mode == "op":
+        steps[-1] = f"{rng.choice([o for o in ('add', 'subtract', 'multiply', 'divide') if o != op])}({arg1}, {arg2})"
+    elif mode == "value":
+        steps[-1] = f"{op}({arg1}, {format_literal(rng.choice(table_values))})"
+    else:
+        steps = steps[:-1]
+    return ", ".join(steps)
+
+
+def make_prediction(record, rng, error_rate):
+    """Copies the gold programs, replacing each turn with a wrong program with probability `error_rate`."""
+    table_values = [v for column in record["doc"]["table"].values() for v in column.values()]
+    programs, answers = [], []
+    for program, gold_answer in zip(record["dialogue"]["turn_program"], record["dialogue"]["executed_answers"]):
+        if rng.random() < error_rate:
+            # Retry a few times since e.g. swapping the arguments of an addition does not change the answer
+            for _ in range(5):
+                candidate = corrupt_program(rng, program, table_values)
+                _, value = eval_program(program_tokenization(candidate))
+                if value != gold_answer:
+                    program = candidate
+                    break
+        programs.append(program)
+        answers.append(eval_program(program_tokenization(program))[1])
+    return {"id": record["id"], "turn_program": programs, "executed_answers": answers}
+
+
+class JsonArrayWriter:
+    """Streams records into a JSON array (or a dict of arrays) without holding them in memory."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'w', encoding='utf-8')
+        self.first = True
+        self.num_arrays = 0
+
+    def open_array(self, key=None):
+        """Starts the top-level array, or the array under `key` of the top-level dict."""
+        if key is None:
+            self.file.write("[")
+        else:
+            self.file.write(("{" if self.num_arrays == 0 else "\n], ") + json.dumps(key) + ": [")
+        self.num_arrays += 1
+        self.first = True
+
+    def write(self, record):
+        """Appends one record to the array currently open."""
+        self.file.write(("\n" if self.first else ",\n") + json.dumps(record))
+        self.first = False
+
+    def close(self, nested=False):
+        """Closes the last array (and the dict around it when `nested`) and the file."""
+        self.file.write("\n]}" if nested else "\n]")
+        self.file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a seeded synthetic corpus with the schema of the ConvFinQA test set.")
+    parser.add_argument("--num_records", type=int, default=10000, help="Number of conversations to generate.")
+    parser.add_argument("--output_path", type=str, default=None, help="Path to the output JSON file (default: data/synthetic/synthetic_<n>.json).")
+    parser.add_argument("--format", type=str, choices=["list", "splits"], default="list",
+                        help="'list' matches final_test_set.json; 'splits' writes {'train': [...], 'dev': [...]} like the raw dataset.")
+    parser.add_argument("--dev_ratio", type=float, default=0.2, help="Share of records written to 'dev' in the 'splits' format.")
+    parser.add_argument("--max_conversations_per_doc", type=int, default=3, help="Maximum number of conversations sharing one document.")
+    parser.add_argument("--predictions_path", type=str, help="Also write a matching predictions file to this path.")
+    parser.add_argument("--error_rate", type=float, default=0.3, help="Probability that a predicted turn is wrong.")
+    parser.add_argument("--seed", type=int, default=config.RANDOM_SEED, help="Random seed.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiled("generate_synthetic_corpus", args.profile, args.profile_top):
+        output_path = args.output_path or config.SYNTHETIC_DATA_DIR / f"synthetic_{args.num_records}.json"
+        num_train = args.num_records - int(args.num_records * args.dev_ratio)
+        nested = args.format == "splits"
+
+        writer = JsonArrayWriter(output_path)
+        writer.open_array("train" if nested else None)
+        pred_writer = None
+        if args.predictions_path:
+            pred_writer = JsonArrayWriter(args.predictions_path)
+            pred_writer.open_array()
+        pred_rng = random.Random(f"{args.seed}-predictions")
+
+        records = generate_records(args.num_records, args.seed, args.max_conversations_per_doc)
+        for i, record in enumerate(tqdm(records, total=args.num_records, desc="Generating records")):
+            if nested and i == num_train:
+                writer.open_array("dev")
+            writer.write(record)
+            if pred_writer:
+                pred_writer.write(make_prediction(record, pred_rng, args.error_rate))
+
+        if nested and num_train == args.num_records:
+            writer.open_array("dev")
+        writer.close(nested)
+        print(f"Wrote {args.num_records} records to {output_path}")
+        if pred_writer:
+            pred_writer.close()
+            print(f"Wrote predictions (error rate {args.error_rate:.0%}) to {args.predictions_path}")
+
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,129 @@
-import json
 import argparse
 import sys
 import os
+import time
 from tqdm import tqdm
 
 # Add the project root to the Python path to allow for module imports
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from src.program_utils import dict_to_markdown_table
-from src.db_utils import bulk_insert_data
+from src.grounding_utils import build_numeric_index
+from src.db_utils import BulkWriter, clear_collection, document_hash
+from src.io_utils import batched, iter_records, map_bounded
 from src import config
+from src.profile_utils import add_profile_arguments, profiled
+
+def prepare_document(doc):
+    """Builds the stored form of a document: its text and table, the table as markdown and its numeric index."""
+    table_json = doc.get('table', {})
+    return {
+        "pre_text": doc.get("pre_text"),
+        "post_text": doc.get("post_text"),
+        "table": table_json,
+        "table_markdown": dict_to_markdown_table(table_json),
+        "numeric_index": build_numeric_index(doc)
+    }
+
+def prepare_batch(items):
+    """Worker task: prepares the documents of a batch of (record id, doc id, doc or None) items."""
+    return [(record_id, doc_id, prepare_document(doc) if doc is not None else None) for record_id, doc_id, doc in items]
+
+def run_pipeline(source_path, collection_name, documents_collection, embed_documents=False, workers=None, batch_size=256, chunk_size=1000, writers=4, max_pending=None):
+    """
+    Streams the source into MongoDB in three overlapping stages: records are parsed incrementally,
+    documents are rendered and indexed by a pool of `workers` processes in batches of `batch_size`
+    conversations, and the results are inserted in chunks of `chunk_size` by `writers` threads.
+    At most `max_pending` batches are in the pool and a few chunks in the writers' queue, so the
+    parser waits for the slower stages and memory stays bounded whatever the source size. With a
+    single worker, documents are prepared in the parsing process (no pickling round trip).
+    Returns the documents inserted per collection.
+    """
+    # Conversations over the same page share one document, rendered and indexed once
+    seen_documents = set()
+    chunks = {collection_name: [], documents_collection: []}
+    progress = tqdm(iter_records(source_path), desc="Loading conversations", unit="conv")
+
+    def items():
+        for sample in progress:
+            doc = sample.get('doc', {})
+            doc_id = document_hash(doc)
+            first_seen = doc_id not in seen_documents
+            seen_documents.add(doc_id)
+            # With embedded documents every conversation carries its own copy
+            yield sample.get("id"), doc_id, doc if first_seen or embed_documents else None
+
+    def flush(collection, writer, final=False):
+        while chunks[collection] and (final or len(chunks[collection]) >= chunk_size):
+            writer.put(collection, chunks[collection][:chunk_size])
+            del chunks[collection][:chunk_size]
+
+    writer = BulkWriter(writers, queue_size=2 * writers)
+    try:
+        for results in map_bounded(prepare_batch, batched(items(), batch_size), workers or os.cpu_count() or 1, max_pending):
+            for record_id, doc_id, prepared in results:
+                if embed_documents:
+                    chunks[collection_name].append({"id": record_id, "doc": prepared})
+                    continue
+                if prepared is not None:
+                    chunks[documents_collection].append({"_id": doc_id, **prepared})
+                chunks[collection_name].append({"id": record_id, "doc_id": doc_id})
+            flush(documents_collection, writer)
+            flush(collection_name, writer)
+            progress.set_postfix({"documents": len(seen_documents)})
+        progress.close()
+        flush(documents_collection, writer, final=True)
+        flush(collection_name, writer, final=True)
+    finally:
+        inserted = writer.close()
+    return inserted
 
 def main():
     """
     Main function to load, process, and upload data to MongoDB.
     """
     parser = argparse.ArgumentParser(description="Load and process financial data into MongoDB.")
-    parser.add_argument("--source_path", type=str, default=config.TEST_SET_PATH, help="Path to the source JSON file.")
+    parser.add_argument("--source_path", type=str, default=config.TEST_SET_PATH, help="Path to the source file: a JSON list, a JSON dict of splits or JSONL, optionally .gz/.zst compressed.")
     parser.add_argument("--collection_name", type=str, default=config.MONGODB_COLLECTION, help="Name of the MongoDB collection.")
+    parser.add_argument("--documents_collection", type=str, default=config.MONGODB_DOCUMENTS_COLLECTION, help="Collection the shared documents are stored in, keyed by content hash.")
+    parser.add_argument("--embed_documents", action="store_true", help="Store a full copy of the document in every conversation record instead of referencing a shared one.")
+    parser.add_argument("--workers", type=int, help="Processes rendering and indexing documents (default: CPU count).")
+    parser.add_argument("--batch_size", type=int, default=256, help="Conversations per worker task.")
+    parser.add_argument("--chunk_size", type=int, default=1000, help="Documents per bulk insert.")
+    parser.add_argument("--writers", type=int, default=4, help="Concurrent bulk insert threads.")
+    parser.add_argument("--max_pending", type=int, help="Worker tasks in flight before reading pauses (default: twice --workers).")
+    add_profile_arguments(parser)
     args = parser.parse_args()
 
-    # --- 1. Load and Process Data ---
-    try:
-        with open(args.source_path, 'r', encoding='utf-8') as f:
-            source_data = json.load(f)
-    except FileNotFoundError:
-        print(f"Error: Source file not found at {args.source_path}")
-        return
+    with profiled("load_data_to_mongodb", args.profile, args.profile_top):
+        if not os.path.exists(args.source_path):
+            print(f"Error: Source file not found at {args.source_path}")
+            return
+
+        try:
+            # --- 1. Clear the target collections ---
+            clear_collection(args.collection_name)
+            if not args.embed_documents:
+                clear_collection(args.documents_collection)
 
-    # Handle both list-of-records and dict-of-lists-of-records formats
-    if isinstance(source_data, dict):
-        all_samples = [item for split in source_data.values() for item in split]
-    else:
-        all_samples = source_data
-    
-    print(f"Processing {len(all_samples)} samples from {args.source_path}...")
-    
-    documents_to_insert = []
-    for sample in tqdm(all_samples, desc="Preparing documents"):
-        doc = sample.get('doc', {})
-        table_json = doc.get('table', {})
-        
-        transformed_doc = {
-            "id": sample.get("id"),
-            "doc": {
-                "pre_text": doc.get("pre_text"),
-                "post_text": doc.get("post_text"),
-                "table": table_json,
-                "table_markdown": dict_to_markdown_table(table_json)
-            }
-        }
-        documents_to_insert.append(transformed_doc)
+            # --- 2. Parse, prepare and insert in overlapping stages ---
+            print(f"Streaming {args.source_path} into MongoDB...")
+            start = time.perf_counter()
+            inserted = run_pipeline(
+                args.source_path, args.collection_name, args.documents_collection, args.embed_documents,
+                args.workers, args.batch_size, args.chunk_size, args.writers, args.max_pending
+            )
+        except Exception as e:
+            print(f"Error during MongoDB loading: {e}")
+            print("\nData loading process failed.")
+            return
 
-    # --- 2. Insert into MongoDB using the utility function ---
-    success = bulk_insert_data(documents_to_insert, args.collection_name)
-    
-    if success:
+        # --- 3. Report ---
+        elapsed = time.perf_counter() - start
+        num_conversations = inserted.get(args.collection_name, 0)
+        print(f"Inserted {num_conversations} conversations" + ("" if args.embed_documents else f" sharing {inserted.get(args.documents_collection, 0)} unique documents")
+              + f" in {elapsed:.1f}s ({num_conversations / elapsed if elapsed else 0:.0f} conversations/s).")
         print("\nData loading process completed successfully.")
-    else:
-        print("\nData loading process failed.")
 
 if __name__ == '__main__':
     main()
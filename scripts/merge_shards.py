@@ -0,0 +1,67 @@
+import json
+import argparse
+import sys
+import os
+from collections import defaultdict, deque
+from pathlib import Path
+
+# Add the project root to the Python path to allow for module imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.io_utils import iter_records
+from src.shard_utils import check_complete, shard_from_path
+from src import config
+from src.profile_utils import add_profile_arguments, profiled
+from run_evaluation import merge_evaluation_shards
+
+def find_shard_files(output_path, suffix):
+    """Returns the shard files written for `output_path` (same directory and stem, any i-of-N)."""
+    output_path = Path(output_path)
+    return sorted(output_path.parent.glob(f"{output_path.stem}.shard-*-of-*{suffix}"))
+
+def merge_prediction_shards(shard_paths, source_path, output_path):
+    """
+    Concatenates shard prediction files and restores the order of the source file, so the result
+    is the file a single-node run writes. Repeated ids keep their relative order.
+    """
+    check_complete([shard_from_path(path) for path in shard_paths])
+    source_positions = defaultdict(deque)
+    for position, record in enumerate(iter_records(source_path)):
+        source_positions[record['id']].append(position)
+
+    keyed = []
+    for shard_index, path in enumerate(shard_paths):
+        with open(path, 'r', encoding='utf-8') as f:
+            for index, prediction in enumerate(json.load(f)):
+                positions = source_positions.get(prediction['id'])
+                position = positions.popleft() if positions else float('inf')
+                keyed.append((position, shard_index, index, prediction))
+    keyed.sort(key=lambda entry: entry[:3])
+    predictions = [prediction for *_, prediction in keyed]
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(predictions, f, indent=4)
+    print(f"Merged {len(predictions)} predictions from {len(shard_paths)} shards into {output_path}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the shard outputs of a sharded inference or evaluation run into the single-node output.")
+    parser.add_argument("kind", choices=["predictions", "evaluation"], help="'predictions': shard prediction files; 'evaluation': run_evaluation.py shard accumulators.")
+    parser.add_argument("--output_path", type=str, required=True, help="Single-node output path: the predictions JSON, or the error analysis CSV for 'evaluation'. Shard files are found next to it.")
+    parser.add_argument("--shard_paths", type=str, nargs="+", help="Explicit shard files (default: <stem>.shard-*-of-*<suffix> next to --output_path).")
+    parser.add_argument("--source_path", type=str, default=config.TEST_SET_PATH, help="Inference source file whose record order the merged predictions follow.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiled("merge_shards", args.profile, args.profile_top):
+        suffix = Path(args.output_path).suffix if args.kind == "predictions" else ".json"
+        shard_paths = args.shard_paths or find_shard_files(args.output_path, suffix)
+        if not shard_paths:
+            parser.error(f"no shard files found for {args.output_path}")
+
+        if args.kind == "predictions":
+            merge_prediction_shards(shard_paths, args.source_path, args.output_path)
+        else:
+            merge_evaluation_shards(shard_paths, args.output_path)
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ import sys
 import argparse
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from src import config
+from src.profile_utils import add_profile_arguments, profiled
 
 def create_final_datasets(
     source_path,
@@ -137,12 +138,14 @@ if __name__ == '__main__':
     parser.add_argument("--train_size", type=int, default=config.TRAIN_SIZE, help="Desired size of the training set.")
     parser.add_argument("--test_size", type=int, default=config.TEST_SIZE, help="Desired size of the test set.")
     parser.add_argument("--random_state", type=int, default=config.RANDOM_SEED, help="Random state for reproducibility.")
+    add_profile_arguments(parser)
     args = parser.parse_args()
-    create_final_datasets(
-        args.source_path,
-        args.train_path,
-        args.test_path,
-        args.train_size,
-        args.test_size,
-        args.random_state
-    )
+    with profiled("prepare_train_test_sets", args.profile, args.profile_top):
+        create_final_datasets(
+            args.source_path,
+            args.train_path,
+            args.test_path,
+            args.train_size,
+            args.test_size,
+            args.random_state
+        )
@@ -0,0 +1,185 @@
+import json
+import os
+import re
+import hashlib
+import argparse
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# Add the project root to the Python path to allow for module imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.io_utils import iter_records
+from src import config
+from src.profile_utils import add_profile_arguments, profiled
+
+# Bump when the statistics or figures change, so cached profiles are recomputed
+PROFILE_VERSION = "1"
+OPERATION_PATTERN = re.compile(r'([a-zA-Z_]+)\(')
+SPLITS = ['Train Set', 'Test Set']
+RARE_OPERATIONS = ['exp', 'greater']
+FIGURES = {
+    "question_types": "question_type_dist.png",
+    "dialogue_turns": "dialogue_turns_dist.png",
+    "rare_operations": "rare_op_dist.png",
+    "operations": "operations_distribution.png",
+}
+
+def input_fingerprint(paths):
+    """Hash of the input files' paths, sizes and modification times (and the profile version)."""
+    parts = [PROFILE_VERSION]
+    for path in paths:
+        stat = os.stat(path)
+        parts.append(f"{Path(path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha1("\n".join(parts).encode('utf-8')).hexdigest()
+
+def new_stats():
+    return {"samples": 0, "question_types": Counter(), "dialogue_turns": Counter(), "rare_operations": Counter(),
+            "operations": Counter(), "program_steps": Counter()}
+
+def add_sample(stats, item):
+    """Adds one conversation to the statistics. The operation regex runs once over all its programs."""
+    features = item.get('features', {})
+    programs = [p for p in item.get('dialogue', {}).get('turn_program', []) if isinstance(p, str)]
+    stats["samples"] += 1
+    stats["question_types"]["Type 2" if features.get('has_type2_question', False) else "Type 1"] += 1
+    stats["dialogue_turns"][features.get('num_dialogue_turns', 0)] += 1
+
+    operations = OPERATION_PATTERN.findall("\n".join(programs))
+    stats["operations"].update(operations)
+    for op in RARE_OPERATIONS:
+        stats["rare_operations"][op] += op in operations
+    for program in programs:
+        stats["program_steps"][program.count("(")] += 1
+
+def profile_file(path):
+    """Computes every statistic of a dataset file in one streaming pass."""
+    stats = new_stats()
+    for item in iter_records(path):
+        add_sample(stats, item)
+    return stats
+
+def to_json(stats):
+    return {name: dict(sorted(value.items())) if isinstance(value, Counter) else value for name, value in stats.items()}
+
+# --- Figures (rendered in worker processes) ---
+def annotate_bars(ax, fmt_value=lambda v: f'{int(v)}'):
+    for p in ax.patches:
+        if p.get_height():
+            ax.annotate(fmt_value(p.get_height()), (p.get_x() + p.get_width() / 2., p.get_height()),
+                        ha='center', va='center', xytext=(0, 9), textcoords='offset points', fontsize=10)
+
+def render_figure(figure, data, output_path):
+    """Renders one figure to `output_path` with the headless Agg backend."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    if figure == "operations":
+        ops, counts = zip(*Counter(data).most_common())
+        plt.figure(figsize=(12, 8))
+        ax = sns.barplot(x=list(counts), y=list(ops), hue=list(ops), palette="viridis", legend=False)
+        plt.xlabel("Frequency")
+        plt.ylabel("Operation Type")
+        plt.title("Distribution of Program Operations in ConvFinQA Dataset")
+        for i, v in enumerate(counts):
+            ax.text(v, i, f"  {v}", color='black', va='center', fontweight='bold')
+    else:
+        # data: {split: {category: count}}; categories are plotted in sorted order
+        categories = sorted({category for counts in data.values() for category in counts})
+        rows = [(split, str(category), data.get(split, {}).get(category, 0)) for split in SPLITS for category in categories]
+        titles = {
+            "question_types": ('Distribution of Question Types', 'Question Type', 'Count'),
+            "dialogue_turns": ('Distribution of Number of Dialogue Turns', 'Number of Turns', 'Count'),
+            "rare_operations": ('Distribution of Samples Containing Rare Operations', 'Operation Type', 'Count of Samples'),
+        }
+        title, xlabel, ylabel = titles[figure]
+        plt.figure(figsize=(10, 6) if figure == "rare_operations" else (12, 7))
+        ax = sns.barplot(x=[r[1] for r in rows], y=[r[2] for r in rows], hue=[r[0] for r in rows], palette='viridis', hue_order=SPLITS)
+        plt.title(title, fontsize=16)
+        plt.ylabel(ylabel, fontsize=12)
+        plt.xlabel(xlabel, fontsize=12)
+        annotate_bars(ax)
+
+    plt.tight_layout()
+    plt.savefig(output_path)
+    plt.close()
+    return str(output_path)
+
+def print_profile(profile):
+    for split in SPLITS:
+        stats = profile["splits"][split]
+        print(f"\n--- {split}: {stats['samples']} samples ---")
+        print("  - Question types: " + ", ".join(f"{kind}: {count}" for kind, count in stats['question_types'].items()))
+        print("  - Dialogue turns: " + ", ".join(f"{turns}: {count}" for turns, count in stats['dialogue_turns'].items()))
+        print("  - Samples with rare operations: " + ", ".join(f"{op}: {count}" for op, count in stats['rare_operations'].items()))
+    dataset = profile["dataset"]
+    print(f"\n--- Full dataset: {dataset['samples']} samples ---")
+    print("  - Operation frequencies: " + ", ".join(f"{op}: {count}" for op, count in Counter(dataset['operations']).most_common()))
+    print("  - Program steps per turn: " + ", ".join(f"{steps}: {count}" for steps, count in dataset['program_steps'].items()))
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the train/test sets and the full dataset in one pass each, and render all distribution plots in parallel.")
+    parser.add_argument("--train_path", type=str, default=config.TRAIN_SET_PATH, help="Path to the final training set JSON file.")
+    parser.add_argument("--test_path", type=str, default=config.TEST_SET_PATH, help="Path to the final test set JSON file.")
+    parser.add_argument("--dataset_path", type=str, default=config.RAW_DATASET_PATH, help="Path to the raw ConvFinQA dataset, for operation frequencies.")
+    parser.add_argument("--output_dir", type=str, default=config.FIGURES_DIR, help="Directory to save the output plots.")
+    parser.add_argument("--profile_path", type=str, default=config.ANALYSIS_DIR / "dataset_profile.json", help="Path to save the statistics as JSON.")
+    parser.add_argument("--force", action="store_true", help="Recompute and re-render even if the inputs have not changed.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiled("profile_dataset", args.profile, args.profile_top):
+        paths = {SPLITS[0]: args.train_path, SPLITS[1]: args.test_path, "dataset": args.dataset_path}
+        missing = [path for path in paths.values() if not os.path.exists(path)]
+        if missing:
+            print(f"Error: Could not find dataset files: {', '.join(map(str, missing))}")
+            return
+        figure_paths = {figure: os.path.join(args.output_dir, file_name) for figure, file_name in FIGURES.items()}
+
+        # --- 1. Skip everything when the inputs are unchanged ---
+        fingerprint = input_fingerprint(paths.values())
+        if not args.force and os.path.exists(args.profile_path) and all(os.path.exists(p) for p in figure_paths.values()):
+            with open(args.profile_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get("fingerprint") == fingerprint:
+                print_profile(cached)
+                print(f"\nInputs unchanged since the last run; kept the plots in {args.output_dir} (use --force to re-render).")
+                return
+
+        # --- 2. One streaming pass per input file ---
+        stats = {name: profile_file(path) for name, path in paths.items()}
+        profile = {
+            "fingerprint": fingerprint,
+            "splits": {split: to_json(stats[split]) for split in SPLITS},
+            "dataset": to_json(stats["dataset"]),
+        }
+        print_profile(profile)
+
+        # --- 3. Render all figures in parallel worker processes ---
+        os.makedirs(args.output_dir, exist_ok=True)
+        figure_data = {
+            "question_types": {split: dict(stats[split]["question_types"]) for split in SPLITS},
+            "dialogue_turns": {split: dict(stats[split]["dialogue_turns"]) for split in SPLITS},
+            "rare_operations": {split: dict(stats[split]["rare_operations"]) for split in SPLITS},
+            "operations": dict(stats["dataset"]["operations"]),
+        }
+        if not figure_data["operations"]:
+            print("No operations found in the dataset; skipping the operations plot.")
+            del figure_data["operations"]
+        with ProcessPoolExecutor(max_workers=len(figure_data)) as pool:
+            futures = [pool.submit(render_figure, figure, data, figure_paths[figure]) for figure, data in figure_data.items()]
+            for future in futures:
+                print(f"Plot saved to {future.result()}")
+
+        # Saved last, so an interrupted run is not mistaken for a complete one
+        os.makedirs(os.path.dirname(os.path.abspath(args.profile_path)), exist_ok=True)
+        with open(args.profile_path, 'w', encoding='utf-8') as f:
+            json.dump(profile, f, indent=4)
+        print(f"\nProfile saved to {args.profile_path}")
+
+if __name__ == "__main__":
+    main()
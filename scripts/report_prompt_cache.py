@@ -0,0 +1,170 @@
+import json
+import argparse
+import sys
+import os
+from collections import defaultdict
+
+# Add the project root to the Python path to allow for module imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.history_utils import count_tokens
+from src.program_utils import dict_to_2d_list_table
+from src.prompt_utils import construct_program_generation_messages, format_history_turn, list_2d_to_markdown_table
+from src import config
+from src.profile_utils import add_profile_arguments, profiled
+
+# OpenAI-style automatic prefix caching: prompts of at least 1024 tokens, cached in 128-token blocks
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+
+def render_messages(messages):
+    """Flattens (role, content) messages in the order the provider sees them."""
+    return "".join(f"<|{role}|>{content}" for role, content in messages)
+
+def conversation_prompts(item, layout):
+    """Yields the flattened prompt of every turn of a conversation, with the gold programs as history."""
+    doc = item.get('doc', {})
+    dialogue = item.get('dialogue', {})
+    questions = dialogue.get('conv_questions', [])
+    programs = dialogue.get('turn_program', [])
+    answers = dialogue.get('executed_answers', [])
+
+    if layout == "finetuned":
+        from run_finetuned_inference import build_system_content
+        messages = [("system", build_system_content(doc))]
+        for i, question in enumerate(questions):
+            messages.append(("human", question))
+            yield render_messages(messages)
+            messages.append(("ai", programs[i] if i < len(programs) else ""))
+        return
+
+    table_str = list_2d_to_markdown_table(dict_to_2d_list_table(doc.get('table', {})))
+    history = ""
+    for i, question in enumerate(questions):
+        yield render_messages(construct_program_generation_messages(doc.get('pre_text', ''), table_str, doc.get('post_text', ''), history, question))
+        history += format_history_turn(i + 1, question, answers[i] if i < len(answers) else "n/a", programs[i] if i < len(programs) else "")
+
+def common_prefix_length(a, b):
+    limit = min(len(a), len(b))
+    i = 0
+    while i < limit and a[i] == b[i]:
+        i += 1
+    return i
+
+def cacheable_tokens(prefix_tokens):
+    """Tokens a provider with automatic prefix caching can serve from cache for a shared prefix."""
+    if prefix_tokens < CACHE_MIN_TOKENS:
+        return 0
+    return prefix_tokens // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS
+
+def analyze_layout(items, layout):
+    """
+    Renders every turn's prompt in dataset order and measures the prefix it shares with the
+    previous request, i.e. the part a prefix cache can serve. Returns per-turn-index totals.
+    """
+    by_turn = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "shared_prefix_tokens": 0, "cacheable_tokens": 0})
+    previous = ""
+    for item in items:
+        for turn, prompt in enumerate(conversation_prompts(item, layout), start=1):
+            prompt_tokens = count_tokens(prompt)
+            shared_tokens = count_tokens(prompt[:common_prefix_length(previous, prompt)])
+            stats = by_turn[min(turn, 5)]
+            stats["calls"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["shared_prefix_tokens"] += shared_tokens
+            stats["cacheable_tokens"] += cacheable_tokens(shared_tokens)
+            previous = prompt
+    return dict(sorted(by_turn.items()))
+
+def load_calls(calls_path):
+    with open(calls_path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def call_cost(call, cached):
+    input_price, output_price = config.MODEL_PRICES_PER_1M_TOKENS.get(call['model'], (0.0, 0.0))
+    cached_tokens = call['cached_input_tokens'] if cached else 0
+    input_cost = (call['input_tokens'] - cached_tokens + cached_tokens * config.CACHED_INPUT_PRICE_FACTOR) * input_price
+    return (input_cost + call['output_tokens'] * output_price) / 1_000_000
+
+def summarize_calls(calls):
+    """Per-turn-index cached share and latency of logged LLM calls, and the cost with and without cache discounts."""
+    by_turn = defaultdict(list)
+    for call in calls:
+        by_turn[min(call.get('turn') or 0, 5)].append(call)
+
+    def stats(group):
+        input_tokens = sum(c['input_tokens'] for c in group)
+        cached_tokens = sum(c['cached_input_tokens'] for c in group)
+        hit_latencies = [c['latency_s'] for c in group if c.get('latency_s') is not None and c['cached_input_tokens'] > 0]
+        miss_latencies = [c['latency_s'] for c in group if c.get('latency_s') is not None and c['cached_input_tokens'] == 0]
+        return {
+            "calls": len(group),
+            "input_tokens": input_tokens,
+            "cached_input_tokens": cached_tokens,
+            "cached_share": cached_tokens / input_tokens if input_tokens else 0.0,
+            "mean_latency_hit_s": sum(hit_latencies) / len(hit_latencies) if hit_latencies else None,
+            "mean_latency_miss_s": sum(miss_latencies) / len(miss_latencies) if miss_latencies else None,
+            "cost_usd": sum(call_cost(c, True) for c in group),
+            "cost_without_cache_usd": sum(call_cost(c, False) for c in group),
+        }
+
+    return {"total": stats(calls), "by_turn": {turn: stats(group) for turn, group in sorted(by_turn.items())}}
+
+def format_turn(turn):
+    return "5+" if turn == 5 else ("?" if turn == 0 else str(turn))
+
+def format_latency(value):
+    return f"{value:.3f}" if value is not None else "-"
+
+def main():
+    parser = argparse.ArgumentParser(description="Report how much of each prompt a provider prefix cache can serve, and how much it actually did.")
+    parser.add_argument("--dataset_path", type=str, default=config.TEST_SET_PATH, help="Conversations whose prompts are rendered for the layout analysis.")
+    parser.add_argument("--layout", type=str, default="baseline", choices=["baseline", "finetuned"], help="Prompt layout to analyze: the few-shot baseline prompt, or the fine-tuned model's messages.")
+    parser.add_argument("--limit", type=int, help="Limit the number of conversations analyzed.")
+    parser.add_argument("--calls_paths", type=str, nargs="+", default=[], help="*_llm_calls.jsonl files written with --metrics, to report measured cache hits.")
+    parser.add_argument("--output_path", type=str, default=config.ANALYSIS_DIR / "prompt_cache_report.json", help="Path to save the report as JSON.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiled("report_prompt_cache", args.profile, args.profile_top):
+        report = {}
+
+        # --- 1. Layout: shared prefix with the previous request, by turn index ---
+        with open(args.dataset_path, 'r', encoding='utf-8') as f:
+            items = json.load(f)
+        if isinstance(items, dict):
+            items = [item for split in items.values() for item in split]
+        items = items[:args.limit] if args.limit else items
+
+        layout = analyze_layout(items, args.layout)
+        report["layout"] = {"layout": args.layout, "by_turn": layout}
+        print(f"--- Prompt layout '{args.layout}': prefix shared with the previous request ({len(items)} conversations) ---")
+        print(f"  {'turn':>4} {'calls':>7} {'avg prompt':>11} {'avg shared':>11} {'cacheable':>10}")
+        for turn, stats in layout.items():
+            print(f"  {format_turn(turn):>4} {stats['calls']:>7} {stats['prompt_tokens'] / stats['calls']:>11.0f} "
+                  f"{stats['shared_prefix_tokens'] / stats['calls']:>11.0f} {stats['cacheable_tokens'] / stats['prompt_tokens']:>9.1%}")
+        total_prompt = sum(s['prompt_tokens'] for s in layout.values())
+        total_cacheable = sum(s['cacheable_tokens'] for s in layout.values())
+        print(f"  Cacheable share of all prompt tokens: {total_cacheable / total_prompt if total_prompt else 0:.1%}")
+
+        # --- 2. Measured: cached prompt tokens reported by the provider ---
+        report["runs"] = {}
+        for calls_path in args.calls_paths:
+            summary = summarize_calls(load_calls(calls_path))
+            report["runs"][calls_path] = summary
+            total = summary["total"]
+            print(f"\n--- Measured: {calls_path} ---")
+            print(f"  {'turn':>4} {'calls':>7} {'cached share':>13} {'latency hit s':>14} {'latency miss s':>15}")
+            for turn, stats in summary["by_turn"].items():
+                print(f"  {format_turn(turn):>4} {stats['calls']:>7} {stats['cached_share']:>13.1%} "
+                      f"{format_latency(stats['mean_latency_hit_s']):>14} {format_latency(stats['mean_latency_miss_s']):>15}")
+            print(f"  Cached: {total['cached_input_tokens']} of {total['input_tokens']} prompt tokens ({total['cached_share']:.1%})")
+            print(f"  Cost: ${total['cost_usd']:.4f} (${total['cost_without_cache_usd']:.4f} without cache discounts)")
+
+        os.makedirs(os.path.dirname(os.path.abspath(args.output_path)), exist_ok=True)
+        with open(args.output_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+        print(f"\nReport saved to {args.output_path}")
+
+if __name__ == "__main__":
+    main()
@@ -1,154 +1,233 @@
 import json
 import argparse
 import os 
-import re
 import sys
-from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple
 
 # Add the project root to the Python path to allow for module imports
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from langchain_openai import ChatOpenAI
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from src.program_utils import eval_program, program_tokenization, dict_to_2d_list_table
-from src import config
+from src.program_utils import eval_program, program_tokenization, dict_to_2d_list_table, repair_program
+from src.eval_utils import OnlineScorer
+from src.prompt_utils import construct_program_generation_messages, format_history_turn, list_2d_to_markdown_table
+from src import config, metrics_utils
+from src.profile_utils import add_profile_arguments, profiled
+from src.shard_utils import add_shard_arguments, check_shard_arguments, filter_shard, iter_shards, shard_path
+from src.schedule_utils import RenderCache, document_key, group_by_document, locality_order, locality_report, print_locality_report
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL_NAME = config.OPENAI_MODEL
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL_NAME = config.GEMINI_MODEL
 
-def list_2d_to_markdown_table(table_data: List[List[str]]) -> str:
+# --- LLM Interaction ---
+@lru_cache(maxsize=None)
+def get_model(llm_choice: str):
+    """Returns the chat model client, created once per process so its HTTP connections are reused across calls."""
+    if llm_choice == "openai":
+        return ChatOpenAI(model=OPENAI_MODEL_NAME, api_key=OPENAI_API_KEY, temperature=0)
+    return ChatGoogleGenerativeAI(model=GEMINI_MODEL_NAME, google_api_key=GEMINI_API_KEY, temperature=0)
+
+def call_llm(llm_choice: str, messages: List[Tuple[str, str]], **context) -> str:
     """
-    Converts a 2D table (list of lists) into markdown table format.
-    
-    Input: List of lists where first sublist is headers, rest are data rows
-    Example: [["Name", "Age"], ["Alice", "25"], ["Bob", "30"]]
-    
-    Output: Markdown-formatted table string
-    Example: "Name | Age\n--- | ---\nAlice | 25\nBob | 30"
+    Calls the specified LLM using LangChain and returns the text response.
+    `context` (e.g. sample_id, turn) is logged with the call's token usage when metrics are on.
     """
-    if not table_data: return "No table provided."
-    try:
-        header = " | ".join(map(str, table_data[0]))
-        separator = " | ".join("---" for _ in table_data[0])
-        rows = [" | ".join(map(str, row)) for row in table_data[1:]]
-        return "\n".join([header, separator] + rows)
-    except Exception:
-        return "Error formatting table."
-
-# --- Prompt Construction ---
-def construct_program_generation_prompt(pre_text: str, table_str: str, post_text: str, history: str, question: str) -> str:
-    return (
-        "You are a reasoning agent. Your task is to generate a single program string to answer the user's question based on the provided context and conversation history.\n\n"
-        "**CRITICAL RULES:**\n"
-        "1.  **Analyze Intent**: First, determine if the current question is a follow-up that uses the *result* of the previous turn, or if it is a new, independent question.\n"
-        "2.  **Program Construction**:\n"
-        "    - **If the question builds on the previous result** (e.g., 'what is the percentage change?'), you MUST copy the program from the previous turn (available in the history) and append the new operation.\n"
-        "    - **If the question is independent** (e.g., 'what about in 2008?'), you MUST start a new program from scratch.\n"
-        "3.  **Program Type**: Decide if the answer is a direct number from the text or requires a calculation.\n"
-        "    - If direct, the program is just the number (e.g., `306870`).\n"
-        "    - If calculation, you MUST use one of these 6 operations: `add`, `subtract`, `multiply`, `divide`, `exp`, `greater`.\n"
-        "4.  **Show Your Work**: Do NOT pre-calculate values. If the answer requires subtracting 50 from 100, the program must be `subtract(100, 50)`, not `50`.\n"
-        "5.  **Sequential Steps ONLY**: Do NOT nest operations. Programs must be a sequence of single operations separated by commas.\n"
-        "6.  **Use Step References**: For multi-step calculations, you MUST use the `#n` syntax to refer to the result of a previous step.\n"
-        "7.  **Subtraction Order**: The `subtract(a, b)` operation computes `a - b`. For 'the change from 2007 to 2008', if 2007 is 100 and 2008 is 120, the program is `subtract(120, 100)`.\n\n"
-        "**CORRECT, SEQUENTIAL FORMAT EXAMPLE:**\n"
-        "To calculate `(100 - 50) / 50`, the program MUST be: `subtract(100, 50), divide(#0, 50)`\n\n"
-        "**INCORRECT, NESTED FORMAT EXAMPLE:**\n"
-        "`divide(subtract(100, 50), 50)` <-- DO NOT DO THIS.\n\n"
-        "**INCORRECT, PRE-CALCULATED EXAMPLE:**\n"
-        "`divide(50, 50)` <-- DO NOT DO THIS.\n\n"
-        "--- FEW-SHOT EXAMPLES ---\n\n"
-        "**Example 1:**\n"
-        "Conversation History:\n"
-        "Turn 1:\nQ: what is the net change in rent expense from 2003 to 2004?\nA: 4785000.0\nProgram: subtract(118741000, 113956000)\n\n"
-        "Current Question: what percentage change does this represent?\n"
-        "Correct Program: subtract(118741000, 113956000), divide(#0, 113956000)\n\n"
-        "**Example 2:**\n"
-        "Conversation History:\n"
-        "Turn 1:\nQ: what was the total number of shares purchased in 11/07?\nA: 2891719.0\nProgram: 2891719\n\nTurn 2:\nQ: and the average price paid per share for that time?\nA: 44.16\nProgram: 44.16\n\nTurn 3:\nQ: so what was the total amount paid for these shares?\nA: 127698311.04\nProgram: multiply(2891719, 44.16)\n\n"
-        "Current Question: and converted to the hundreds?\n"
-        "Correct Program: multiply(2891719, 44.16), divide(#0, const_1000000)\n\n"
-        "--- END OF EXAMPLES ---\n\n"
-        "**YOUR TASK:**\n"
-        "Construct a single program string for the current turn. Your output MUST be ONLY the program string and nothing else.\n\n"
-        f"== Pre-Table Context ==\n{pre_text}\n\n"
-        f"== Table Data ==\n{table_str}\n\n"
-        f"== Post-Table Context ==\n{post_text}\n\n"
-        f"== Conversation History (Question, Answer, and Program) ==\n{history if history else 'No history yet.'}\n\n"
-        f"== Current Question ==\n{question}\n\n"
-        "Program:"
-    )
-
-# --- LLM Interaction ---
-def call_llm(llm_choice: str, prompt: str) -> str:
-    """Calls the specified LLM using LangChain and returns the text response."""
     try:
         if llm_choice == "openai":
             if not OPENAI_API_KEY: return "[ERROR: OPENAI_API_KEY not set]"
-            model = ChatOpenAI(model=OPENAI_MODEL_NAME, api_key=OPENAI_API_KEY, temperature=0)
         elif llm_choice == "gemini":
             if not GEMINI_API_KEY: return "[ERROR: GEMINI_API_KEY not set]"
-            model = ChatGoogleGenerativeAI(model=GEMINI_MODEL_NAME, google_api_key=GEMINI_API_KEY, temperature=0)
         else:
             return "[ERROR: LLM not implemented]"
+        model = get_model(llm_choice)
 
-        chain = ChatPromptTemplate.from_template("{prompt}") | model | StrOutputParser()
-        return chain.invoke({"prompt": prompt})
+        model_name = OPENAI_MODEL_NAME if llm_choice == "openai" else GEMINI_MODEL_NAME
+        with metrics_utils.span("llm_call", model=model_name):
+            response = model.invoke(messages)
+        metrics_utils.record_llm_usage(model_name, response.usage_metadata, **context)
+        return StrOutputParser().invoke(response)
     except Exception as e:
+        metrics_utils.inc("llm_errors_total", llm=llm_choice)
         return f"[ERROR: LangChain LLM call failed - {e}]"
 
 # --- Main Processing Logic ---
-def run_baseline_inference(llm_choice: str, input_path: str, output_path: str, limit: Optional[int] = None):
+def render_table(doc: Dict) -> str:
+    return list_2d_to_markdown_table(dict_to_2d_list_table(doc.get('table', {})))
+
+def save_locality_report(data_items: List[Dict], render_cache: RenderCache, report_path: Optional[str] = None):
+    """Prints the per-document-group cache hit rates of a grouped run, and saves them as JSON if asked."""
+    report = locality_report(data_items, render_cache)
+    print_locality_report(report)
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+        print(f"Locality report saved to {report_path}")
+
+def run_baseline_inference(llm_choice: str, input_path: str, output_path: str, limit: Optional[int] = None, repair: bool = False, online_scorer: Optional[OnlineScorer] = None, shard: Optional[tuple] = None, group_by_doc: bool = False, locality_report_path: Optional[str] = None):
+    """
+    Generates programs turn by turn, conditioned on the model's own history. With `online_scorer`,
+    each finished item is scored against its gold turns and the run stops early (saving what it
+    has) when the scorer reports accuracy below its floor. With `shard` (i, N), only the items of
+    that shard are processed. With `group_by_doc`, the items of each document run back to back and
+    share one rendered table; predictions are still saved in input order.
+    """
     with open(input_path, 'r', encoding='utf-8') as f:
         dataset = json.load(f)
 
-    all_final_outputs = []
+    outputs_by_position = {}
     data_items = dataset if isinstance(dataset, list) else next(iter(dataset.values()), [])
 
     if limit:
         print(f"Limiting processing to the first {limit} samples.")
         data_items = data_items[:limit]
+    if shard:
+        data_items = filter_shard(data_items, shard)
+        print(f"Processing shard {shard[0]}/{shard[1]}: {len(data_items)} samples.")
 
-    for item in data_items:
+    order = locality_order(data_items) if group_by_doc else range(len(data_items))
+    render_cache = RenderCache(render_table) if group_by_doc else None
+    for position in order:
+        item = data_items[position]
         item_id = item.get('id')
         print(f"\nProcessing ID: {item_id}")
 
         doc = item.get('doc', {})
-        table_data = dict_to_2d_list_table(doc.get('table', {}))
-        table_str = list_2d_to_markdown_table(table_data)
+        table_str = render_cache.get(doc, document_key(item_id)) if render_cache else render_table(doc)
         
         questions = item.get('dialogue', {}).get('conv_questions', [])
         
         history = ""
-        turn_programs, executed_answers = [], []
+        turn_programs, executed_answers, program_repairs = [], [], []
 
         for i, question in enumerate(questions):
             print(f"  Turn {i+1}: Generating program...")
             
-            prog_prompt = construct_program_generation_prompt(doc.get('pre_text', ''), table_str, doc.get('post_text', ''), history, question)
-            program_str = call_llm(llm_choice, prog_prompt).strip()
+            with metrics_utils.span("prompt_render"):
+                prog_messages = construct_program_generation_messages(doc.get('pre_text', ''), table_str, doc.get('post_text', ''), history, question)
+            program_str = call_llm(llm_choice, prog_messages, sample_id=item_id, turn=i + 1).strip()
+            if repair:
+                program_str, repairs = repair_program(program_str)
+                program_repairs.append(repairs)
+                if repairs:
+                    print(f"  Turn {i+1}: Repaired program ({', '.join(repairs)})")
             turn_programs.append(program_str)
             
-            tokenized_prog = program_tokenization(program_str)
-            _, exe_res = eval_program(tokenized_prog)
+            with metrics_utils.span("execution"):
+                tokenized_prog = program_tokenization(program_str)
+                _, exe_res = eval_program(tokenized_prog)
             executed_answers.append(exe_res)
             
-            history += f"Turn {i+1}:\nQ: {question}\nA: {exe_res}\nProgram: {program_str}\n\n"
+            history += format_history_turn(i + 1, question, exe_res, program_str)
 
-        all_final_outputs.append({
+        output = {
             "id": item_id,
             "turn_program": turn_programs,
             "executed_answers": executed_answers
-        })
+        }
+        if repair:
+            output["program_repairs"] = program_repairs
+        outputs_by_position[position] = output
         print(f"  Finished processing for {item_id}")
 
+        if online_scorer:
+            online_scorer.add(item, output)
+            print("  Running accuracy: " + ", ".join(f"{name} {value}" for name, value in online_scorer.postfix().items()))
+            if online_scorer.should_abort():
+                print(f"\n{online_scorer.abort_message()}")
+                break
+
+    all_final_outputs = [outputs_by_position[position] for position in sorted(outputs_by_position)]
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(all_final_outputs, f, indent=4)
+    print(f"\nBatch generation complete. Predictions saved to {output_path}")
+    if group_by_doc:
+        save_locality_report(data_items, render_cache, locality_report_path)
+
+def build_gold_history_messages(item: Dict, render_cache: Optional[RenderCache] = None) -> List[List[Tuple[str, str]]]:
+    """
+    Builds the messages of every turn of an item, with the history filled from the gold programs
+    and executed answers (teacher forcing), so each turn can be requested independently.
+    """
+    doc = item.get('doc', {})
+    table_str = render_cache.get(doc, document_key(item.get('id'))) if render_cache else render_table(doc)
+    dialogue = item.get('dialogue', {})
+    gold_programs = dialogue.get('turn_program', [])
+    gold_answers = dialogue.get('executed_answers', [])
+
+    turn_messages, history = [], ""
+    for i, question in enumerate(dialogue.get('conv_questions', [])):
+        turn_messages.append(construct_program_generation_messages(doc.get('pre_text', ''), table_str, doc.get('post_text', ''), history, question))
+        gold_prog = gold_programs[i] if i < len(gold_programs) else ""
+        gold_ans = gold_answers[i] if i < len(gold_answers) else "n/a"
+        history += format_history_turn(i + 1, question, gold_ans, gold_prog)
+    return turn_messages
+
+def run_gold_history_inference(llm_choice: str, input_path: str, output_path: str, limit: Optional[int] = None, max_concurrency: int = 16, repair: bool = False, shard: Optional[tuple] = None, group_by_doc: bool = False, locality_report_path: Optional[str] = None):
+    """
+    Runs every turn of every item (of `shard`, if given) concurrently, each conditioned on the gold
+    history. With `group_by_doc`, the turns of each document's items run in order on one worker,
+    so they reach the provider one after another and can hit its prefix cache.
+    """
+    with open(input_path, 'r', encoding='utf-8') as f:
+        dataset = json.load(f)
+
+    data_items = dataset if isinstance(dataset, list) else next(iter(dataset.values()), [])
+    if limit:
+        print(f"Limiting processing to the first {limit} samples.")
+        data_items = data_items[:limit]
+    if shard:
+        data_items = filter_shard(data_items, shard)
+        print(f"Processing shard {shard[0]}/{shard[1]}: {len(data_items)} samples.")
+
+    render_cache = RenderCache(render_table) if group_by_doc else None
+    requests, turn_keys = [], []
+    for item_index, item in enumerate(data_items):
+        with metrics_utils.span("prompt_render"):
+            item_messages = build_gold_history_messages(item, render_cache)
+        for i, messages in enumerate(item_messages):
+            requests.append((messages, {"sample_id": item.get('id'), "turn": i + 1}))
+            turn_keys.append(item_index)
+
+    print(f"Generating programs for {len(requests)} independent turns across {len(data_items)} items...")
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        if group_by_doc:
+            program_strs = [None] * len(requests)
+            group_of_item = {position: group for group, positions in enumerate(group_by_document(data_items).values()) for position in positions}
+            groups = [[] for _ in set(group_of_item.values())]
+            for index, item_index in enumerate(turn_keys):
+                groups[group_of_item[item_index]].append(index)
+
+            def run_group(indexes):
+                for index in indexes:
+                    messages, context = requests[index]
+                    program_strs[index] = call_llm(llm_choice, messages, **context).strip()
+
+            list(executor.map(run_group, groups))
+        else:
+            program_strs = list(executor.map(lambda request: call_llm(llm_choice, request[0], **request[1]).strip(), requests))
+
+    all_final_outputs = [{"id": item.get('id'), "turn_program": [], "executed_answers": []} for item in data_items]
+    for item_index, program_str in zip(turn_keys, program_strs):
+        if repair:
+            program_str, repairs = repair_program(program_str)
+            all_final_outputs[item_index].setdefault('program_repairs', []).append(repairs)
+        with metrics_utils.span("execution"):
+            tokenized_prog = program_tokenization(program_str)
+            _, exe_res = eval_program(tokenized_prog)
+        all_final_outputs[item_index]['turn_program'].append(program_str)
+        all_final_outputs[item_index]['executed_answers'].append(exe_res)
+
     with open(output_path, 'w', encoding='utf-8') as f:
         json.dump(all_final_outputs, f, indent=4)
     print(f"\nBatch generation complete. Predictions saved to {output_path}")
+    if group_by_doc:
+        save_locality_report(data_items, render_cache, locality_report_path)
 
 def main():
     parser = argparse.ArgumentParser(description="Generate baseline predictions using a few-shot prompted model.")
@@ -156,9 +235,46 @@ def main():
     parser.add_argument("--input_data_path", type=str, default=config.TEST_SET_PATH, help="Path to the input data JSON file.")
     parser.add_argument("--output_path", type=str, default=config.PREDICTIONS_DIR / "baseline_on_test.json", help="Path to save the output predictions.")
     parser.add_argument("--limit", type=int, help="Limit the number of samples to process.")
+    parser.add_argument("--history", type=str, default="model", choices=["model", "gold"], help="Condition each turn on the model's own previous programs, or on the gold programs (all turns run in parallel).")
+    parser.add_argument("--max_concurrency", type=int, default=16, help="Maximum concurrent requests with --history gold.")
+    parser.add_argument("--repair", action="store_true", help="Repair malformed programs (nesting, separators, surrounding text) before execution; applied repairs are saved as 'program_repairs'.")
+    parser.add_argument("--metrics", action="store_true", help="Collect timing and token metrics and export them to config.METRICS_DIR.")
+    parser.add_argument("--online_eval", action="store_true", help="Score each finished item against the input gold and print running accuracies with 95%% confidence intervals (--history model only).")
+    parser.add_argument("--abort_below", type=float, help="Stop the run once turn execution accuracy (in %%) is confidently below this floor. Implies --online_eval.")
+    parser.add_argument("--abort_min_samples", type=int, default=config.ONLINE_EVAL_MIN_SAMPLES, help="Items to score before --abort_below can stop the run.")
+    parser.add_argument("--group_by_document", action="store_true", help="Run the items of each document (ids differing only in the Single_/Double_ prefix and the trailing -N) back to back on one worker, for prompt cache hits. Predictions keep the input order.")
+    parser.add_argument("--locality_report_path", type=str, help="Path to save the per-document-group cache hit rates of a --group_by_document run as JSON.")
+    add_shard_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    check_shard_arguments(parser, args)
+    online_scorer = None
+    if args.online_eval or args.abort_below is not None:
+        if args.history == "gold":
+            parser.error("--online_eval and --abort_below are only available with --history model")
+        online_scorer = OnlineScorer(args.abort_below, args.abort_min_samples)
+    with profiled("run_baseline_inference", args.profile, args.profile_top):
+        if args.metrics:
+            metrics_utils.enable()
+
+        # Each shard is written next to the single-node output; merge_shards.py combines them
+        for shard in iter_shards(args):
+            output_path = shard_path(args.output_path, shard)
+            locality_report_path = shard_path(args.locality_report_path, shard) if args.locality_report_path else None
+            if args.history == "gold":
+                run_gold_history_inference(args.llm, args.input_data_path, output_path, args.limit, args.max_concurrency, args.repair, shard, args.group_by_document, locality_report_path)
+            else:
+                run_baseline_inference(args.llm, args.input_data_path, output_path, args.limit, args.repair, online_scorer, shard, args.group_by_document, locality_report_path)
+                if online_scorer and online_scorer.should_abort():
+                    break
+
+        metrics_path = metrics_utils.export("run_baseline_inference")
+        if metrics_path:
+            metrics_utils.print_summary()
+            print(f"Metrics saved to {metrics_path}")
 
-    run_baseline_inference(args.llm, args.input_data_path, args.output_path, args.limit)
+    if online_scorer and online_scorer.should_abort():
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
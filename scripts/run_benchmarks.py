@@ -0,0 +1,157 @@
+import json
+import argparse
+import contextlib
+import datetime
+import io
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import timeit
+
+# Add the project root to the Python path to allow for module imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.program_utils import (
+    str_to_num, program_tokenization, eval_program, equal_program,
+    dict_to_2d_list_table, dict_to_markdown_table
+)
+from src import config
+from src.profile_utils import add_profile_arguments, profiled
+from run_evaluation import evaluate_predictions
+
+DEFAULT_PREDICTIONS_PATH = config.PREDICTIONS_DIR / "finetuned_gpt-4.1-mini_on_test.json"
+
+def build_benchmarks(gold_path, predictions_path):
+    """
+    Returns {name: (callable, items_per_call)} for the program_utils hot paths and the full
+    evaluation, using the bundled test set and prediction file as inputs.
+    """
+    with open(gold_path, 'r', encoding='utf-8') as f:
+        gold_data = json.load(f)
+    with open(predictions_path, 'r', encoding='utf-8') as f:
+        pred_data = json.load(f)
+
+    gold_programs = [p for item in gold_data for p in item['dialogue']['turn_program']]
+    tokenized_gold = [program_tokenization(p) for p in gold_programs]
+    tables = [item['doc']['table'] for item in gold_data]
+    number_strings = [str(a) for item in gold_data for a in item['dialogue']['conv_answers']] + ["1,234", "3.75%", "const_m1", "n/a"]
+
+    pred_dict = {item['id']: item['turn_program'] for item in pred_data}
+    program_pairs = [
+        (program_tokenization(gold), program_tokenization(pred))
+        for item in gold_data
+        for gold, pred in zip(item['dialogue']['turn_program'], pred_dict.get(item['id'], []))
+    ]
+
+    error_file = os.path.join(tempfile.gettempdir(), "benchmark_error_analysis.csv")
+
+    def run_evaluation():
+        with contextlib.redirect_stdout(io.StringIO()):
+            evaluate_predictions(gold_path, predictions_path, error_file)
+
+    return {
+        "str_to_num": (lambda: [str_to_num(s) for s in number_strings], len(number_strings)),
+        "program_tokenization": (lambda: [program_tokenization(p) for p in gold_programs], len(gold_programs)),
+        "eval_program": (lambda: [eval_program(p) for p in tokenized_gold], len(tokenized_gold)),
+        "equal_program": (lambda: [equal_program(g, p) for g, p in program_pairs], len(program_pairs)),
+        "dict_to_2d_list_table": (lambda: [dict_to_2d_list_table(t) for t in tables], len(tables)),
+        "dict_to_markdown_table": (lambda: [dict_to_markdown_table(t) for t in tables], len(tables)),
+        "evaluate_predictions": (run_evaluation, 1),
+    }
+
+def time_benchmark(fn, repeat, min_time):
+    """
+    Times `fn` after a warm-up call. The number of calls per repeat is calibrated so each
+    repeat takes at least `min_time` seconds; returns per-call timings in seconds.
+    """
+    fn()
+    timer = timeit.Timer(fn)
+    number, elapsed = 1, 0.0
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+    timings = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "calls_per_repeat": number,
+        "min_s": min(timings),
+        "median_s": statistics.median(timings),
+        "mean_s": statistics.mean(timings),
+        "stdev_s": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+    }
+
+def compare_to_baseline(results, baseline, threshold):
+    """Prints each benchmark's median against the baseline and returns the names of regressions."""
+    regressions = []
+    print("\n--- Comparison to Baseline (median) ---")
+    for name, stats in results.items():
+        base = baseline.get("benchmarks", {}).get(name)
+        if not base:
+            print(f"  {name:<24} no baseline")
+            continue
+        ratio = stats["median_s"] / base["median_s"] if base["median_s"] else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  <-- REGRESSION"
+            regressions.append(name)
+        print(f"  {name:<24} {base['median_s'] * 1000:10.3f} ms -> {stats['median_s'] * 1000:10.3f} ms  ({ratio:5.2f}x){flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for program_utils and the evaluation hot paths.")
+    parser.add_argument("--gold_path", type=str, default=config.TEST_SET_PATH, help="Path to the gold standard JSON file.")
+    parser.add_argument("--predictions_path", type=str, default=DEFAULT_PREDICTIONS_PATH, help="Path to the predictions JSON file.")
+    parser.add_argument("--output_path", type=str, default=config.OUTPUTS_DIR / "benchmarks" / "latest.json", help="Path to save the benchmark results JSON.")
+    parser.add_argument("--baseline_path", type=str, help="Benchmark results JSON to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative slowdown of the median beyond which a benchmark is flagged as a regression.")
+    parser.add_argument("--repeat", type=int, default=7, help="Number of timed repeats per benchmark.")
+    parser.add_argument("--min_time", type=float, default=0.2, help="Minimum duration of each repeat, in seconds.")
+    parser.add_argument("--only", type=str, nargs="+", help="Run only the named benchmarks.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiled("run_benchmarks", args.profile, args.profile_top):
+        benchmarks = build_benchmarks(args.gold_path, args.predictions_path)
+        if args.only:
+            benchmarks = {name: bench for name, bench in benchmarks.items() if name in args.only}
+
+        # --- 1. Run the benchmarks ---
+        results = {}
+        print("--- Benchmarks (per call) ---")
+        for name, (fn, items_per_call) in benchmarks.items():
+            stats = time_benchmark(fn, args.repeat, args.min_time)
+            stats["items_per_call"] = items_per_call
+            results[name] = stats
+            print(f"  {name:<24} median {stats['median_s'] * 1000:10.3f} ms  (min {stats['min_s'] * 1000:.3f}, stdev {stats['stdev_s'] * 1000:.3f}, {items_per_call} items)")
+
+        # --- 2. Save results ---
+        output = {
+            "meta": {
+                "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "repeat": args.repeat,
+                "min_time_s": args.min_time,
+            },
+            "benchmarks": results,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(args.output_path)), exist_ok=True)
+        with open(args.output_path, 'w', encoding='utf-8') as f:
+            json.dump(output, f, indent=4)
+        print(f"\nBenchmark results saved to {args.output_path}")
+
+        # --- 3. Compare against a stored baseline ---
+        if args.baseline_path:
+            with open(args.baseline_path, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+            regressions = compare_to_baseline(results, baseline, args.threshold)
+            if regressions:
+                print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}: {', '.join(regressions)}")
+                sys.exit(1)
+            print("\nNo regressions.")
+
+if __name__ == "__main__":
+    main()
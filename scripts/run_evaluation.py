@@ -1,6 +1,5 @@
 import json
 import argparse
-import re
 import csv
 import sys
 import os
@@ -9,107 +8,34 @@ from collections import defaultdict
 # Add the project root to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from src.program_utils import str_to_num, program_tokenization, equal_program
-from src import config
+from src.eval_utils import ScoreCache, build_turn_table, compute_slice_metrics, score_samples, write_table
+from src.io_utils import GoldIndex, iter_records
+from src import config, metrics_utils
+from src.profile_utils import add_profile_arguments, profiled
+from src.shard_utils import add_shard_arguments, check_shard_arguments, check_complete, in_shard, iter_shards, shard_path
 
-def evaluate_predictions(gold_path, predictions_path, error_file_path="error_analysis.csv"):
-    """Evaluates prediction file against the gold standard dataset."""
-    with open(gold_path, 'r', encoding='utf-8') as f:
-        gold_data = json.load(f)
-    with open(predictions_path, 'r', encoding='utf-8') as f:
-        pred_data = json.load(f)
+def error_category(turn):
+    """Returns the error category of a scored turn, or None when it is fully correct."""
+    if not turn['exe_correct'] and not turn['prog_correct']:
+        return 'both_mismatch'
+    if not turn['exe_correct']:
+        return 'answer_mismatch_only'
+    if not turn['prog_correct']:
+        return 'program_mismatch_only'
+    return None
 
-    if isinstance(gold_data, dict):
-        flat_gold_data = [item for split in gold_data.values() for item in split]
-    else:
-        flat_gold_data = gold_data
-    gold_dict = {item['id']: item for item in flat_gold_data}
-    
-    turn_exe_correct, turn_prog_correct, total_turns = 0, 0, 0
-    sample_exe_correct, sample_prog_correct = 0, 0
-    errors = defaultdict(list)
-
-    for pred_item in pred_data:
-        if 'error' in pred_item: continue
-        gold_item = gold_dict.get(pred_item['id'])
-        if not gold_item: continue
-
-        gold_dialogue = gold_item.get('dialogue', {})
-        pred_programs = pred_item.get('turn_program', [])
-        pred_exe_ans = pred_item.get('executed_answers', [])
-        
-        num_turns = len(gold_dialogue.get('turn_program', []))
-        if num_turns == 0:
-            continue
-
-        last_turn_exe_correct = False
-        last_turn_prog_correct = False
-
-        for i, gold_prog_str in enumerate(gold_dialogue.get('turn_program', [])):
-            if i >= len(pred_programs) or i >= len(pred_exe_ans): continue
-            
-            total_turns += 1
-            gold_exe_ans = gold_dialogue['executed_answers'][i]
-            
-            pred_ans = pred_exe_ans[i]
-            is_exe_correct = False
-            if isinstance(gold_exe_ans, str) and gold_exe_ans.lower() in ['yes', 'no']:
-                if str(pred_ans).lower() == gold_exe_ans.lower():
-                    is_exe_correct = True
-            else:
-                gold_ans_norm = round(str_to_num(gold_exe_ans), 5) if isinstance(str_to_num(gold_exe_ans), float) else str_to_num(gold_exe_ans)
-                pred_ans_norm = round(pred_ans, 5) if isinstance(pred_ans, float) else pred_ans
-                if pred_ans_norm == gold_ans_norm:
-                    is_exe_correct = True
-            
-            if is_exe_correct:
-                turn_exe_correct += 1
-
-            is_program_correct = False
-            gold_prog_tokenized = program_tokenization(gold_prog_str)
-            pred_prog_tokenized = program_tokenization(pred_programs[i])
-            if equal_program(gold_prog_tokenized, pred_prog_tokenized):
-                is_program_correct = True
-            else:
-                def normalize_program_string(prog_str):
-                    s = prog_str.replace(" ", "")
-                    s = re.sub(r'(\d+)\.0(?![\d])', r'\1', s)
-                    s = s.replace("const_", "")
-                    return s
-                gold_prog_norm = normalize_program_string(gold_prog_str)
-                pred_prog_norm = normalize_program_string(pred_programs[i])
-                if gold_prog_norm == pred_prog_norm:
-                    is_program_correct = True
-            
-            if is_program_correct:
-                turn_prog_correct += 1
-
-            if not is_exe_correct or not is_program_correct:
-                error_detail = {
-                    "id": pred_item['id'],
-                    "turn": i + 1,
-                    "gold_program": gold_prog_str,
-                    "predicted_program": pred_programs[i],
-                    "gold_answer": gold_exe_ans,
-                    "predicted_answer": pred_ans
-                }
-                if not is_exe_correct and not is_program_correct:
-                    errors['both_mismatch'].append(error_detail)
-                elif not is_exe_correct:
-                    errors['answer_mismatch_only'].append(error_detail)
-                else:
-                    errors['program_mismatch_only'].append(error_detail)
-            
-            if i == num_turns - 1:
-                last_turn_exe_correct = is_exe_correct
-                last_turn_prog_correct = is_program_correct
-        
-        if last_turn_exe_correct:
-            sample_exe_correct += 1
-        if last_turn_prog_correct:
-            sample_prog_correct += 1
+def error_detail(sample_id, turn):
+    return {
+        "id": sample_id,
+        "turn": turn['turn'],
+        "gold_program": turn['gold_program'],
+        "predicted_program": turn['predicted_program'],
+        "gold_answer": turn['gold_answer'],
+        "predicted_answer": turn['predicted_answer'],
+        "ungrounded_args": turn['ungrounded_args']
+    }
 
-    total_samples = len(pred_data)
+def print_accuracy(total_samples, sample_exe_correct, sample_prog_correct, total_turns, turn_exe_correct, turn_prog_correct, ungrounded_turns):
     turn_exe_acc = (turn_exe_correct / total_turns) * 100 if total_turns > 0 else 0
     turn_prog_acc = (turn_prog_correct / total_turns) * 100 if total_turns > 0 else 0
     sample_exe_acc = (sample_exe_correct / total_samples) * 100 if total_samples > 0 else 0
@@ -125,7 +51,23 @@ def evaluate_predictions(gold_path, predictions_path, error_file_path="error_ana
     print(f"Total conversational turns evaluated: {total_turns}")
     print(f"  - Execution Accuracy: {turn_exe_acc:.2f}%")
     print(f"  - Program Accuracy:   {turn_prog_acc:.2f}%")
+    print(f"  - Turns with ungrounded arguments: {ungrounded_turns}")
 
+def print_top_errors(examples, counts):
+    """Prints up to 10 example errors per category, with the category's total error count."""
+    print("\n--- Turn-Level Error Analysis (Top 10) ---")
+    for category, err_list in examples.items():
+        print(f"\n--- {category.replace('_', ' ').title()} ({counts[category]} errors) ---")
+        if not err_list:
+            print("  None")
+        else:
+            for err in err_list[:10]:
+                print(f"  ID: {err['id']}, Turn: {err['turn']}")
+                print(f"    Gold Prog: {err['gold_program']} (Exec: {err['gold_answer']})")
+                print(f"    Pred Prog: {err['predicted_program']} (Exec: {err['predicted_answer']})")
+
+def write_error_file(errors, error_file_path):
+    """Writes the errors, grouped by category, to the error analysis CSV."""
     all_errors_flat = []
     for category, err_list in errors.items():
         for err in err_list:
@@ -139,25 +81,252 @@ def evaluate_predictions(gold_path, predictions_path, error_file_path="error_ana
             writer.writerows(all_errors_flat)
     print(f"\nFull error analysis saved to {error_file_path}")
 
-    print("\n--- Turn-Level Error Analysis (Top 10) ---")
-    for category, err_list in errors.items():
-        print(f"\n--- {category.replace('_', ' ').title()} ({len(err_list)} errors) ---")
-        if not err_list:
-            print("  None")
-        else:
-            for err in err_list[:10]:
-                print(f"  ID: {err['id']}, Turn: {err['turn']}")
-                print(f"    Gold Prog: {err['gold_program']} (Exec: {err['gold_answer']})")
-                print(f"    Pred Prog: {err['predicted_program']} (Exec: {err['predicted_answer']})")
+def evaluate_predictions(gold_path, predictions_path, error_file_path="error_analysis.csv", cache_path=None, slices_path=None, turn_table_path=None, shard=None):
+    """
+    Evaluates prediction file against the gold standard dataset.
+    With `cache_path`, per-sample results are reused from (and stored to) a score cache,
+    so only samples whose gold or prediction changed since the last run are rescored.
+    With `slices_path` / `turn_table_path`, the per-turn results table and the accuracy per
+    slice (turn index, dialogue length, type II, rare ops, op set, program length) are saved.
+    With `shard` (i, N), only the predictions of that shard are scored, and the counts and errors
+    are also saved as a JSON accumulator next to the error file for merge_shards.py.
+    """
+    with metrics_utils.span("eval_load"):
+        with open(gold_path, 'r', encoding='utf-8') as f:
+            gold_data = json.load(f)
+        with open(predictions_path, 'r', encoding='utf-8') as f:
+            pred_data = json.load(f)
+
+    if isinstance(gold_data, dict):
+        flat_gold_data = [item for split in gold_data.values() for item in split]
+    else:
+        flat_gold_data = gold_data
+    gold_dict = {item['id']: item for item in flat_gold_data}
+    
+    turn_exe_correct, turn_prog_correct, total_turns = 0, 0, 0
+    sample_exe_correct, sample_prog_correct = 0, 0
+    ungrounded_turns = 0
+    errors = defaultdict(list)
+    error_positions = []
+
+    # Positions in the full prediction file let merged shards restore the single-node order
+    positions = [i for i, pred_item in enumerate(pred_data) if in_shard(pred_item['id'], shard)]
+    pair_positions = [
+        i for i in positions
+        if 'error' not in pred_data[i] and pred_data[i]['id'] in gold_dict
+    ]
+    pairs = [(gold_dict[pred_data[i]['id']], pred_data[i]) for i in pair_positions]
+    cache = ScoreCache(cache_path) if cache_path else None
+    results = score_samples(pairs, cache)
+    if cache:
+        print(f"Scored {cache.misses} samples, reused {cache.hits} from {cache_path}")
+        cache.close()
+
+    for position, (_, pred_item), result in zip(pair_positions, pairs, results):
+        if result is None:
+            continue
+
+        for turn in result['turns']:
+            total_turns += 1
+            is_exe_correct, is_program_correct = turn['exe_correct'], turn['prog_correct']
+            if is_exe_correct:
+                turn_exe_correct += 1
+            if is_program_correct:
+                turn_prog_correct += 1
+            if turn['ungrounded_args']:
+                ungrounded_turns += 1
+
+            category = error_category(turn)
+            if category:
+                errors[category].append(error_detail(pred_item['id'], turn))
+                error_positions.append((position, category, errors[category][-1]))
+        
+        if result['last_turn_exe_correct']:
+            sample_exe_correct += 1
+        if result['last_turn_prog_correct']:
+            sample_prog_correct += 1
+
+    total_samples = len(positions)
+    metrics_utils.inc("eval_samples_total", total_samples)
+    metrics_utils.inc("eval_turns_total", total_turns)
+    print_accuracy(total_samples, sample_exe_correct, sample_prog_correct, total_turns, turn_exe_correct, turn_prog_correct, ungrounded_turns)
+    write_error_file(errors, error_file_path)
+
+    if shard:
+        accumulator_path = os.path.splitext(error_file_path)[0] + ".json"
+        with open(accumulator_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "shard": list(shard),
+                "counts": {
+                    "total_samples": total_samples,
+                    "sample_exe_correct": sample_exe_correct,
+                    "sample_prog_correct": sample_prog_correct,
+                    "total_turns": total_turns,
+                    "turn_exe_correct": turn_exe_correct,
+                    "turn_prog_correct": turn_prog_correct,
+                    "ungrounded_turns": ungrounded_turns,
+                },
+                "errors": error_positions,
+            }, f)
+        print(f"Shard accumulator saved to {accumulator_path}")
+
+    if slices_path or turn_table_path:
+        turn_table = build_turn_table(pairs, results)
+        if turn_table_path:
+            write_table(turn_table, turn_table_path)
+            print(f"Per-turn results saved to {turn_table_path}")
+        if slices_path:
+            slice_metrics = compute_slice_metrics(turn_table)
+            write_table(slice_metrics, slices_path)
+            print("\n--- Sliced Accuracy ---")
+            for row in slice_metrics.itertuples(index=False):
+                print(f"  {row.slice:<20} {row.value:<28} {row.turns:>6} turns  exe {row.exe_acc:6.2f}%  prog {row.prog_acc:6.2f}%")
+            print(f"Sliced metrics saved to {slices_path}")
+
+    print_top_errors(errors, {category: len(err_list) for category, err_list in errors.items()})
+
+def evaluate_predictions_streaming(gold_path, predictions_path, error_file_path="error_analysis.csv", cache_path=None, gold_index_path=None, batch_size=256):
+    """
+    Evaluates a prediction file in constant memory. Predictions are read incrementally
+    (JSON list or JSONL, optionally .gz/.zst), gold records are looked up in an on-disk
+    index, and error rows are appended to the CSV as they are found (in prediction order
+    rather than grouped by category). Accuracies match `evaluate_predictions`.
+    """
+    with metrics_utils.span("eval_gold_index"):
+        gold_index = GoldIndex(gold_path, gold_index_path)
+    if gold_index.rebuilt:
+        print(f"Indexed {len(gold_index)} gold records in {gold_index.index_path}")
+    cache = ScoreCache(cache_path) if cache_path else None
+
+    turn_exe_correct, turn_prog_correct, total_turns = 0, 0, 0
+    sample_exe_correct, sample_prog_correct = 0, 0
+    ungrounded_turns, total_samples = 0, 0
+    error_examples, error_counts = defaultdict(list), defaultdict(int)
+
+    with open(error_file_path, 'w', newline='', encoding='utf-8') as f:
+        writer = None
+
+        def score_batch(pairs):
+            nonlocal writer, turn_exe_correct, turn_prog_correct, total_turns, sample_exe_correct, sample_prog_correct, ungrounded_turns
+            for (_, pred_item), result in zip(pairs, score_samples(pairs, cache)):
+                if result is None:
+                    continue
+                for turn in result['turns']:
+                    total_turns += 1
+                    turn_exe_correct += turn['exe_correct']
+                    turn_prog_correct += turn['prog_correct']
+                    ungrounded_turns += bool(turn['ungrounded_args'])
+                    category = error_category(turn)
+                    if category:
+                        row = {**error_detail(pred_item['id'], turn), "error_category": category}
+                        if writer is None:
+                            writer = csv.DictWriter(f, fieldnames=row.keys())
+                            writer.writeheader()
+                        writer.writerow(row)
+                        error_counts[category] += 1
+                        if len(error_examples[category]) < 10:
+                            error_examples[category].append(row)
+                sample_exe_correct += result['last_turn_exe_correct']
+                sample_prog_correct += result['last_turn_prog_correct']
+
+        pairs = []
+        for pred_item in iter_records(predictions_path):
+            total_samples += 1
+            if 'error' in pred_item:
+                continue
+            gold_item = gold_index.get(pred_item['id'])
+            if gold_item is None:
+                continue
+            pairs.append((gold_item, pred_item))
+            if len(pairs) >= batch_size:
+                score_batch(pairs)
+                pairs = []
+        if pairs:
+            score_batch(pairs)
+
+    gold_index.close()
+    if cache:
+        print(f"Scored {cache.misses} samples, reused {cache.hits} from {cache_path}")
+        cache.close()
+
+    metrics_utils.inc("eval_samples_total", total_samples)
+    metrics_utils.inc("eval_turns_total", total_turns)
+    print_accuracy(total_samples, sample_exe_correct, sample_prog_correct, total_turns, turn_exe_correct, turn_prog_correct, ungrounded_turns)
+    print(f"\nFull error analysis saved to {error_file_path}")
+    print_top_errors(error_examples, error_counts)
+
+def merge_evaluation_shards(accumulator_paths, error_file_path):
+    """
+    Combines the accumulators of a sharded evaluation into the summary and error CSV of a
+    single-node run over the same prediction file.
+    """
+    accumulators = []
+    for path in accumulator_paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            accumulators.append(json.load(f))
+    check_complete([tuple(accumulator['shard']) for accumulator in accumulators])
+
+    counts = {key: sum(accumulator['counts'][key] for accumulator in accumulators) for key in accumulators[0]['counts']}
+    # Positions are unique across shards and each shard lists its turns in order, so a stable sort restores the single-node order
+    errors = defaultdict(list)
+    for _, category, detail in sorted((error for accumulator in accumulators for error in accumulator['errors']), key=lambda error: error[0]):
+        errors[category].append(detail)
+
+    print_accuracy(**counts)
+    write_error_file(errors, error_file_path)
+    print_top_errors(errors, {category: len(err_list) for category, err_list in errors.items()})
 
 def main():
     parser = argparse.ArgumentParser(description="Evaluate model predictions against a gold standard.")
     parser.add_argument("--gold_path", type=str, default=config.TEST_SET_PATH, help="Path to the gold standard JSON file.")
     parser.add_argument("--predictions_path", type=str, required=True, help="Path to the predictions JSON file.")
     parser.add_argument("--error_file_path", type=str, default=config.ANALYSIS_DIR / "error_analysis.csv", help="Path to save the error analysis CSV file.")
+    parser.add_argument("--metrics", action="store_true", help="Time loading, tokenization, equivalence and grounding checks and export them to config.METRICS_DIR.")
+    parser.add_argument("--cache", action="store_true", help="Reuse per-sample scores from the score cache (config.ANALYSIS_DIR/score_cache.sqlite); only new or changed samples are rescored.")
+    parser.add_argument("--cache_path", type=str, help="Score cache file to use instead of the default; implies --cache.")
+    parser.add_argument("--slices_path", type=str, help="Save accuracy per slice (turn, dialogue length, type II, ops, program length) to this .csv or .parquet file.")
+    parser.add_argument("--turn_table_path", type=str, help="Save the per-turn results table to this .csv or .parquet file.")
+    parser.add_argument("--stream", action="store_true", help="Evaluate in constant memory: read predictions incrementally (.json, .jsonl, .gz, .zst) and look up gold in an on-disk index.")
+    parser.add_argument("--gold_index_path", type=str, help="On-disk gold index used with --stream (default: config.INDEXES_DIR/<gold file name>.sqlite).")
+    add_shard_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    check_shard_arguments(parser, args)
+    # The score cache is opt-in, so a plain run neither reads nor writes it
+    cache_path = args.cache_path or (config.ANALYSIS_DIR / "score_cache.sqlite" if args.cache else None)
+    if (args.shard or args.shard_queue) and (args.stream or args.slices_path or args.turn_table_path):
+        parser.error("--shard and --shard_queue cannot be combined with --stream, --slices_path or --turn_table_path")
+    with profiled("run_evaluation", args.profile, args.profile_top):
+        if args.metrics:
+            metrics_utils.enable()
+
+        if args.stream:
+            if args.slices_path or args.turn_table_path:
+                parser.error("--slices_path and --turn_table_path need the full per-turn table and are not available with --stream")
+            evaluate_predictions_streaming(
+                args.gold_path,
+                args.predictions_path,
+                args.error_file_path,
+                cache_path,
+                args.gold_index_path
+            )
+        else:
+            # Each shard is written next to the single-node output; merge_shards.py combines them
+            for shard in iter_shards(args):
+                evaluate_predictions(
+                    args.gold_path,
+                    args.predictions_path,
+                    str(shard_path(args.error_file_path, shard)),
+                    cache_path,
+                    args.slices_path,
+                    args.turn_table_path,
+                    shard
+                )
 
-    evaluate_predictions(args.gold_path, args.predictions_path, args.error_file_path)
+        metrics_path = metrics_utils.export("run_evaluation")
+        if metrics_path:
+            metrics_utils.print_summary()
+            print(f"Metrics saved to {metrics_path}")
 
 if __name__ == "__main__":
     main()
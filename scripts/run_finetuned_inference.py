@@ -2,8 +2,11 @@ import json
 import os
 import argparse
 import datetime
+import time
 import uuid
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from tqdm import tqdm
 
 # Add the project root to the Python path to allow for module imports
@@ -11,85 +14,488 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
-from src.program_utils import eval_program, program_tokenization, dict_to_2d_list_table
-from src import config
+from src.program_utils import eval_program, program_tokenization, dict_to_2d_list_table, repair_program
+from src.cascade_utils import CascadeRouter
+from src.grounding_utils import build_numeric_index
+from src.eval_utils import OnlineScorer
+from src import config, metrics_utils
+from src.profile_utils import add_profile_arguments, profiled
+from src.shard_utils import add_shard_arguments, check_shard_arguments, filter_shard, iter_shards, shard_path
+from src.schedule_utils import RenderCache, document_key, group_by_document, locality_order, locality_report, print_locality_report
 
-def run_inference_and_process(model_id, source_json_path, output_path, limit: int = None):
+def build_system_content(doc):
+    """Renders a sample's document as the system message the fine-tuned model was trained with."""
+    table_str = dict_to_2d_list_table(doc.get('table', {}))
+    return f"{doc.get('pre_text', '')}\n\nTABLE:\n{table_str}\n\n{doc.get('post_text', '')}"
+
+def load_source_data(source_json_path, limit=None, shard=None):
     """
-    Runs inference on a fine-tuned model, executes the predicted programs,
-    and saves the results in an evaluation-ready format.
-    Logs all traces to a single, unique run in LangSmith using a shared run_id.
+    Loads the source samples, optionally keeping only the first `limit` and then only those of
+    `shard` (i, N). Returns None if the file is missing.
     """
-    # --- 1. Setup ---
-    llm = ChatOpenAI(model=model_id, temperature=config.TEMPERATURE, max_tokens=config.MAX_TOKENS)
-
     try:
         with open(source_json_path, 'r', encoding='utf-8') as f:
             source_data = json.load(f)
-    except FileNotFoundError as e:
+    except FileNotFoundError:
         print(f"Error: Source file not found at {source_json_path}")
-        return
+        return None
 
     if limit:
         print(f"Limiting processing to the first {limit} samples.")
         source_data = source_data[:limit]
+    if shard:
+        source_data = filter_shard(source_data, shard)
+        print(f"Processing shard {shard[0]}/{shard[1]}: {len(source_data)} samples.")
+    return source_data
+
+def save_predictions(predictions, output_path):
+    """Writes predictions in the format consumed by run_evaluation.py."""
+    try:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(predictions, f, indent=4)
+        print(f"\nInference and processing complete. Final predictions saved to {output_path}")
+    except IOError as e:
+        print(f"Error writing predictions to file: {e}")
+
+def print_repair_summary(predictions):
+    """Prints how many turns were repaired, by repair type."""
+    counts = {}
+    for prediction in predictions:
+        for repairs in prediction.get('program_repairs', []):
+            for name in repairs:
+                counts[name] = counts.get(name, 0) + 1
+    num_repaired = sum(1 for p in predictions for repairs in p.get('program_repairs', []) if repairs)
+    print(f"Repaired {num_repaired} turns: " + (", ".join(f"{name}={count}" for name, count in counts.items()) or "none"))
+
+def predict_conversation(sample, model_id, llm=None, router=None, repair: bool = False, render_cache=None):
+    """
+    Runs one conversation turn by turn, each turn conditioned on the model's own previous programs,
+    and returns its prediction in the evaluation format. Turns go through `router` when given
+    (cascade mode), otherwise through `llm`. The system message comes from `render_cache` when given.
+    A turn whose call or execution fails is recorded as '[ERROR: ...]' and left out of the history of
+    later turns, as in `main batch`.
+    """
+    sample_id = sample.get("id")
+    doc = sample.get('doc', {})
+    dialogue = sample.get('dialogue', {})
+
+    with metrics_utils.span("prompt_render"):
+        system_content = render_cache.get(doc, document_key(sample_id)) if render_cache else build_system_content(doc)
+
+    questions = dialogue.get('conv_questions', [])
+    predicted_programs = []
+    executed_answers = []
+    program_repairs = []
+
+    current_messages = [SystemMessage(content=system_content)]
+    cascade_turns = []
+    # Built once per conversation; `doc` is shared with other threads and is not modified
+    numeric_index = (doc.get('numeric_index') or build_numeric_index(doc)) if router is not None else None
+
+    for i, question in enumerate(questions):
+        turn_messages = current_messages + [HumanMessage(content=question)]
+
+        try:
+            if router is not None:
+                result = router.answer(turn_messages, doc, cascade_turns, question, metadata={"sample_id": sample_id, "turn": i+1}, numeric_index=numeric_index)
+                program_str, exe_res, repairs = result["program"], result["answer"], result["repairs"]
+                cascade_turns.append({"question": question, "program": program_str, "answer": exe_res})
+            else:
+                with metrics_utils.span("llm_call", model=model_id):
+                    response = llm.invoke(
+                        turn_messages,
+                        config={
+                            "metadata": {"sample_id": sample_id, "turn": i+1},
+                        }
+                    )
+                metrics_utils.record_llm_usage(model_id, response.usage_metadata, sample_id=sample_id, turn=i+1)
+                program_str = response.content.strip()
+                repairs = []
+                if repair:
+                    with metrics_utils.span("repair"):
+                        program_str, repairs = repair_program(program_str)
+
+                with metrics_utils.span("execution"):
+                    tokenized_prog = program_tokenization(program_str)
+                    _, exe_res = eval_program(tokenized_prog)
+
+        except Exception as e:
+            metrics_utils.inc("llm_errors_total", model=model_id)
+            print(f"\nError during API call or execution for sample {sample_id}, turn {i+1}: {e}")
+            predicted_programs.append(f"[ERROR: {e}]")
+            executed_answers.append("n/a")
+            program_repairs.append([])
+            continue
+
+        current_messages = turn_messages + [AIMessage(content=program_str)]
+        predicted_programs.append(program_str)
+        executed_answers.append(exe_res)
+        program_repairs.append(repairs)
+
+    prediction = {
+        "id": sample_id,
+        "turn_program": predicted_programs,
+        "executed_answers": executed_answers
+    }
+    if repair:
+        prediction["program_repairs"] = program_repairs
+    return prediction
+
+def run_inference_and_process(model_id, source_json_path, output_path, limit: int = None, cascade: bool = False, cascade_report_path=None, repair: bool = False, online_scorer=None, shard=None, group_by_doc: bool = False, locality_report_path=None):
+    """
+    Runs inference on a fine-tuned model, executes the predicted programs,
+    and saves the results in an evaluation-ready format.
+    Logs all traces to a single, unique run in LangSmith using a shared run_id.
+    With `cascade`, turns whose program fails validation are escalated to the larger model.
+    With `repair`, malformed programs are repaired locally before execution.
+    With `online_scorer`, each finished conversation is scored against its gold turns, the running
+    accuracies are shown on the progress bar, and the run stops early (saving what it has) when
+    the scorer reports accuracy below its floor.
+    With `group_by_doc`, the conversations of each document run back to back and share one rendered
+    system message; predictions are still saved in source order.
+    """
+    # --- 1. Setup ---
+    llm, router = None, None
+    if cascade:
+        router = CascadeRouter(primary_model=model_id, repair=repair)
+    else:
+        llm = ChatOpenAI(model=model_id, temperature=config.TEMPERATURE, max_tokens=config.MAX_TOKENS)
+
+    source_data = load_source_data(source_json_path, limit, shard)
+    if source_data is None:
+        return
 
     # --- 2. Inference and Processing Loop ---
-    all_final_predictions = []
+    predictions_by_position = {}
+    order = locality_order(source_data) if group_by_doc else range(len(source_data))
+    render_cache = RenderCache(build_system_content) if group_by_doc else None
     print(f"Running inference and processing for {len(source_data)} samples with model: {model_id}")
 
-    for sample in tqdm(source_data, desc="Processing samples"):
-        sample_id = sample.get("id")
-        doc = sample.get('doc', {})
-        dialogue = sample.get('dialogue', {})
-        
-        table_str = dict_to_2d_list_table(doc.get('table', {}))
-        system_content = f"{doc.get('pre_text', '')}\n\nTABLE:\n{table_str}\n\n{doc.get('post_text', '')}"
-        
-        questions = dialogue.get('conv_questions', [])
-        predicted_programs = []
-        executed_answers = []
-        
-        current_messages = [SystemMessage(content=system_content)]
-
-        for i, question in enumerate(questions):
-            current_messages.append(HumanMessage(content=question))
-            
+    progress = tqdm(order, desc="Processing samples")
+    for position in progress:
+        sample = source_data[position]
+        prediction = predict_conversation(sample, model_id, llm, router, repair, render_cache)
+        predictions_by_position[position] = prediction
+
+        if online_scorer:
+            online_scorer.add(sample, prediction)
+            progress.set_postfix(online_scorer.postfix())
+            if online_scorer.should_abort():
+                progress.close()
+                print(f"\n{online_scorer.abort_message()}")
+                break
+
+    # --- 3. Save Final Results ---
+    all_final_predictions = [predictions_by_position[position] for position in sorted(predictions_by_position)]
+    if online_scorer:
+        print("Online accuracy: " + ", ".join(f"{name} {value}" for name, value in online_scorer.postfix().items()))
+    save_predictions(all_final_predictions, output_path)
+    if repair:
+        print_repair_summary(all_final_predictions)
+    if group_by_doc:
+        save_locality_report(source_data, render_cache, locality_report_path)
+
+    if cascade:
+        summary = router.summary()
+        print("\n--- Cascade Routing ---")
+        for key, value in summary.items():
+            print(f"  - {key}: {value}")
+        if cascade_report_path:
+            with open(cascade_report_path, 'w', encoding='utf-8') as f:
+                json.dump({"summary": summary, "turns": router.turn_stats}, f, indent=4)
+            print(f"Cascade report saved to {cascade_report_path}")
+
+def save_locality_report(source_data, render_cache, report_path=None):
+    """Prints the per-document-group cache hit rates of a grouped run, and saves them as JSON if asked."""
+    report = locality_report(source_data, render_cache)
+    print_locality_report(report)
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+        print(f"Locality report saved to {report_path}")
+
+def build_gold_history_messages(sample, render_cache=None):
+    """
+    Builds the message list of every turn of a sample, conditioned on the gold programs of the
+    previous turns (teacher forcing), so each turn can be requested independently.
+    """
+    doc = sample.get('doc', {})
+    system_content = render_cache.get(doc, document_key(sample.get('id'))) if render_cache else build_system_content(doc)
+    dialogue = sample.get('dialogue', {})
+    questions = dialogue.get('conv_questions', [])
+    gold_programs = dialogue.get('turn_program', [])
+
+    turn_messages = []
+    history = [SystemMessage(content=system_content)]
+    for i, question in enumerate(questions):
+        turn_messages.append(history + [HumanMessage(content=question)])
+        history = history + [HumanMessage(content=question), AIMessage(content=gold_programs[i] if i < len(gold_programs) else "")]
+    return turn_messages
+
+def invoke_grouped(llm, inputs, run_configs, groups, max_concurrency):
+    """
+    Runs the requests of each group in order on one worker thread, with up to `max_concurrency`
+    groups at a time, so a document's requests reach the provider one after another and can hit
+    its prefix cache. Returns the responses (or exceptions) in input order, like `llm.batch`.
+    """
+    responses = [None] * len(inputs)
+
+    def run_group(indexes):
+        for index in indexes:
             try:
-                response = llm.invoke(
-                    current_messages, 
-                    config={
-                        "metadata": {"sample_id": sample_id, "turn": i+1},
-                    }
-                )
-                program_str = response.content.strip()
-                predicted_programs.append(program_str)
-                
-                current_messages.append(AIMessage(content=program_str))
+                responses[index] = llm.invoke(inputs[index], config=run_configs[index])
+            except Exception as e:
+                responses[index] = e
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        list(executor.map(run_group, groups))
+    return responses
+
+def run_gold_history_inference(model_id, source_json_path, output_path, limit: int = None, max_concurrency: int = 16, repair: bool = False, shard=None, group_by_doc: bool = False, locality_report_path=None):
+    """
+    Runs every turn of every sample concurrently, each conditioned on the gold history, and saves
+    the results in the same format as the sequential mode. With `group_by_doc`, the turns of each
+    document's conversations run sequentially on one worker instead of all at once.
+    """
+    # --- 1. Setup: build all turns' messages up front ---
+    llm = ChatOpenAI(model=model_id, temperature=config.TEMPERATURE, max_tokens=config.MAX_TOKENS)
+    source_data = load_source_data(source_json_path, limit, shard)
+    if source_data is None:
+        return
+
+    render_cache = RenderCache(build_system_content) if group_by_doc else None
+    inputs, run_configs, turn_keys = [], [], []
+    for sample_index, sample in enumerate(source_data):
+        with metrics_utils.span("prompt_render"):
+            sample_messages = build_gold_history_messages(sample, render_cache)
+        for i, messages in enumerate(sample_messages):
+            inputs.append(messages)
+            run_configs.append({"metadata": {"sample_id": sample.get("id"), "turn": i + 1}, "max_concurrency": max_concurrency})
+            turn_keys.append(sample_index)
+
+    # --- 2. Issue all requests concurrently ---
+    print(f"Running {len(inputs)} independent turns for {len(source_data)} samples with model: {model_id}")
+    with metrics_utils.span("llm_batch", model=model_id):
+        if group_by_doc:
+            group_of_sample = {position: group for group, positions in enumerate(group_by_document(source_data).values()) for position in positions}
+            groups = [[] for _ in set(group_of_sample.values())]
+            for index, sample_index in enumerate(turn_keys):
+                groups[group_of_sample[sample_index]].append(index)
+            responses = invoke_grouped(llm, inputs, run_configs, groups, max_concurrency)
+        else:
+            responses = llm.batch(inputs, config=run_configs, return_exceptions=True)
+
+    # --- 3. Execute programs and regroup turns by sample ---
+    all_final_predictions = [{"id": sample.get("id"), "turn_program": [], "executed_answers": []} for sample in source_data]
+    if repair:
+        for prediction in all_final_predictions:
+            prediction['program_repairs'] = []
+    for sample_index, response in zip(turn_keys, responses):
+        prediction = all_final_predictions[sample_index]
+        if isinstance(response, Exception):
+            metrics_utils.inc("llm_errors_total", model=model_id)
+            print(f"\nError during API call for sample {prediction['id']}, turn {len(prediction['turn_program']) + 1}: {response}")
+            prediction['turn_program'].append(f"[ERROR: {response}]")
+            prediction['executed_answers'].append("n/a")
+            if repair:
+                prediction['program_repairs'].append([])
+            continue
+
+        metrics_utils.record_llm_usage(model_id, response.usage_metadata, sample_id=prediction['id'], turn=len(prediction['turn_program']) + 1)
+        program_str = response.content.strip()
+        if repair:
+            program_str, repairs = repair_program(program_str)
+            prediction['program_repairs'].append(repairs)
+        with metrics_utils.span("execution"):
+            tokenized_prog = program_tokenization(program_str)
+            _, exe_res = eval_program(tokenized_prog)
+        prediction['turn_program'].append(program_str)
+        prediction['executed_answers'].append(exe_res)
+
+    save_predictions(all_final_predictions, output_path)
+    if repair:
+        print_repair_summary(all_final_predictions)
+    if group_by_doc:
+        save_locality_report(source_data, render_cache, locality_report_path)
+
+# --- Batch API Mode ---
+# Conversations are sequential, so the batch workflow is turn-synchronous: one request file
+# per turn index holds the next question of every conversation that still has questions,
+# and its results are executed and appended to the history before the next file is built.
+
+def write_batch_requests(states, turn, model_id, request_path):
+    """Writes one chat-completions batch request per conversation that has a question at `turn`."""
+    num_requests = 0
+    with open(request_path, 'w', encoding='utf-8') as f:
+        for index, state in enumerate(states):
+            if turn >= len(state['questions']):
+                continue
+            messages = state['messages'] + [{"role": "user", "content": state['questions'][turn]}]
+            f.write(json.dumps({
+                "custom_id": f"{index}-{turn}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model_id,
+                    "messages": messages,
+                    "temperature": config.TEMPERATURE,
+                    "max_tokens": config.MAX_TOKENS,
+                },
+            }) + '\n')
+            num_requests += 1
+    return num_requests
+
+def read_batch_results(result_path):
+    """Reads a batch result file into {custom_id: program string}, or an '[ERROR: ...]' string for failed requests."""
+    results = {}
+    with open(result_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get('response') or {}
+            if result.get('error') or response.get('status_code') != 200:
+                error = result.get('error') or response.get('body', {}).get('error')
+                results[result['custom_id']] = f"[ERROR: {error}]"
+                metrics_utils.inc("llm_errors_total", model="batch")
+                continue
+            metrics_utils.record_llm_usage(response['body'].get('model', "batch"), response['body'].get('usage'), custom_id=result['custom_id'])
+            results[result['custom_id']] = response['body']['choices'][0]['message']['content'].strip()
+    return results
+
+def submit_openai_batch(request_path, result_path, poll_interval=30):
+    """Runs a request file through the OpenAI Batch API and downloads the results to `result_path`."""
+    from openai import OpenAI
+    client = OpenAI()
+
+    with open(request_path, 'rb') as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+    print(f"Submitted batch {batch.id} for {request_path}")
+
+    while batch.status not in {"completed", "failed", "expired", "cancelled"}:
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}'")
+
+    # Failed requests are reported in a separate error file with the same line format
+    with open(result_path, 'w', encoding='utf-8') as f:
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                f.write(client.files.content(file_id).text)
+
+def make_local_batch_backend(responder):
+    """
+    Returns a local stand-in for the Batch API that writes a result file in the Batch API's
+    format from a request file, using `responder(custom_id, body) -> content` for each request.
+    """
+    def run_local_batch(request_path, result_path):
+        with open(request_path, 'r', encoding='utf-8') as f_in, open(result_path, 'w', encoding='utf-8') as f_out:
+            for line in f_in:
+                request = json.loads(line)
+                content = responder(request['custom_id'], request['body'])
+                f_out.write(json.dumps({
+                    "id": f"batch_req_{uuid.uuid4().hex}",
+                    "custom_id": request['custom_id'],
+                    "response": {
+                        "status_code": 200,
+                        "request_id": uuid.uuid4().hex,
+                        "body": {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]},
+                    },
+                    "error": None,
+                }) + '\n')
+    return run_local_batch
+
+def make_gold_responder(source_data):
+    """Answers each request with the gold program of its turn, so a local batch run reproduces the gold set."""
+    def responder(custom_id, body):
+        index, turn = (int(part) for part in custom_id.split('-'))
+        return source_data[index].get('dialogue', {}).get('turn_program', [])[turn]
+    return responder
+
+def run_batch_inference(model_id, source_json_path, output_path, limit: int = None, batch_dir=None, backend="openai", poll_interval=30, repair: bool = False, shard=None):
+    """
+    Runs inference through turn-synchronous batch files and saves the results in the same
+    format as the synchronous mode. Turns whose result file already exists are not resubmitted,
+    so an interrupted run can be resumed with the same `batch_dir`.
+    """
+    # --- 1. Setup ---
+    source_data = load_source_data(source_json_path, limit, shard)
+    if source_data is None:
+        return
 
+    batch_dir = Path(batch_dir or config.OUTPUTS_DIR / "batches" / datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
+    os.makedirs(batch_dir, exist_ok=True)
+
+    if backend == "local":
+        submit_batch = make_local_batch_backend(make_gold_responder(source_data))
+    else:
+        def submit_batch(request_path, result_path):
+            return submit_openai_batch(request_path, result_path, poll_interval)
+
+    states = [{
+        "questions": sample.get('dialogue', {}).get('conv_questions', []),
+        "messages": [{"role": "system", "content": build_system_content(sample.get('doc', {}))}],
+        "turn_program": [],
+        "executed_answers": [],
+        "program_repairs": [],
+    } for sample in source_data]
+
+    # --- 2. One batch per turn index until every dialogue has finished ---
+    print(f"Running batch inference for {len(states)} samples with model: {model_id} (backend: {backend})")
+    turn = 0
+    while any(turn < len(state['questions']) for state in states):
+        request_path = batch_dir / f"turn_{turn + 1:02d}_requests.jsonl"
+        result_path = batch_dir / f"turn_{turn + 1:02d}_results.jsonl"
+
+        with metrics_utils.span("prompt_render"):
+            num_requests = write_batch_requests(states, turn, model_id, request_path)
+        if not result_path.exists():
+            with metrics_utils.span("batch_turn", backend=backend):
+                submit_batch(request_path, result_path)
+        results = read_batch_results(result_path)
+        print(f"Turn {turn + 1}: {num_requests} requests, {len(results)} results")
+
+        for index, state in enumerate(states):
+            if turn >= len(state['questions']):
+                continue
+            program_str = results.get(f"{index}-{turn}", "[ERROR: missing batch result]")
+            if program_str.startswith("[ERROR:"):
+                # Failed requests are recorded but kept out of the history, as in the other modes
+                state['turn_program'].append(program_str)
+                state['executed_answers'].append("n/a")
+                state['program_repairs'].append([])
+                continue
+            repairs = []
+            if repair:
+                program_str, repairs = repair_program(program_str)
+            with metrics_utils.span("execution"):
                 tokenized_prog = program_tokenization(program_str)
                 _, exe_res = eval_program(tokenized_prog)
-                executed_answers.append(exe_res)
 
-            except Exception as e:
-                print(f"\nError during API call or execution for sample {sample_id}, turn {i+1}: {e}")
-                predicted_programs.append(f"[ERROR: {e}]")
-                executed_answers.append("n/a")
-                current_messages.append(AIMessage(content=f"[ERROR: {e}]"))
-
-        all_final_predictions.append({
-            "id": sample_id,
-            "turn_program": predicted_programs,
-            "executed_answers": executed_answers
-        })
+            state['messages'].append({"role": "user", "content": state['questions'][turn]})
+            state['messages'].append({"role": "assistant", "content": program_str})
+            state['turn_program'].append(program_str)
+            state['executed_answers'].append(exe_res)
+            state['program_repairs'].append(repairs)
+        turn += 1
 
     # --- 3. Save Final Results ---
-    try:
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(all_final_predictions, f, indent=4)
-        print(f"\nInference and processing complete. Final predictions saved to {output_path}")
-    except IOError as e:
-        print(f"Error writing predictions to file: {e}")
+    all_final_predictions = []
+    for sample, state in zip(source_data, states):
+        prediction = {
+            "id": sample.get("id"),
+            "turn_program": state['turn_program'],
+            "executed_answers": state['executed_answers'],
+        }
+        if repair:
+            prediction["program_repairs"] = state['program_repairs']
+        all_final_predictions.append(prediction)
+    save_predictions(all_final_predictions, output_path)
+    if repair:
+        print_repair_summary(all_final_predictions)
 
 
 if __name__ == '__main__':
@@ -98,12 +504,89 @@ if __name__ == '__main__':
     parser.add_argument("--source_json_path", type=str, default=config.TEST_SET_PATH, help="Path to the source .json file.")
     parser.add_argument("--output_path", type=str, default=config.PREDICTIONS_DIR / "finetuned_on_test.json", help="Path to save the final, evaluation-ready predictions.")
     parser.add_argument("--limit", type=int, help="Limit the number of samples to process.")
+    parser.add_argument("--repair", action="store_true", help="Repair malformed programs (nesting, separators, surrounding text) before execution; applied repairs are saved as 'program_repairs'.")
+    parser.add_argument("--cascade", action="store_true", help="Escalate turns whose program fails validation to config.OPENAI_MODEL (sequential mode only).")
+    parser.add_argument("--cascade_report_path", type=str, help="Path to save per-turn cascade routing statistics as JSON.")
+    parser.add_argument("--history", type=str, default="model", choices=["model", "gold"], help="Condition each turn on the model's own previous programs, or on the gold programs (all turns run in parallel).")
+    parser.add_argument("--max_concurrency", type=int, default=16, help="Maximum concurrent requests with --history gold.")
+    parser.add_argument("--mode", type=str, default="sync", choices=["sync", "batch"], help="'sync' calls the model turn by turn; 'batch' uses turn-synchronous Batch API files.")
+    parser.add_argument("--batch_backend", type=str, default="openai", choices=["openai", "local"], help="Batch mode backend. 'local' answers every request with its gold program, without calling the API.")
+    parser.add_argument("--batch_dir", type=str, help="Directory for batch request/result files. Reuse it to resume an interrupted batch run.")
+    parser.add_argument("--poll_interval", type=int, default=30, help="Seconds between Batch API status checks.")
+    parser.add_argument("--metrics", action="store_true", help="Collect timing, token and cache metrics and export them to config.METRICS_DIR.")
+    parser.add_argument("--online_eval", action="store_true", help="Score each finished conversation against the source gold and show running accuracies with 95%% confidence intervals (sequential mode only).")
+    parser.add_argument("--abort_below", type=float, help="Stop the run once turn execution accuracy (in %%) is confidently below this floor. Implies --online_eval.")
+    parser.add_argument("--abort_min_samples", type=int, default=config.ONLINE_EVAL_MIN_SAMPLES, help="Conversations to score before --abort_below can stop the run.")
+    parser.add_argument("--group_by_document", action="store_true", help="Run the conversations of each document (ids differing only in the Single_/Double_ prefix and the trailing -N) back to back on one worker, for prompt cache hits (--mode sync only). Predictions keep the source order.")
+    parser.add_argument("--locality_report_path", type=str, help="Path to save the per-document-group cache hit rates of a --group_by_document run as JSON.")
+    add_shard_arguments(parser)
+    add_profile_arguments(parser)
 
     args = parser.parse_args()
+    check_shard_arguments(parser, args)
+    online_scorer = None
+    if args.online_eval or args.abort_below is not None:
+        if args.history == "gold" or args.mode == "batch":
+            parser.error("--online_eval and --abort_below are only available with --history model and --mode sync")
+        online_scorer = OnlineScorer(args.abort_below, args.abort_min_samples)
+    if args.history == "gold" and args.mode == "batch":
+        parser.error("--history gold and --mode batch cannot be combined; batch mode always conditions on the model's own programs")
+    if args.cascade and (args.history == "gold" or args.mode == "batch"):
+        parser.error("--cascade is only available with --history model and --mode sync")
+    if args.group_by_document and args.mode == "batch":
+        parser.error("--group_by_document is only available with --mode sync")
+    with profiled("run_finetuned_inference", args.profile, args.profile_top):
+        if args.metrics:
+            metrics_utils.enable()
     
-    run_inference_and_process(
-        args.model_id, 
-        args.source_json_path, 
-        args.output_path,
-        args.limit
-    )
+        # Each shard is written next to the single-node output; merge_shards.py combines them
+        for shard in iter_shards(args):
+            output_path = shard_path(args.output_path, shard)
+            if args.history == "gold":
+                run_gold_history_inference(
+                    args.model_id,
+                    args.source_json_path,
+                    output_path,
+                    args.limit,
+                    args.max_concurrency,
+                    args.repair,
+                    shard,
+                    args.group_by_document,
+                    shard_path(args.locality_report_path, shard) if args.locality_report_path else None
+                )
+            elif args.mode == "batch":
+                run_batch_inference(
+                    args.model_id,
+                    args.source_json_path,
+                    output_path,
+                    args.limit,
+                    shard_path(args.batch_dir, shard) if args.batch_dir else None,
+                    args.batch_backend,
+                    args.poll_interval,
+                    args.repair,
+                    shard
+                )
+            else:
+                run_inference_and_process(
+                    args.model_id, 
+                    args.source_json_path, 
+                    output_path,
+                    args.limit,
+                    args.cascade,
+                    shard_path(args.cascade_report_path, shard) if args.cascade_report_path else None,
+                    args.repair,
+                    online_scorer,
+                    shard,
+                    args.group_by_document,
+                    shard_path(args.locality_report_path, shard) if args.locality_report_path else None
+                )
+                if online_scorer and online_scorer.should_abort():
+                    break
+
+        metrics_path = metrics_utils.export("run_finetuned_inference")
+        if metrics_path:
+            metrics_utils.print_summary()
+            print(f"Metrics saved to {metrics_path}")
+
+    if online_scorer and online_scorer.should_abort():
+        sys.exit(1)
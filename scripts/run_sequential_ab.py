@@ -0,0 +1,164 @@
+import json
+import argparse
+import sys
+import os
+from tqdm import tqdm
+
+# Add the project root to the Python path to allow for module imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.eval_utils import ConfidenceSequence, score_sample, stratified_order
+from src import config
+from src.profile_utils import add_profile_arguments, profiled
+from compare_runs import load_gold
+
+def conversation_score(gold_item, pred_item, metric):
+    """
+    Scores one conversation in [0, 1]: the share of its gold turns with a correct execution
+    result ('turn'), or whether its last turn is correct ('sample'). None if it cannot be scored.
+    """
+    if pred_item is None or 'error' in pred_item:
+        return None
+    result = score_sample(gold_item, pred_item)
+    if result is None:
+        return None
+    if metric == "sample":
+        return float(result['last_turn_exe_correct'])
+    num_gold_turns = len(gold_item['dialogue']['turn_program'])
+    return sum(turn['exe_correct'] for turn in result['turns']) / num_gold_turns
+
+def make_file_predictor(predictions_path):
+    """Replays an existing prediction file: returns each conversation's stored prediction."""
+    with open(predictions_path, 'r', encoding='utf-8') as f:
+        predictions = {item['id']: item for item in json.load(f)}
+    return lambda sample: predictions.get(sample['id'])
+
+def make_model_predictor(model_id, repair):
+    """Runs a fine-tuned model on each conversation as it is drawn, like run_finetuned_inference.py."""
+    from langchain_openai import ChatOpenAI
+    from run_finetuned_inference import predict_conversation
+
+    llm = ChatOpenAI(model=model_id, temperature=config.TEMPERATURE, max_tokens=config.MAX_TOKENS)
+    return lambda sample: predict_conversation(sample, model_id, llm, None, repair)
+
+def run_sequential_ab(gold_items, runs, metric="turn", rule="sequential", target_width=0.05, alpha=0.05, min_samples=30, max_samples=None, seed=42):
+    """
+    Draws conversations in a seeded stratified order, runs both predictors on each and stops as soon
+    as the confidence sequence of the paired accuracy difference (A - B) excludes zero ('sequential')
+    or is narrower than `target_width` ('ci_width'). The sequence is anytime-valid, so stopping at
+    the first decisive look keeps the 1 - alpha coverage. Returns the report and the predictions made.
+    """
+    (name_a, predict_a), (name_b, predict_b) = runs
+    order = stratified_order(gold_items, seed)[:max_samples]
+    difference = ConfidenceSequence(-1, 1, alpha)
+    accuracy = {name_a: ConfidenceSequence(0, 1, alpha), name_b: ConfidenceSequence(0, 1, alpha)}
+    predictions = {name_a: [], name_b: []}
+    trace, stop_reason, drawn = [], None, 0
+
+    progress = tqdm(order, desc="Sequential A/B")
+    for sample in progress:
+        drawn += 1
+        pred_a, pred_b = predict_a(sample), predict_b(sample)
+        predictions[name_a].append(pred_a)
+        predictions[name_b].append(pred_b)
+        score_a, score_b = conversation_score(sample, pred_a, metric), conversation_score(sample, pred_b, metric)
+        if score_a is None or score_b is None:
+            continue
+
+        accuracy[name_a].update(score_a)
+        accuracy[name_b].update(score_b)
+        difference.update(score_a - score_b)
+        low, high = difference.interval()
+        trace.append({"samples": difference.count, "difference": difference.mean, "low": low, "high": high})
+        progress.set_postfix({"diff": f"{difference.mean * 100:+.1f}", "cs": f"[{low * 100:+.1f}, {high * 100:+.1f}]"})
+
+        if difference.count < min_samples:
+            continue
+        if rule == "sequential" and (low > 0 or high < 0):
+            stop_reason = f"{name_a if low > 0 else name_b} is better"
+            break
+        if rule == "ci_width" and high - low <= target_width:
+            stop_reason = f"interval width {high - low:.3f} <= {target_width}"
+            break
+    progress.close()
+
+    report = {
+        "metric": metric,
+        "rule": rule,
+        "alpha": alpha,
+        "seed": seed,
+        "stop_reason": stop_reason or "all conversations used without meeting the stopping rule",
+        "conversations_available": len(order),
+        "conversations_drawn": drawn,
+        "conversations_scored": difference.count,
+        "difference": {"mean": difference.mean, "interval": list(difference.interval())},
+        "runs": {name: {"accuracy": cs.mean, "interval": list(cs.interval())} for name, cs in accuracy.items()},
+        "trace": trace,
+    }
+    return report, predictions
+
+def print_report(report):
+    available, drawn = report["conversations_available"], report["conversations_drawn"]
+    print("\n--- Sequential A/B Evaluation ---")
+    print(f"Stopped: {report['stop_reason']}")
+    print(f"Conversations needed: {drawn} of {available} ({(1 - drawn / available) * 100 if available else 0:.1f}% not run)")
+    for name, run in report["runs"].items():
+        low, high = run["interval"]
+        print(f"  - {name}: {run['accuracy'] * 100:.2f}% [{low * 100:.2f}, {high * 100:.2f}]")
+    low, high = report["difference"]["interval"]
+    print(f"  - Difference: {report['difference']['mean'] * 100:+.2f} points [{low * 100:+.2f}, {high * 100:+.2f}]")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two runs on a stratified sample that grows until the accuracy difference is statistically clear.")
+    parser.add_argument("--gold_path", type=str, default=config.TEST_SET_PATH, help="Path to the gold standard JSON file (also the inference source for --model_ids).")
+    parser.add_argument("--predictions_paths", type=str, nargs="+", default=[], help="Existing prediction files to replay.")
+    parser.add_argument("--model_ids", type=str, nargs="+", default=[], help="Fine-tuned models to run on each drawn conversation.")
+    parser.add_argument("--names", type=str, nargs=2, help="Names of the two runs (default: file names and model ids).")
+    parser.add_argument("--metric", type=str, default="turn", choices=["turn", "sample"], help="'turn': share of correct turns per conversation; 'sample': last turn correct.")
+    parser.add_argument("--rule", type=str, default="sequential", choices=["sequential", "ci_width"], help="Stop when the difference excludes zero, or when its interval is narrower than --target_width.")
+    parser.add_argument("--target_width", type=float, default=0.05, help="Interval width (as a fraction) for --rule ci_width.")
+    parser.add_argument("--alpha", type=float, default=0.05, help="Error probability of the confidence sequence.")
+    parser.add_argument("--min_samples", type=int, default=config.ONLINE_EVAL_MIN_SAMPLES, help="Conversations to score before the stopping rule is checked.")
+    parser.add_argument("--max_samples", type=int, help="Upper bound on the conversations drawn.")
+    parser.add_argument("--repair", action="store_true", help="Repair malformed programs of --model_ids runs before execution.")
+    parser.add_argument("--seed", type=int, default=config.RANDOM_SEED, help="Seed of the stratified order.")
+    parser.add_argument("--report_path", type=str, default=config.ANALYSIS_DIR / "sequential_ab.json", help="Path to save the report, with the interval after every scored conversation.")
+    parser.add_argument("--output_dir", type=str, default=config.PREDICTIONS_DIR, help="Where predictions made for --model_ids runs are saved.")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    if len(args.predictions_paths) + len(args.model_ids) != 2:
+        parser.error("give exactly two runs with --predictions_paths and/or --model_ids")
+
+    with profiled("run_sequential_ab", args.profile, args.profile_top):
+        # --- 1. Set up both runs (prediction files first, then models) ---
+        sources = [("file", path) for path in args.predictions_paths] + [("model", model_id) for model_id in args.model_ids]
+        names = args.names or [os.path.splitext(os.path.basename(source))[0] if kind == "file" else source for kind, source in sources]
+        if names[0] == names[1]:
+            parser.error("the two runs need different names (use --names)")
+        runs = [
+            (name, make_file_predictor(source) if kind == "file" else make_model_predictor(source, args.repair))
+            for name, (kind, source) in zip(names, sources)
+        ]
+
+        # --- 2. Draw conversations until the stopping rule is met ---
+        report, predictions = run_sequential_ab(
+            load_gold(args.gold_path), runs, args.metric, args.rule, args.target_width,
+            args.alpha, args.min_samples, args.max_samples, args.seed
+        )
+        print_report(report)
+
+        # --- 3. Save the report and any new predictions ---
+        os.makedirs(os.path.dirname(os.path.abspath(args.report_path)), exist_ok=True)
+        with open(args.report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+        print(f"\nReport saved to {args.report_path}")
+        for name, (kind, _) in zip(names, sources):
+            if kind == "model":
+                output_path = os.path.join(args.output_dir, f"{name}_sequential.json")
+                with open(output_path, 'w', encoding='utf-8') as f:
+                    json.dump([p for p in predictions[name] if p is not None], f, indent=4)
+                print(f"Predictions of {name} saved to {output_path}")
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ import argparse
 import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from src import config
+from src.profile_utils import add_profile_arguments, profiled
 
 def analyze_and_plot_distributions(
     train_path,
@@ -120,5 +121,7 @@ if __name__ == '__main__':
     parser.add_argument("--train_path", type=str, default=config.TRAIN_SET_PATH, help="Path to the final training set JSON file.")
     parser.add_argument("--test_path", type=str, default=config.TEST_SET_PATH, help="Path to the final test set JSON file.")
     parser.add_argument("--output_dir", type=str, default=config.FIGURES_DIR, help="Directory to save the output plots.")
+    add_profile_arguments(parser)
     args = parser.parse_args()
-    analyze_and_plot_distributions(args.train_path, args.test_path, args.output_dir)
+    with profiled("validate_train_test_sets", args.profile, args.profile_top):
+        analyze_and_plot_distributions(args.train_path, args.test_path, args.output_dir)
@@ -10,6 +10,7 @@ import sys
 import argparse
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from src import config
+from src.profile_utils import add_profile_arguments, profiled
 
 # --- Function to Load Data ---
 def load_data(file_path):
@@ -87,8 +88,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Analyze and visualize the distribution of program operations.")
     parser.add_argument("--dataset_path", type=str, default=config.RAW_DATASET_PATH, help="Path to the raw ConvFinQA dataset.")
     parser.add_argument("--output_filename", type=str, default=config.FIGURES_DIR / "operations_distribution.png", help="Path to save the output plot.")
+    add_profile_arguments(parser)
     args = parser.parse_args()
 
-    dataset = load_data(args.dataset_path)
-    if dataset:
-        analyze_and_visualize(dataset, args.output_filename)
+    with profiled("visualize_operations_dist", args.profile, args.profile_top):
+        dataset = load_data(args.dataset_path)
+        if dataset:
+            analyze_and_visualize(dataset, args.output_filename)
@@ -0,0 +1,167 @@
+"""
+Execution-verified model cascade.
+
+Each turn goes to the cheap fine-tuned model first. Its program is validated locally
+(tokenization, operation whitelist, `#n` references, execution and grounding of the
+arguments in the document) and the turn is escalated to the larger model only when
+validation fails.
+"""
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from . import config, metrics_utils
+from .grounding_utils import NumericIndex, build_numeric_index, find_ungrounded_args
+from .program_utils import all_ops, dict_to_2d_list_table, eval_program, program_tokenization, repair_program, str_to_num
+from .prompt_utils import construct_program_generation_messages, format_history_turn, list_2d_to_markdown_table
+
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+    from langchain_core.runnables import RunnableConfig
+
+def validate_program(program_str: str, numeric_index: Optional[NumericIndex] = None) -> List[str]:
+    """
+    Validates a predicted program and returns the list of failed checks (empty if it passes).
+    Grounding is checked only when the document's `numeric_index` is given.
+    """
+    tokens = program_tokenization(program_str)
+    steps = tokens[:-1]
+    if not steps:
+        return ["tokenization"]
+
+    failures = []
+    if len(steps) == 1:
+        if str_to_num(steps[0]) == "n/a":
+            failures.append("tokenization")
+    elif len(steps) % 4 != 0:
+        failures.append("tokenization")
+    else:
+        for ind, token in enumerate(steps):
+            position, step_index = ind % 4, ind // 4
+            if position == 0 and token.strip("(") not in all_ops:
+                failures.append("op_whitelist")
+            elif position == 3 and token != ")":
+                failures.append("tokenization")
+            elif position in (1, 2):
+                arg = token.strip()
+                if arg.startswith("#") and (not arg[1:].isdigit() or int(arg[1:]) >= step_index):
+                    failures.append("step_reference")
+
+    status, _ = eval_program(tokens)
+    if status != 0:
+        failures.append("execution")
+
+    if numeric_index is not None and find_ungrounded_args(program_str, numeric_index):
+        failures.append("grounding")
+
+    # Keep each failed check once, in the order it was found
+    return list(dict.fromkeys(failures))
+
+
+class CascadeRouter:
+    """
+    Routes turns to `primary_model` and escalates to `fallback_model` when the primary's
+    program fails validation. Per-turn statistics are kept in `turn_stats`. With `repair`,
+    programs are repaired locally before validation, which avoids escalating formatting slips.
+    """
+
+    def __init__(self, primary_model: str = config.FINETUNED_OPENAI_MODEL, fallback_model: str = config.OPENAI_MODEL, repair: bool = False):
+        from langchain_openai import ChatOpenAI
+
+        self.repair = repair
+        self.primary_model = primary_model
+        self.fallback_model = fallback_model
+        self.primary = ChatOpenAI(model=primary_model, temperature=config.TEMPERATURE, max_tokens=config.MAX_TOKENS)
+        self.fallback = ChatOpenAI(model=fallback_model, temperature=config.TEMPERATURE, max_tokens=config.MAX_TOKENS)
+        self.turn_stats: List[Dict[str, Any]] = []
+
+    @staticmethod
+    def _call_cost(model: str, usage: Optional[Dict[str, Any]]) -> float:
+        input_price, output_price = config.MODEL_PRICES_PER_1M_TOKENS.get(model, (0.0, 0.0))
+        usage = usage or {}
+        cached_tokens = (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+        input_cost = (usage.get("input_tokens", 0) - cached_tokens + cached_tokens * config.CACHED_INPUT_PRICE_FACTOR) * input_price
+        return float(input_cost + usage.get("output_tokens", 0) * output_price) / 1_000_000
+
+    def _fallback_messages(self, doc: Dict[str, Any], turns: Sequence[Mapping[str, Any]], question: str) -> List[Tuple[str, str]]:
+        table_str = list_2d_to_markdown_table(dict_to_2d_list_table(doc.get("table", {})))
+        history = "".join(
+            format_history_turn(i + 1, turn["question"], turn["answer"], turn["program"]) for i, turn in enumerate(turns)
+        )
+        return construct_program_generation_messages(doc.get("pre_text", ""), table_str, doc.get("post_text", ""), history, question)
+
+    def answer(self, messages: List["BaseMessage"], doc: Dict[str, Any], turns: Sequence[Mapping[str, Any]], question: str, metadata: Optional[Dict[str, Any]] = None, numeric_index: Optional[NumericIndex] = None) -> Dict[str, Any]:
+        """
+        Answers one turn. `messages` is the fine-tuned model's input (ending with `question`);
+        `turns` holds the previous turns' question, program and answer for the fallback prompt.
+        `doc` is only read (it may be a shared, cached document); pass the document's
+        `numeric_index` to reuse it across turns when `doc` does not store one.
+        Returns the chosen program, its executed answer and the turn's routing statistics.
+        """
+        if numeric_index is None:
+            # Loaders store the index with the document; build it otherwise
+            metrics_utils.record_cache("numeric_index", bool(doc.get("numeric_index")))
+            numeric_index = doc.get("numeric_index") or build_numeric_index(doc)
+        metadata = metadata or {}
+        run_config: "RunnableConfig" = {"metadata": metadata}
+        start = time.perf_counter()
+
+        with metrics_utils.span("llm_call", model=self.primary_model):
+            response = self.primary.invoke(messages, config=run_config)
+        usage = getattr(response, "usage_metadata", None)
+        metrics_utils.record_llm_usage(self.primary_model, usage, route="primary", **metadata)
+        program_str = response.text().strip()
+        repairs: List[str] = []
+        if self.repair:
+            program_str, repairs = repair_program(program_str)
+        failures = validate_program(program_str, numeric_index)
+        cost = self._call_cost(self.primary_model, usage)
+        chosen, model = program_str, self.primary_model
+
+        escalated = bool(failures)
+        metrics_utils.inc("cascade_turns_total", escalated=escalated)
+        fallback_failures: List[str] = []
+        if escalated:
+            fallback_messages = self._fallback_messages(doc, turns, question)
+            with metrics_utils.span("llm_call", model=self.fallback_model):
+                fallback_response = self.fallback.invoke(fallback_messages, config=run_config)
+            fallback_usage = getattr(fallback_response, "usage_metadata", None)
+            metrics_utils.record_llm_usage(self.fallback_model, fallback_usage, route="fallback", **metadata)
+            fallback_program = fallback_response.text().strip()
+            fallback_repairs: List[str] = []
+            if self.repair:
+                fallback_program, fallback_repairs = repair_program(fallback_program)
+            fallback_failures = validate_program(fallback_program, numeric_index)
+            cost += self._call_cost(self.fallback_model, fallback_usage)
+
+            # Prefer the fallback unless it is the only one of the two that does not execute
+            if not ("execution" in fallback_failures and "execution" not in failures):
+                chosen, model, repairs = fallback_program, self.fallback_model, fallback_repairs
+
+        _, final_answer = eval_program(program_tokenization(chosen))
+        stats = {
+            "model": model,
+            "escalated": escalated,
+            "repairs": repairs,
+            "primary_failures": failures,
+            "fallback_failures": fallback_failures,
+            "latency_s": time.perf_counter() - start,
+            "cost_usd": cost,
+        }
+        self.turn_stats.append(stats)
+        return {"program": chosen, "answer": final_answer, **stats}
+
+    def summary(self) -> Dict[str, Any]:
+        """Aggregates escalation rate, latency and cost over all routed turns."""
+        num_turns = len(self.turn_stats)
+        if num_turns == 0:
+            return {"turns": 0}
+        num_escalated = sum(s["escalated"] for s in self.turn_stats)
+        total_cost = sum(s["cost_usd"] for s in self.turn_stats)
+        return {
+            "turns": num_turns,
+            "escalated_turns": num_escalated,
+            "escalation_rate": num_escalated / num_turns,
+            "avg_latency_s": sum(s["latency_s"] for s in self.turn_stats) / num_turns,
+            "avg_cost_usd": total_cost / num_turns,
+            "total_cost_usd": total_cost,
+        }
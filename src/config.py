@@ -14,6 +14,7 @@ ROOT_DIR = Path(__file__).parent.parent
 DATA_DIR = ROOT_DIR / "data"
 RAW_DATA_DIR = DATA_DIR / "raw"
 PROCESSED_DATA_DIR = DATA_DIR / "processed"
+SYNTHETIC_DATA_DIR = DATA_DIR / "synthetic"
 
 # Specific File Paths
 RAW_DATASET_PATH = RAW_DATA_DIR / "convfinqa_dataset.json"
@@ -26,6 +27,9 @@ TEST_SET_JSONL_PATH = PROCESSED_DATA_DIR / "final_test_set.jsonl"
 OUTPUTS_DIR = ROOT_DIR / "outputs"
 PREDICTIONS_DIR = OUTPUTS_DIR / "predictions"
 ANALYSIS_DIR = OUTPUTS_DIR / "analysis"
+METRICS_DIR = OUTPUTS_DIR / "metrics"
+PROFILES_DIR = OUTPUTS_DIR / "profiles"
+INDEXES_DIR = OUTPUTS_DIR / "indexes"
 FIGURES_DIR = ROOT_DIR / "figures"
 
 # --- Model Settings ---
@@ -33,10 +37,25 @@ OPENAI_MODEL = "gpt-4.1-2025-04-14"
 FINETUNED_OPENAI_MODEL = 'ft:gpt-4.1-mini-2025-04-14:tsgs::BnoieExO'
 GEMINI_MODEL = "models/gemini-2.5-pro-preview-05-06"
 
+# USD per 1M (input, output) tokens, used for cost reporting
+MODEL_PRICES_PER_1M_TOKENS = {
+    OPENAI_MODEL: (2.00, 8.00),
+    FINETUNED_OPENAI_MODEL: (0.80, 3.20),
+}
+# Share of the input price charged for prompt tokens served from the provider's prefix cache
+CACHED_INPUT_PRICE_FACTOR = 0.25
+
 # LLM Call Parameters
 TEMPERATURE = 0.0
 MAX_TOKENS = 200
 
+# --- Chat History Settings ---
+HISTORY_KEEP_TURNS = 4        # Most recent turns sent verbatim; older turns are summarized
+HISTORY_TOKEN_BUDGET = 8000   # Upper bound on prompt tokens sent per chat turn
+
+# --- Online Evaluation Settings ---
+ONLINE_EVAL_MIN_SAMPLES = 30  # Conversations scored before an inference run may abort below its accuracy floor
+
 # --- Train Test Split Parameters ---
 TRAIN_SIZE = 1000
 TEST_SIZE = 200
@@ -45,3 +64,5 @@ RANDOM_SEED = 42
 # --- Database Settings ---
 MONGODB_DATABASE = "convfinqa"
 MONGODB_COLLECTION = "parent_docs"
+MONGODB_DOCUMENTS_COLLECTION = "documents"  # Shared documents, keyed by content hash and referenced by conversations
+DOCUMENT_CACHE_SIZE = 4096  # Documents kept in process by get_record_by_id
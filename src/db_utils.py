@@ -1,53 +1,127 @@
 """
 Utilities for interacting with the MongoDB database.
+
+Conversations over the same filing page share their document. The loader stores each document
+once in the documents collection under a hash of its content, and conversation records reference
+it by `doc_id`. `get_record_by_id` joins the two and returns the record with its `doc` embedded,
+keeping fetched documents in process so the conversations of a page cost one document fetch.
 """
+import hashlib
+import json
 import os
-from pymongo import MongoClient
-from typing import List, Dict, Optional
-from . import config
+import queue
+import threading
+from collections import OrderedDict
+from typing import Any, List, Dict, Optional, Tuple
+from . import config, metrics_utils
 
 # --- Load Environment Variables ---
 MONGO_URI = os.getenv("MONGODB_URI")
 
 # --- Global Client ---
-# Use a global client to avoid reconnecting on every function call
-try:
-    if not MONGO_URI:
-        raise ConnectionError("MONGODB_URI not found in .env file.")
-    
-    client = MongoClient(MONGO_URI)
-    # Test the connection
-    client.admin.command('ping')
-    print("MongoDB connection successful.")
-    
-    # Set the default database
-    db = client.convfinqa
+# A single lazily-created client is shared by every caller (it pools connections internally).
+# Connecting on first use rather than on import keeps CLI commands that never touch the
+# database from paying for pymongo and the connection handshake.
+_client: Any = None
+_db: Any = None
+_connect_attempted = False
+_connect_lock = threading.Lock()
 
-except Exception as e:
-    print(f"Fatal: Could not connect to MongoDB upon application start. {e}")
-    client = None
-    db = None
+# A chunk handed to the bulk writers: (collection name, documents)
+Chunk = Tuple[str, List[Dict[str, Any]]]
 
-def get_record_by_id(record_id: str, collection_name: str = "parent_docs") -> Optional[Dict]:
+# Documents fetched so far, by content hash (least recently used first)
+_document_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_document_cache_lock = threading.Lock()
+
+def get_db() -> Any:
     """
-    Retrieves a single record from the specified collection by its ID.
+    Returns the default database, connecting on first call. Returns None if no connection is available.
     """
+    global _client, _db, _connect_attempted
+    if _connect_attempted:
+        return _db
+
+    with _connect_lock:
+        if _connect_attempted:
+            return _db
+        try:
+            if not MONGO_URI:
+                raise ConnectionError("MONGODB_URI not found in .env file.")
+
+            from pymongo import MongoClient
+            _client = MongoClient(MONGO_URI)
+            # Test the connection
+            _client.admin.command('ping')
+            print("MongoDB connection successful.")
+
+            # Set the default database
+            _db = _client[config.MONGODB_DATABASE]
+
+        except Exception as e:
+            print(f"Fatal: Could not connect to MongoDB. {e}")
+            _client = None
+            _db = None
+        _connect_attempted = True
+    return _db
+
+def document_hash(doc: Dict[str, Any]) -> str:
+    """Content hash of a document's text and table, the key of its entry in the documents collection."""
+    content = json.dumps([doc.get("pre_text"), doc.get("post_text"), doc.get("table")], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+def _get_document(db: Any, doc_id: str, documents_collection: str) -> Optional[Dict[str, Any]]:
+    with _document_cache_lock:
+        doc: Optional[Dict[str, Any]] = _document_cache.get(doc_id)
+        if doc is not None:
+            _document_cache.move_to_end(doc_id)
+    metrics_utils.record_cache("document", doc is not None)
+    if doc is not None:
+        return doc
+
+    with metrics_utils.span("db_fetch", collection=documents_collection):
+        doc = db[documents_collection].find_one({"_id": doc_id}, {"_id": 0})
+    if doc is not None:
+        with _document_cache_lock:
+            _document_cache[doc_id] = doc
+            if len(_document_cache) > config.DOCUMENT_CACHE_SIZE:
+                _document_cache.popitem(last=False)
+    return doc
+
+def get_record_by_id(record_id: str, collection_name: str = config.MONGODB_COLLECTION, documents_collection: str = config.MONGODB_DOCUMENTS_COLLECTION) -> Optional[Dict[str, Any]]:
+    """
+    Retrieves a single record from the specified collection by its ID, with its document under
+    `doc`. Records that reference a shared document by `doc_id` get it from the documents
+    collection (cached in process; callers must not modify it). Records stored with an embedded
+    `doc` are returned as they are.
+    """
+    db = get_db()
     if db is None:
         print("Error: No database connection available.")
         return None
         
     try:
         collection = db[collection_name]
-        record = collection.find_one({"id": record_id})
+        with metrics_utils.span("db_fetch", collection=collection_name):
+            record: Optional[Dict[str, Any]] = collection.find_one({"id": record_id})
+        if record and "doc_id" in record:
+            doc = _get_document(db, record.pop("doc_id"), documents_collection)
+            if doc is None:
+                print(f"Error: Document of record '{record_id}' not found in '{documents_collection}'.")
+                record = None
+            else:
+                record["doc"] = doc
+        metrics_utils.inc("db_records_fetched_total", result="found" if record else "missing")
         return record
     except Exception as e:
         print(f"Error retrieving record from MongoDB: {e}")
         return None
 
-def bulk_insert_data(documents: List[Dict], collection_name: str, clear_collection: bool = True) -> bool:
+def bulk_insert_data(documents: List[Dict[str, Any]], collection_name: str, clear_collection: bool = True) -> bool:
     """
     Inserts a list of documents into a specified collection, with an option to clear it first.
     """
+    db = get_db()
     if db is None:
         print("Error: No database connection available.")
         return False
@@ -62,9 +136,73 @@ def bulk_insert_data(documents: List[Dict], collection_name: str, clear_collecti
             print("No documents to insert.")
             return True
 
-        collection.insert_many(documents)
+        with metrics_utils.span("db_bulk_insert", collection=collection_name):
+            collection.insert_many(documents)
+        metrics_utils.inc("db_documents_inserted_total", len(documents), collection=collection_name)
         print(f"Successfully inserted {len(documents)} documents into '{collection_name}'.")
         return True
     except Exception as e:
         print(f"Error during MongoDB insertion: {e}")
         return False
+
+def clear_collection(collection_name: str) -> None:
+    """Deletes every document of a collection. Raises if no connection is available."""
+    db = get_db()
+    if db is None:
+        raise ConnectionError("No database connection available.")
+    db[collection_name].delete_many({})
+    print(f"Cleared existing documents in '{collection_name}'.")
+
+class BulkWriter:
+    """
+    Inserts chunks of documents from `num_writers` threads sharing the client. Chunks are handed
+    over through a queue of at most `queue_size` chunks, so `put` blocks (backpressure) when the
+    writers fall behind. The first failed insert is re-raised by the next `put` or by `close`.
+    """
+
+    def __init__(self, num_writers: int = 4, queue_size: int = 8) -> None:
+        self.db = get_db()
+        if self.db is None:
+            raise ConnectionError("No database connection available.")
+        self.queue: "queue.Queue[Optional[Chunk]]" = queue.Queue(maxsize=queue_size)
+        self.error: Optional[BaseException] = None
+        # Collection name -> documents inserted
+        self.inserted: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name=f"bulk-writer-{i}", daemon=True) for i in range(num_writers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            collection_name, documents = item
+            if self.error is not None:
+                continue  # Keep draining so producers blocked in put() can see the error
+            try:
+                with metrics_utils.span("db_bulk_insert", collection=collection_name):
+                    self.db[collection_name].insert_many(documents, ordered=False)
+                metrics_utils.inc("db_documents_inserted_total", len(documents), collection=collection_name)
+                with self._lock:
+                    self.inserted[collection_name] = self.inserted.get(collection_name, 0) + len(documents)
+            except Exception as e:
+                self.error = e
+
+    def put(self, collection_name: str, documents: List[Dict[str, Any]]) -> None:
+        """Queues a chunk of documents for insertion, blocking while the queue is full. Raises the first failed insert."""
+        if self.error is not None:
+            raise self.error
+        if documents:
+            self.queue.put((collection_name, documents))
+
+    def close(self) -> Dict[str, int]:
+        """Waits for every queued chunk to be written and returns the documents inserted per collection."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+        return dict(self.inserted)
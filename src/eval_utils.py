@@ -0,0 +1,481 @@
+"""
+Per-sample scoring shared by the evaluation scripts, and a persistent score cache.
+
+`score_sample` scores one conversation against its gold sample. Its result depends only on
+the two samples and the scorer, so results are stored under a hash of (gold, prediction,
+SCORER_VERSION) and reused while the inputs are unchanged. Bump SCORER_VERSION whenever the
+scoring logic changes so that stale results are not reused.
+"""
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import sqlite3
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple
+
+from . import metrics_utils
+from .grounding_utils import NumericIndex, build_numeric_index, find_ungrounded_args
+from .program_utils import equal_program, program_symbol_map, program_to_sympy, program_tokenization, str_to_num
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+SCORER_VERSION = "1"
+
+OP_PATTERN = re.compile(r"([a-z]+)\(")
+
+# Columns of the per-turn table that sliced metrics are grouped by
+SLICE_COLUMNS = ["turn", "num_dialogue_turns", "has_type2_question", "rare_ops", "gold_ops", "program_steps"]
+
+# A gold or predicted sample, and the (gold, prediction) pairs the evaluation scores
+Sample = Dict[str, Any]
+SamplePair = Tuple[Sample, Sample]
+
+
+def is_answer_correct(gold_answer: Any, pred_answer: Any) -> bool:
+    """Compares executed answers: yes/no case-insensitively, numbers rounded to 5 decimals."""
+    if isinstance(gold_answer, str) and gold_answer.lower() in ['yes', 'no']:
+        return str(pred_answer).lower() == gold_answer.lower()
+    gold_num = str_to_num(gold_answer)
+    gold_ans_norm = round(gold_num, 5) if isinstance(gold_num, float) else gold_num
+    pred_ans_norm = round(pred_answer, 5) if isinstance(pred_answer, float) else pred_answer
+    return pred_ans_norm == gold_ans_norm
+
+
+def normalize_program_string(prog_str: str) -> str:
+    """Normalizes a program string for the exact-match fallback (spaces, `.0` suffixes, `const_`)."""
+    s = prog_str.replace(" ", "")
+    s = re.sub(r'(\d+)\.0(?![\d])', r'\1', s)
+    s = s.replace("const_", "")
+    return s
+
+
+def is_program_correct(gold_prog_str: str, pred_prog_str: str) -> bool:
+    """Checks symbolic equivalence, falling back to a normalized string match."""
+    with metrics_utils.span("eval_tokenization"):
+        gold_prog_tokenized = program_tokenization(gold_prog_str)
+        pred_prog_tokenized = program_tokenization(pred_prog_str)
+    with metrics_utils.span("eval_equivalence"):
+        if equal_program(gold_prog_tokenized, pred_prog_tokenized):
+            return True
+    return normalize_program_string(gold_prog_str) == normalize_program_string(pred_prog_str)
+
+
+class PreparedGold:
+    """
+    Gold samples preprocessed once for scoring several prediction files: each gold turn's
+    symbol map and simplified sympy form, each document's numeric index, and a memo of
+    program equivalence results keyed by (sample, turn, predicted program) shared by all runs.
+    """
+
+    def __init__(self, gold_items: Iterable[Sample]):
+        self.items = {item['id']: item for item in gold_items}
+        self._gold_forms: Dict[Tuple[str, int], Tuple[str, Optional[Dict[str, str]], Any]] = {}
+        self._numeric_indexes: Dict[str, NumericIndex] = {}
+        self._equivalence: Dict[Tuple[str, int, str], bool] = {}
+        self.equivalence_computed, self.equivalence_reused = 0, 0
+
+    def numeric_index(self, sample_id: str) -> NumericIndex:
+        """Returns the numeric index of a gold sample's document, built on first use."""
+        if sample_id not in self._numeric_indexes:
+            gold_doc = self.items[sample_id].get('doc', {})
+            self._numeric_indexes[sample_id] = gold_doc.get('numeric_index') or build_numeric_index(gold_doc)
+        return self._numeric_indexes[sample_id]
+
+    def _gold_form(self, sample_id: str, turn_index: int) -> Tuple[str, Optional[Dict[str, str]], Any]:
+        """Returns (gold program string, symbol map, simplified form); the last two are None if the program does not parse."""
+        key = (sample_id, turn_index)
+        if key not in self._gold_forms:
+            gold_prog_str = self.items[sample_id]['dialogue']['turn_program'][turn_index]
+            gold_prog_tokenized = program_tokenization(gold_prog_str)
+            try:
+                sym_map = program_symbol_map(gold_prog_tokenized)
+                self._gold_forms[key] = (gold_prog_str, sym_map, program_to_sympy(gold_prog_tokenized, sym_map))
+            except Exception:
+                self._gold_forms[key] = (gold_prog_str, None, None)
+        return self._gold_forms[key]
+
+    def is_program_correct(self, sample_id: str, turn_index: int, pred_prog_str: str) -> bool:
+        """Same result as `is_program_correct(gold, pred)`, computed once per distinct predicted program."""
+        key = (sample_id, turn_index, pred_prog_str)
+        if key in self._equivalence:
+            self.equivalence_reused += 1
+            return self._equivalence[key]
+
+        gold_prog_str, sym_map, gold_form = self._gold_form(sample_id, turn_index)
+        correct = False
+        if gold_form is not None and sym_map is not None:
+            with metrics_utils.span("eval_equivalence"):
+                try:
+                    correct = program_to_sympy(program_tokenization(pred_prog_str), sym_map) == gold_form
+                except Exception:
+                    correct = False
+        if not correct:
+            correct = normalize_program_string(gold_prog_str) == normalize_program_string(pred_prog_str)
+        self._equivalence[key] = correct
+        self.equivalence_computed += 1
+        return correct
+
+
+def score_sample(gold_item: Sample, pred_item: Sample, prepared: Optional[PreparedGold] = None) -> Optional[Dict[str, Any]]:
+    """
+    Scores every predicted turn of a conversation. Returns None if the gold sample has no turns,
+    otherwise {"turns": [...], "last_turn_exe_correct", "last_turn_prog_correct"} where each turn
+    holds its correctness flags and the fields of the error analysis CSV. With `prepared`, gold-side
+    work and equivalence results are taken from (and added to) the shared preprocessing.
+    """
+    gold_dialogue = gold_item.get('dialogue', {})
+    gold_programs = gold_dialogue.get('turn_program', [])
+    pred_programs = pred_item.get('turn_program', [])
+    pred_exe_ans = pred_item.get('executed_answers', [])
+    num_turns = len(gold_programs)
+    if num_turns == 0:
+        return None
+
+    if prepared is not None:
+        numeric_index = prepared.numeric_index(gold_item['id'])
+    else:
+        gold_doc = gold_item.get('doc', {})
+        metrics_utils.record_cache("numeric_index", bool(gold_doc.get('numeric_index')))
+        with metrics_utils.span("eval_grounding_index"):
+            numeric_index = gold_doc.get('numeric_index') or build_numeric_index(gold_doc)
+
+    turns = []
+    last_turn_exe_correct, last_turn_prog_correct = False, False
+    for i, gold_prog_str in enumerate(gold_programs):
+        if i >= len(pred_programs) or i >= len(pred_exe_ans):
+            continue
+        gold_exe_ans = gold_dialogue['executed_answers'][i]
+        exe_correct = is_answer_correct(gold_exe_ans, pred_exe_ans[i])
+        if prepared is not None:
+            prog_correct = prepared.is_program_correct(gold_item['id'], i, pred_programs[i])
+        else:
+            prog_correct = is_program_correct(gold_prog_str, pred_programs[i])
+        with metrics_utils.span("eval_grounding_check"):
+            ungrounded_args = find_ungrounded_args(pred_programs[i], numeric_index)
+
+        turns.append({
+            "turn": i + 1,
+            "exe_correct": exe_correct,
+            "prog_correct": prog_correct,
+            "gold_program": gold_prog_str,
+            "predicted_program": pred_programs[i],
+            "gold_answer": gold_exe_ans,
+            "predicted_answer": pred_exe_ans[i],
+            "ungrounded_args": " ".join(ungrounded_args),
+        })
+        if i == num_turns - 1:
+            last_turn_exe_correct, last_turn_prog_correct = exe_correct, prog_correct
+
+    return {
+        "turns": turns,
+        "last_turn_exe_correct": last_turn_exe_correct,
+        "last_turn_prog_correct": last_turn_prog_correct,
+    }
+
+
+def sample_hash(gold_item: Sample, pred_item: Sample) -> str:
+    """Returns the cache key of a (gold, prediction) pair under the current scorer version."""
+    payload = json.dumps([SCORER_VERSION, gold_item, pred_item], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ScoreCache:
+    """Persists `score_sample` results in SQLite, keyed by `sample_hash`."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scores (hash TEXT PRIMARY KEY, result TEXT NOT NULL)")
+        self.hits, self.misses = 0, 0
+
+    def get_many(self, hashes: Iterable[str]) -> Dict[str, Any]:
+        """Returns {hash: result} for the hashes that are stored."""
+        hashes = list(hashes)
+        found: Dict[str, Any] = {}
+        # Stay under SQLite's bound-parameter limit
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT hash, result FROM scores WHERE hash IN ({','.join('?' * len(chunk))})", chunk
+            )
+            found.update((h, json.loads(result)) for h, result in rows)
+        return found
+
+    def put_many(self, results: Dict[str, Any]) -> None:
+        """Stores {hash: result}, replacing existing entries."""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO scores (hash, result) VALUES (?, ?)",
+            ((h, json.dumps(result)) for h, result in results.items())
+        )
+        self.conn.commit()
+
+    def close(self) -> None:
+        """Closes the database connection."""
+        self.conn.close()
+
+
+def score_samples(pairs: List[SamplePair], cache: Optional[ScoreCache] = None) -> List[Optional[Dict[str, Any]]]:
+    """
+    Scores a list of (gold_item, pred_item) pairs, in order. With a cache, stored results are
+    reused and only new or changed pairs are scored (and then stored).
+    """
+    if cache is None:
+        return [score_sample(gold, pred) for gold, pred in pairs]
+
+    with metrics_utils.span("eval_hash"):
+        hashes = [sample_hash(gold, pred) for gold, pred in pairs]
+    stored = cache.get_many(set(hashes))
+    new_results: Dict[str, Optional[Dict[str, Any]]] = {}
+    results = []
+    for h, (gold, pred) in zip(hashes, pairs):
+        if h in stored:
+            result = stored[h]
+        elif h in new_results:
+            result = new_results[h]
+        else:
+            result = new_results[h] = score_sample(gold, pred)
+        results.append(result)
+    cache.hits += len(hashes) - len(new_results)
+    cache.misses += len(new_results)
+    metrics_utils.inc("cache_lookups_total", len(hashes) - len(new_results), cache="score", result="hit")
+    metrics_utils.inc("cache_lookups_total", len(new_results), cache="score", result="miss")
+    if new_results:
+        cache.put_many(new_results)
+    return results
+
+
+# --- Online Scoring ---
+
+def wilson_interval(correct: int, total: int, z: float = 1.96) -> Tuple[float, float]:
+    """Returns the Wilson score interval (low, high) of a proportion, as fractions."""
+    if total == 0:
+        return 0.0, 1.0
+    p = correct / total
+    denominator = 1 + z * z / total
+    center = (p + z * z / (2 * total)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+class OnlineScorer:
+    """
+    Scores conversations as an inference run finishes them, with the same rules as
+    run_evaluation.py. With `floor` (turn execution accuracy, in percent), `should_abort()`
+    becomes true once `min_samples` conversations are scored and the upper bound of the
+    confidence interval is below the floor, i.e. the run is confidently worse than the floor.
+    """
+
+    def __init__(self, floor: Optional[float] = None, min_samples: int = 30, z: float = 1.96):
+        self.floor = floor
+        self.min_samples = min_samples
+        self.z = z
+        self.samples = 0
+        self.sample_exe_correct = 0
+        self.turns = 0
+        self.turn_exe_correct = 0
+        self.turn_prog_correct = 0
+
+    def add(self, gold_item: Sample, pred_item: Sample) -> None:
+        """Scores one finished conversation and adds it to the running totals."""
+        self.samples += 1
+        result = score_sample(gold_item, pred_item)
+        if result is None:
+            return
+        for turn in result['turns']:
+            self.turns += 1
+            self.turn_exe_correct += turn['exe_correct']
+            self.turn_prog_correct += turn['prog_correct']
+        self.sample_exe_correct += result['last_turn_exe_correct']
+
+    def _format(self, correct: int, total: int) -> str:
+        low, high = wilson_interval(correct, total, self.z)
+        accuracy = correct / total * 100 if total else 0.0
+        return f"{accuracy:.1f}% [{low * 100:.1f}, {high * 100:.1f}]"
+
+    def postfix(self) -> Dict[str, str]:
+        """Running accuracies with their confidence intervals, for a tqdm postfix or a log line."""
+        return {
+            "turn_exe": self._format(self.turn_exe_correct, self.turns),
+            "turn_prog": self._format(self.turn_prog_correct, self.turns),
+            "sample_exe": self._format(self.sample_exe_correct, self.samples),
+        }
+
+    def should_abort(self) -> bool:
+        """True once enough conversations are scored and accuracy is confidently below the floor."""
+        if self.floor is None or self.samples < self.min_samples:
+            return False
+        _, high = wilson_interval(self.turn_exe_correct, self.turns, self.z)
+        return high * 100 < self.floor
+
+    def abort_message(self) -> str:
+        """Explains why `should_abort()` stopped the run."""
+        return (f"Aborting: turn execution accuracy {self._format(self.turn_exe_correct, self.turns)} is below "
+                f"the floor of {self.floor:.1f}% after {self.samples} conversations.")
+
+
+# --- Sequential Evaluation ---
+
+def sample_stratum(item: Sample) -> str:
+    """
+    Returns the stratum of a conversation, using the stages of prepare_train_test_sets.py in order:
+    exp, 9-turn, greater, 8-, 7- and 1-turn dialogues, then type II flag x number of turns.
+    """
+    features = item.get('features', {})
+    num_turns = features.get('num_dialogue_turns', 0)
+    programs_str = str(item.get('dialogue', {}).get('turn_program', []))
+    if 'exp' in programs_str:
+        return "exp"
+    if num_turns == 9:
+        return "turns_9"
+    if 'greater' in programs_str:
+        return "greater"
+    if num_turns in (8, 7, 1):
+        return f"turns_{num_turns}"
+    return f"type2_{features.get('has_type2_question', False)}_turns_{num_turns}"
+
+
+def stratified_order(items: List[Sample], seed: int) -> List[Sample]:
+    """
+    Returns the items in a seeded order whose every prefix keeps each stratum close to its share
+    of the full set: items are shuffled within their stratum and the k-th of n items is placed at
+    (k + offset) / n, with a random offset per stratum.
+    """
+    rng = random.Random(seed)
+    strata: Dict[str, List[Sample]] = {}
+    for item in items:
+        strata.setdefault(sample_stratum(item), []).append(item)
+
+    keyed: List[Tuple[float, str, int, Sample]] = []
+    for name in sorted(strata):
+        members = strata[name]
+        rng.shuffle(members)
+        offset = rng.random()
+        keyed.extend(((k + offset) / len(members), name, k, item) for k, item in enumerate(members))
+    keyed.sort(key=lambda entry: entry[:3])
+    return [item for *_, item in keyed]
+
+
+class ConfidenceSequence:
+    """
+    Anytime-valid confidence sequence for the mean of observations bounded in [low, high]
+    (predictable plug-in empirical-Bernstein, Waudby-Smith & Ramdas): with probability 1 - alpha
+    the true mean lies in every interval of the sequence, so it may be checked after each
+    observation and collection stopped at the first decisive look. The width adapts to the
+    observed variance; intervals are intersected over time, so they only shrink.
+    """
+
+    def __init__(self, low: float, high: float, alpha: float = 0.05, max_lambda: float = 0.5):
+        self.low = low
+        self.high = high
+        self.alpha = alpha
+        self.max_lambda = max_lambda
+        self.count = 0
+        self.total = 0.0
+        # Running sums on the [0, 1] scale
+        self._sum_x = 0.0
+        self._sum_sq_dev = 0.0
+        self._sum_lambda = 0.0
+        self._sum_lambda_x = 0.0
+        self._sum_penalty = 0.0
+        self._bounds = (low, high)
+
+    def update(self, value: float) -> None:
+        """Adds one observation and narrows the interval."""
+        x = (value - self.low) / (self.high - self.low)
+        t = self.count + 1
+        mean_prev = (0.5 + self._sum_x) / t
+        var_prev = (0.25 + self._sum_sq_dev) / t
+        lam = min(math.sqrt(2 * math.log(2 / self.alpha) / (var_prev * t * math.log(1 + t))), self.max_lambda)
+        self._sum_lambda += lam
+        self._sum_lambda_x += lam * x
+        self._sum_penalty += 4 * (x - mean_prev) ** 2 * (-math.log(1 - lam) - lam) / 4
+
+        self.count = t
+        self.total += value
+        self._sum_x += x
+        self._sum_sq_dev += (x - (0.5 + self._sum_x) / (t + 1)) ** 2
+
+        center = self._sum_lambda_x / self._sum_lambda
+        radius = (math.log(2 / self.alpha) + self._sum_penalty) / self._sum_lambda
+        scale = self.high - self.low
+        low, high = self._bounds
+        self._bounds = (max(low, self.low + (center - radius) * scale), min(high, self.low + (center + radius) * scale))
+
+    @property
+    def mean(self) -> float:
+        """Mean of the observations so far."""
+        return self.total / self.count if self.count else 0.0
+
+    def interval(self) -> Tuple[float, float]:
+        """Current (low, high) bounds on the mean, valid at any time."""
+        return self._bounds
+
+
+# --- Sliced Metrics ---
+
+def build_turn_table(pairs: List[SamplePair], results: List[Optional[Dict[str, Any]]]) -> "pd.DataFrame":
+    """
+    Collects every scored turn into one row of a columnar table: correctness flags plus the
+    slice features of its gold sample (dialogue length, type II flag, rare operations in the
+    conversation) and of its gold program (operation set, number of steps).
+    """
+    import pandas as pd
+
+    columns: Dict[str, List[Any]] = {name: [] for name in ["id", *SLICE_COLUMNS, "is_last_turn", "exe_correct", "prog_correct"]}
+    for (gold_item, _), result in zip(pairs, results):
+        if result is None:
+            continue
+        features = gold_item.get('features', {})
+        gold_programs = gold_item.get('dialogue', {}).get('turn_program', [])
+        sample_ops = set(OP_PATTERN.findall(" ".join(gold_programs)))
+        rare_ops = "+".join(sorted(sample_ops & {"exp", "greater"})) or "none"
+        num_turns = features.get('num_dialogue_turns', len(gold_programs))
+        for turn in result['turns']:
+            ops = OP_PATTERN.findall(turn['gold_program'])
+            columns["id"].append(gold_item['id'])
+            columns["turn"].append(turn['turn'])
+            columns["num_dialogue_turns"].append(num_turns)
+            columns["has_type2_question"].append(bool(features.get('has_type2_question', False)))
+            columns["rare_ops"].append(rare_ops)
+            columns["gold_ops"].append("+".join(sorted(set(ops))) or "value")
+            columns["program_steps"].append(len(ops))
+            columns["is_last_turn"].append(turn['turn'] == len(gold_programs))
+            columns["exe_correct"].append(bool(turn['exe_correct']))
+            columns["prog_correct"].append(bool(turn['prog_correct']))
+    return pd.DataFrame(columns)
+
+
+def compute_slice_metrics(turn_table: "pd.DataFrame", slice_columns: Optional[List[str]] = None) -> "pd.DataFrame":
+    """
+    Returns turn count and execution/program accuracy (%) for every value of every slice column,
+    as one long table (slice, value, turns, exe_acc, prog_acc) computed with a single group-by.
+    """
+    import pandas as pd
+
+    slice_columns = slice_columns or SLICE_COLUMNS
+    long_table = turn_table.melt(
+        id_vars=["exe_correct", "prog_correct"], value_vars=slice_columns, var_name="slice", value_name="value"
+    )
+    long_table["value"] = long_table["value"].astype(str)
+    metrics = long_table.groupby(["slice", "value"], sort=False).agg(
+        turns=("exe_correct", "size"), exe_acc=("exe_correct", "mean"), prog_acc=("prog_correct", "mean")
+    ).reset_index()
+    metrics[["exe_acc", "prog_acc"]] *= 100
+
+    # Keep the slices in the given order and their values in natural (numeric-aware) order
+    slice_order = metrics["slice"].map({name: i for i, name in enumerate(slice_columns)})
+    numeric_value = pd.to_numeric(metrics["value"], errors="coerce")
+    order = pd.DataFrame({"slice": slice_order, "numeric": numeric_value, "value": metrics["value"]}).sort_values(["slice", "numeric", "value"]).index
+    return metrics.loc[order].reset_index(drop=True)
+
+
+def write_table(table: "pd.DataFrame", path: str) -> None:
+    """Writes a table as Parquet if `path` ends with .parquet, otherwise as CSV."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if str(path).endswith(".parquet"):
+        table.to_parquet(path, index=False)
+    else:
+        table.to_csv(path, index=False)
@@ -0,0 +1,94 @@
+"""
+Per-document numeric grounding index.
+
+Every number in a document's table (cells and headers) and text is normalized the way
+`process_row`/`str_to_num` read it ($, %, commas, parentheses) and bucketed, so checking
+whether a program argument appears in the document is a dictionary lookup.
+"""
+import re
+from typing import Any, Dict, List
+
+from .program_utils import program_tokenization, str_to_num
+
+NUMBER_PATTERN = re.compile(r"-?(?:\d[\d,]*(?:\.\d+)?|\.\d+)")
+SENTENCE_SPLIT_PATTERN = re.compile(r"\s\.\s")
+
+# Values are bucketed in units of 1e-4 so that e.g. `32.1` and `32.10` share a bucket.
+# Keys are integer strings, which keeps them valid as MongoDB field names.
+BUCKET_SCALE = 10000
+
+# Literals models legitimately use without them appearing in the document (unit scaling, counts)
+IMPLICIT_CONSTANTS = {float(n) for n in range(13)} | {100.0, 1000.0, 1000000.0, 1000000000.0}
+
+# {bucket: [location, ...]}, see `build_numeric_index`
+NumericIndex = Dict[str, List[Dict[str, Any]]]
+
+
+def value_bucket(value: float) -> str:
+    """Returns the index key of a numeric value. Signs are ignored since tables write negatives as `( 12 )`."""
+    return str(round(abs(value) * BUCKET_SCALE))
+
+
+def normalize_number(raw: Any) -> Any:
+    """Normalizes a raw cell or literal like `process_row` does; returns 'n/a' if it is not numeric."""
+    return str_to_num(str(raw).replace("$", "").split("(")[0].strip())
+
+
+def build_numeric_index(doc: Dict[str, Any]) -> NumericIndex:
+    """
+    Builds {bucket: [location, ...]} for every number in the document. A location is
+    {"source": "table", "column": ..., "row": ...}, {"source": "table_header", "header": ...}
+    or {"source": "pre_text"/"post_text", "sentence": i}. Each number is also registered as a
+    fraction ("percent": True), matching how `str_to_num` reads `3.75%`.
+    """
+    index: NumericIndex = {}
+
+    def register(raw: Any, location: Dict[str, Any]) -> None:
+        num = normalize_number(raw)
+        if num == "n/a":
+            return
+        index.setdefault(value_bucket(num), []).append(location)
+        index.setdefault(value_bucket(num / 100.0), []).append({**location, "percent": True})
+
+    for col_header, column in (doc.get("table") or {}).items():
+        # Table headers often carry values too (e.g. a row labelled "high $ 17.84")
+        for match in NUMBER_PATTERN.findall(str(col_header)):
+            register(match, {"source": "table_header", "header": str(col_header)})
+        for row_header, cell in column.items():
+            for match in NUMBER_PATTERN.findall(str(row_header)):
+                register(match, {"source": "table_header", "header": str(row_header)})
+            location = {"source": "table", "column": str(col_header), "row": str(row_header)}
+            if isinstance(cell, (int, float)):
+                register(cell, location)
+            else:
+                for match in NUMBER_PATTERN.findall(str(cell)):
+                    register(match, location)
+
+    for source in ("pre_text", "post_text"):
+        for i, sentence in enumerate(SENTENCE_SPLIT_PATTERN.split(doc.get(source) or "")):
+            for match in NUMBER_PATTERN.findall(sentence):
+                register(match, {"source": source, "sentence": i})
+    return index
+
+
+def is_grounded(literal: str, numeric_index: NumericIndex) -> bool:
+    """Checks whether a program literal is a constant or appears in the indexed document."""
+    if literal.startswith("const_") or literal.startswith("#"):
+        return True
+    num = str_to_num(literal)
+    if num == "n/a":
+        return False
+    return num in IMPLICIT_CONSTANTS or value_bucket(num) in numeric_index
+
+
+def program_literals(program_str: str) -> List[str]:
+    """Returns the literal (non-reference) arguments of a program, or the program itself if it is a bare value."""
+    steps = program_tokenization(program_str)[:-1]
+    if len(steps) == 1:
+        return [steps[0].strip()]
+    return [token.strip() for ind, token in enumerate(steps) if ind % 4 in (1, 2) and not token.strip().startswith("#")]
+
+
+def find_ungrounded_args(program_str: str, numeric_index: NumericIndex) -> List[str]:
+    """Returns the program's literal arguments that do not appear in the document."""
+    return [literal for literal in program_literals(program_str) if not is_grounded(literal, numeric_index)]
@@ -0,0 +1,125 @@
+"""
+Sliding-window conversation history for long chat sessions.
+
+The document system prompt and the last K turns are sent verbatim; older turns are
+folded into a compact summary of their programs and executed values, which is what
+later turns refer back to.
+"""
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict, List, TypedDict
+
+from . import config
+
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+
+# Rough per-message overhead added by the chat format (role, separators)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+class HistoryTurn(TypedDict):
+    """A completed turn, with its summary line and the token counts of both of its forms."""
+    question: str
+    program: str
+    answer: Any
+    summary_line: str
+    verbatim_tokens: int
+    summary_tokens: int
+
+
+@lru_cache(maxsize=1)
+def _get_encoder() -> Any:
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+def has_exact_tokenizer() -> bool:
+    """True when tiktoken and its `o200k_base` encoding are available, so `count_tokens` is exact."""
+    return _get_encoder() is not None
+
+
+def tokenizer_name() -> str:
+    """Names the tokenizer `count_tokens` uses, for reports."""
+    return "tiktoken o200k_base" if has_exact_tokenizer() else "estimate (~4 characters per token)"
+
+
+def count_tokens(text: str) -> int:
+    """Counts tokens with tiktoken when available, otherwise estimates ~4 characters per token."""
+    encoder = _get_encoder()
+    if encoder is None:
+        return len(text) // 4 + 1
+    return len(encoder.encode(text))
+
+
+class ConversationHistory:
+    """
+    Keeps the system prompt, the last `keep_turns` turns verbatim and a summary of earlier turns,
+    shrinking the verbatim window (then the summary) until the prompt fits `token_budget`.
+    """
+
+    def __init__(self, system_prompt: str, keep_turns: int = config.HISTORY_KEEP_TURNS, token_budget: int = config.HISTORY_TOKEN_BUDGET):
+        self.system_prompt = system_prompt
+        self.keep_turns = keep_turns
+        self.token_budget = token_budget
+        self.turns: List[HistoryTurn] = []
+        self.last_stats: Dict[str, int] = {}
+        self._system_tokens = count_tokens(system_prompt) + MESSAGE_TOKEN_OVERHEAD
+
+    def add_turn(self, question: str, program: str, answer: Any) -> None:
+        """Records a completed turn (question, predicted program and its executed value)."""
+        summary_line = f"Turn {len(self.turns) + 1}: {program} = {answer}"
+        self.turns.append({
+            "question": question,
+            "program": program,
+            "answer": answer,
+            "summary_line": summary_line,
+            "verbatim_tokens": count_tokens(question) + count_tokens(program) + 2 * MESSAGE_TOKEN_OVERHEAD,
+            "summary_tokens": count_tokens(summary_line) + 1,
+        })
+
+    def build_messages(self, question: str) -> List["BaseMessage"]:
+        """Builds the message list for the next question and records token statistics in `last_stats`."""
+        from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+        question_tokens = count_tokens(question) + MESSAGE_TOKEN_OVERHEAD
+        num_verbatim = min(self.keep_turns, len(self.turns)) if self.keep_turns > 0 else 0
+        first_summarized = 0
+
+        def total_tokens() -> int:
+            split = len(self.turns) - num_verbatim
+            summary = self.turns[first_summarized:split]
+            summary_tokens = sum(t["summary_tokens"] for t in summary) + MESSAGE_TOKEN_OVERHEAD if summary else 0
+            verbatim_tokens = sum(t["verbatim_tokens"] for t in self.turns[split:])
+            return self._system_tokens + summary_tokens + verbatim_tokens + question_tokens
+
+        # --- Enforce the budget: summarize verbatim turns first, then drop the oldest summary lines ---
+        while total_tokens() > self.token_budget and num_verbatim > 0:
+            num_verbatim -= 1
+        while total_tokens() > self.token_budget and first_summarized < len(self.turns) - num_verbatim:
+            first_summarized += 1
+
+        split = len(self.turns) - num_verbatim
+        messages: List["BaseMessage"] = [SystemMessage(content=self.system_prompt)]
+        summary_lines = [t["summary_line"] for t in self.turns[first_summarized:split]]
+        if summary_lines:
+            messages.append(SystemMessage(content="Earlier turns (program = executed value):\n" + "\n".join(summary_lines)))
+        for turn in self.turns[split:]:
+            messages.append(HumanMessage(content=turn["question"]))
+            messages.append(AIMessage(content=turn["program"]))
+        messages.append(HumanMessage(content=question))
+
+        tokens_full = self._system_tokens + sum(t["verbatim_tokens"] for t in self.turns) + question_tokens
+        tokens_sent = total_tokens()
+        self.last_stats = {
+            "turn": len(self.turns) + 1,
+            "tokens_sent": tokens_sent,
+            "tokens_full": tokens_full,
+            "tokens_saved": tokens_full - tokens_sent,
+            "turns_verbatim": num_verbatim,
+            "turns_summarized": split - first_summarized,
+            "turns_dropped": first_summarized,
+        }
+        return messages
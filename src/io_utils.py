@@ -0,0 +1,218 @@
+"""
+Streaming readers for dataset and prediction files.
+
+`iter_records` yields the records of a JSON list, a JSON dict of lists (the raw dataset's
+split format) or a JSONL file, optionally gzip- or zstd-compressed, without loading the whole
+file. `GoldIndex` keeps gold records in an on-disk SQLite index for lookups by id.
+`map_bounded` processes such a stream in a process pool without reading ahead of the workers.
+"""
+import gzip
+import io
+import json
+import os
+import sqlite3
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import IO, Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional
+
+from . import config
+
+CHUNK_SIZE = 1 << 20
+
+
+def _strip_compression_suffix(path: str) -> str:
+    for suffix in (".gz", ".zst"):
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def open_text(path: Any) -> IO[str]:
+    """Opens a text file for reading, decompressing `.gz` and `.zst` files on the fly."""
+    path = str(path)
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("Reading .zst files requires the 'zstandard' package.") from e
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+class _IncrementalJsonReader:
+    """Decodes JSON values one at a time from a text stream, keeping only a small buffer in memory."""
+
+    def __init__(self, f: IO[str], chunk_size: Optional[int] = None):
+        self.f = f
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Returns the next non-whitespace character without consuming it ('' at end of file)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char: str) -> None:
+        """Consumes `char` (after any whitespace), raising ValueError if something else comes next."""
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected '{char}' in JSON stream, found '{found or 'end of file'}'")
+        self.pos += 1
+
+    def decode(self) -> Any:
+        """Decodes the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A value ending exactly at the buffer end may be a truncated number; read more first
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def iter_array(self) -> Iterator[Any]:
+        """Yields the items of the array starting at the current position."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("]")
+            return
+
+
+def iter_records(path: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Yields records from a JSONL file, a JSON list, or a JSON dict of lists (records of every
+    split, in file order). `.gz` and `.zst` files are decompressed while reading.
+    """
+    with open_text(path) as f:
+        if _strip_compression_suffix(str(path)).endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        reader = _IncrementalJsonReader(f)
+        if reader.peek() == "{":
+            reader.expect("{")
+            while reader.peek() != "}":
+                reader.decode()  # split name
+                reader.expect(":")
+                yield from reader.iter_array()
+                if reader.peek() == ",":
+                    reader.pos += 1
+            reader.expect("}")
+        else:
+            yield from reader.iter_array()
+
+
+def batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Yields lists of up to `size` consecutive items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def map_bounded(fn: Callable[[Any], Any], items: Iterable[Any], workers: int = 1, max_pending: Optional[int] = None) -> Iterator[Any]:
+    """
+    Yields `fn(item)` for each item, in input order, computed by a pool of `workers` processes
+    (in this process when `workers` is 1). At most `max_pending` items (default: twice the
+    workers) are submitted ahead of the consumer, so the input is read only as fast as results
+    are taken and memory stays bounded. `fn` must be a module-level function.
+    """
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    max_pending = max_pending or 2 * workers
+    pending: Deque["Future[Any]"] = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class GoldIndex:
+    """
+    On-disk index of gold records by id, built once from a gold file with `iter_records` and
+    rebuilt when the file's size or modification time changes.
+    """
+
+    def __init__(self, gold_path: Any, index_path: Optional[Any] = None):
+        gold_path = Path(gold_path)
+        stat = gold_path.stat()
+        self.source = f"{gold_path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+        self.index_path = Path(index_path or config.INDEXES_DIR / f"{gold_path.name}.sqlite")
+        os.makedirs(self.index_path.parent, exist_ok=True)
+
+        self.conn = sqlite3.connect(str(self.index_path))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS records (id TEXT PRIMARY KEY, record TEXT NOT NULL)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+        self.rebuilt = row is None or row[0] != self.source
+        if self.rebuilt:
+            self._build(gold_path)
+
+    def _build(self, gold_path: Path, batch_size: int = 1000) -> None:
+        self.conn.execute("DELETE FROM records")
+        batch = []
+        for record in iter_records(gold_path):
+            batch.append((record['id'], json.dumps(record)))
+            if len(batch) >= batch_size:
+                self.conn.executemany("INSERT OR REPLACE INTO records (id, record) VALUES (?, ?)", batch)
+                batch = []
+        if batch:
+            self.conn.executemany("INSERT OR REPLACE INTO records (id, record) VALUES (?, ?)", batch)
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('source', ?)", (self.source,))
+        self.conn.commit()
+
+    def get(self, record_id: str) -> Optional[Dict[str, Any]]:
+        """Returns the gold record with this id, or None."""
+        row = self.conn.execute("SELECT record FROM records WHERE id = ?", (record_id,)).fetchone()
+        record: Optional[Dict[str, Any]] = json.loads(row[0]) if row else None
+        return record
+
+    def __len__(self) -> int:
+        return int(self.conn.execute("SELECT COUNT(*) FROM records").fetchone()[0])
+
+    def close(self) -> None:
+        """Closes the index database."""
+        self.conn.close()
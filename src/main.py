@@ -2,12 +2,23 @@
 Main typer app for ConvFinQA
 """
 import os
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 import typer
 from rich import print as rich_print
+from . import metrics_utils
 from .db_utils import get_record_by_id
-from .program_utils import eval_program, program_tokenization
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+from .grounding_utils import build_numeric_index, find_ungrounded_args
+from .history_utils import ConversationHistory
+from .program_utils import eval_program, program_tokenization, repair_program
+
+# LangChain is imported inside the commands that call the model, so `main --help`
+# and lightweight commands start without loading it.
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+    from langchain_openai import ChatOpenAI
 
 # --- App Initialization ---
 app = typer.Typer(
@@ -19,11 +30,45 @@ app = typer.Typer(
 # --- Global Variables & Setup ---
 from . import config
 
+
+@app.callback()
+def _main_options(
+    ctx: typer.Context,
+    profile: bool = typer.Option(False, help="Profile the command and write .pstats/.collapsed files to config.PROFILES_DIR."),
+    profile_top: int = typer.Option(20, help="Number of hot functions printed with --profile."),
+) -> None:
+    if profile:
+        from .profile_utils import Profiler
+        profiler = Profiler(ctx.invoked_subcommand or "main", top_n=profile_top)
+        profiler.start()
+        # Runs when the command finishes, including on typer.Exit
+        ctx.call_on_close(profiler.stop)
+
+
+def _build_system_prompt(doc: Dict[str, Any]) -> str:
+    """Renders a stored record's document as the system prompt for the fine-tuned model."""
+    return (
+        f"{doc.get('pre_text', '')}\n\n"
+        f"TABLE:\n{doc.get('table_markdown', '')}\n\n"
+        f"{doc.get('post_text', '')}"
+    )
+
+
 @app.command()
 def chat(
     record_id: str = typer.Argument(..., help="ID of the record to chat about (e.g., 'Single_Apple/2005/page_35.pdf-1')"),
+    keep_turns: int = typer.Option(config.HISTORY_KEEP_TURNS, help="Number of recent turns sent verbatim; older turns are summarized."),
+    token_budget: int = typer.Option(config.HISTORY_TOKEN_BUDGET, help="Maximum prompt tokens sent per turn."),
+    cascade: bool = typer.Option(False, help="Escalate to the larger model when the fine-tuned model's program fails validation."),
+    metrics: bool = typer.Option(False, help="Collect timing and token metrics and export them to config.METRICS_DIR on exit."),
+    metrics_port: Optional[int] = typer.Option(None, help="Also serve the metrics in Prometheus format on this port."),
+    metrics_host: str = typer.Option("127.0.0.1", help="Interface the metrics endpoint binds to; use 0.0.0.0 to allow remote scraping."),
 ) -> None:
     """Ask questions about a specific financial record stored in MongoDB."""
+    if metrics:
+        metrics_utils.enable()
+    if metrics_port:
+        metrics_utils.serve_prometheus(metrics_port, metrics_host)
     
     # --- 1. Retrieve the record from MongoDB ---
     record = get_record_by_id(record_id)
@@ -36,46 +81,216 @@ def chat(
     
     # --- 2. Prepare the initial context (System Prompt) ---
     doc = record.get('doc', {})
-    system_prompt = (
-        f"{doc.get('pre_text', '')}\n\n"
-        f"TABLE:\n{doc.get('table_markdown', '')}\n\n"
-        f"{doc.get('post_text', '')}"
-    )
+    system_prompt = _build_system_prompt(doc)
+    metrics_utils.record_cache("numeric_index", bool(doc.get('numeric_index')))
+    numeric_index = doc.get('numeric_index') or build_numeric_index(doc)
     
     # --- 3. Initialize the conversation ---
-    llm = ChatOpenAI(model=config.FINETUNED_OPENAI_MODEL, temperature=config.TEMPERATURE)
-    history = [SystemMessage(content=system_prompt)]
+    if cascade:
+        from .cascade_utils import CascadeRouter
+        router = CascadeRouter(repair=True)
+    else:
+        from langchain_openai import ChatOpenAI
+        llm = ChatOpenAI(model=config.FINETUNED_OPENAI_MODEL, temperature=config.TEMPERATURE)
+    history = ConversationHistory(system_prompt, keep_turns=keep_turns, token_budget=token_budget)
     
     rich_print("[bold yellow]Starting chat session. Type 'exit' or 'quit' to end.[/bold yellow]")
 
     while True:
         message = input(">>> ")
         if message.strip().lower() in {"exit", "quit"}:
+            if cascade:
+                summary = router.summary()
+                if summary["turns"]:
+                    rich_print(
+                        f"[grey50]Cascade: {summary['escalation_rate']:.0%} of {summary['turns']} turns escalated, "
+                        f"avg latency {summary['avg_latency_s']:.2f}s, total cost ${summary['total_cost_usd']:.4f}[/grey50]"
+                    )
+            metrics_path = metrics_utils.export("chat")
+            if metrics_path:
+                rich_print(f"[grey50]Metrics saved to {metrics_path}[/grey50]")
             rich_print("[bold yellow]Ending chat session.[/bold yellow]")
             break
 
-        # --- 4. Invoke the LLM with the full conversation history ---
-        history.append(HumanMessage(content=message))
+        # --- 4. Invoke the LLM with the compacted conversation history ---
+        with metrics_utils.span("prompt_render"):
+            messages = history.build_messages(message)
         
         try:
-            # Get the predicted program string
-            response = llm.invoke(history)
-            program_str = response.content.strip()
-            rich_print(f"[grey50]Predicted program: {program_str}[/grey50]")
-            
-            # Add the model's program to the history for the next turn
-            history.append(AIMessage(content=program_str))
-
-            # --- 5. Execute the program to get the final answer ---
-            tokenized_prog = program_tokenization(program_str)
-            _, final_answer = eval_program(tokenized_prog)
+            if cascade:
+                # The router validates, escalates if needed and executes the chosen program
+                result = router.answer(messages, doc, history.turns, message, metadata={"sample_id": record_id, "turn": len(history.turns) + 1}, numeric_index=numeric_index)
+                program_str, final_answer, repairs = result["program"], result["answer"], result["repairs"]
+                rich_print(f"[grey50]Predicted program: {program_str}[/grey50]")
+                escalation = f"escalated ({', '.join(result['primary_failures'])})" if result["escalated"] else "not escalated"
+                rich_print(f"[grey50]Model: {result['model']}, {escalation}, {result['latency_s']:.2f}s, ${result['cost_usd']:.5f}[/grey50]")
+            else:
+                # Get the predicted program string, repairing formatting slips locally instead of re-asking
+                with metrics_utils.span("llm_call", model=config.FINETUNED_OPENAI_MODEL):
+                    response = llm.invoke(messages)
+                metrics_utils.record_llm_usage(config.FINETUNED_OPENAI_MODEL, getattr(response, "usage_metadata", None), sample_id=record_id, turn=len(history.turns) + 1)
+                program_str, repairs = repair_program(response.text().strip())
+                rich_print(f"[grey50]Predicted program: {program_str}[/grey50]")
+
+                # --- 5. Execute the program to get the final answer ---
+                with metrics_utils.span("execution"):
+                    tokenized_prog = program_tokenization(program_str)
+                    _, final_answer = eval_program(tokenized_prog)
  
+            if repairs:
+                rich_print(f"[grey50]Repairs applied: {', '.join(repairs)}[/grey50]")
             rich_print(f"[blue][bold]Assistant:[/bold] {final_answer}[/blue]")
+            ungrounded_args = find_ungrounded_args(program_str, numeric_index)
+            if ungrounded_args:
+                rich_print(f"[yellow]Warning: arguments not found in the document: {', '.join(ungrounded_args)}[/yellow]")
+
+            # Record the turn only once it succeeded, so a failed question can be asked again
+            history.add_turn(message, program_str, final_answer)
+            stats = history.last_stats
+            rich_print(
+                f"[grey50]Prompt tokens: {stats['tokens_sent']} sent, {stats['tokens_saved']} saved "
+                f"({stats['turns_verbatim']} verbatim, {stats['turns_summarized']} summarized turns)[/grey50]"
+            )
 
         except Exception as e:
             rich_print(f"[bold red]An error occurred: {e}[/bold red]")
-            # Remove the last user message to allow them to try again
-            history.pop()
+
+
+def _load_batch_entries(input_path: Optional[Path], dataset_path: Path, limit: Optional[int]) -> List[Dict[str, Any]]:
+    """
+    Builds the list of {'id', 'questions'} entries for a batch run.
+    Entries come from a JSON/JSONL input file; entries without questions (or no input file at all)
+    take their record ids and `conv_questions` from the dataset.
+    """
+    with open(dataset_path, 'r', encoding='utf-8') as f:
+        dataset = json.load(f)
+    if isinstance(dataset, dict):
+        dataset = [item for split in dataset.values() for item in split]
+    dataset_questions = {item['id']: item.get('dialogue', {}).get('conv_questions', []) for item in dataset}
+
+    if input_path is None:
+        entries = [{"id": record_id, "questions": questions} for record_id, questions in dataset_questions.items()]
+    else:
+        with open(input_path, 'r', encoding='utf-8') as f:
+            if str(input_path).endswith('.jsonl'):
+                entries = [json.loads(line) for line in f if line.strip()]
+            else:
+                entries = json.load(f)
+        for entry in entries:
+            if not entry.get('questions'):
+                entry['questions'] = dataset_questions.get(entry['id'], [])
+
+    return entries[:limit] if limit else entries
+
+
+def _run_batch_conversation(llm: "ChatOpenAI", entry: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Runs one conversation of a batch: every question in order, with the model's programs as history.
+    Programs are repaired like in `chat`, with the fixes per turn in `program_repairs`.
+    A turn whose call or execution fails is recorded as '[ERROR: ...]' and listed in `turn_errors`,
+    but left out of the history sent for the later turns. A conversation that fails as a whole
+    (e.g. the record cannot be loaded) is returned with an `error` field.
+    """
+    from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+
+    record_id = entry.get('id')
+    questions = entry.get('questions', [])
+    if not isinstance(record_id, str):
+        return {"id": record_id, "questions": questions, "error": f"Entry id must be a string, got {record_id!r}."}
+    try:
+        record = get_record_by_id(record_id)
+        if not record:
+            return {"id": record_id, "questions": questions, "error": f"Record with ID '{record_id}' not found in the database."}
+
+        history: List["BaseMessage"] = [SystemMessage(content=_build_system_prompt(record.get('doc', {})))]
+        predicted_programs: List[str] = []
+        executed_answers: List[Any] = []
+        program_repairs: List[List[str]] = []
+        turn_errors: List[Dict[str, Any]] = []
+
+        for i, question in enumerate(questions):
+            try:
+                with metrics_utils.span("llm_call", model=config.FINETUNED_OPENAI_MODEL):
+                    response = llm.invoke(history + [HumanMessage(content=question)], config={"metadata": {"sample_id": record_id, "turn": i + 1}})
+                metrics_utils.record_llm_usage(config.FINETUNED_OPENAI_MODEL, getattr(response, "usage_metadata", None), sample_id=record_id, turn=i + 1)
+                program_str, repairs = repair_program(response.text().strip())
+                with metrics_utils.span("execution"):
+                    tokenized_prog = program_tokenization(program_str)
+                    _, exe_res = eval_program(tokenized_prog)
+            except Exception as e:
+                predicted_programs.append(f"[ERROR: {e}]")
+                executed_answers.append("n/a")
+                program_repairs.append([])
+                turn_errors.append({"turn": i + 1, "error": str(e)})
+                continue
+
+            history.extend([HumanMessage(content=question), AIMessage(content=program_str)])
+            predicted_programs.append(program_str)
+            executed_answers.append(exe_res)
+            program_repairs.append(repairs)
+    except Exception as e:
+        return {"id": record_id, "questions": questions, "error": f"{type(e).__name__}: {e}"}
+
+    result: Dict[str, Any] = {
+        "id": record_id,
+        "questions": questions,
+        "turn_program": predicted_programs,
+        "executed_answers": executed_answers,
+        "program_repairs": program_repairs,
+    }
+    if turn_errors:
+        result["turn_errors"] = turn_errors
+    return result
+
+
+@app.command()
+def batch(
+    input_path: Optional[Path] = typer.Option(None, help="JSON or JSONL file of {'id': ..., 'questions': [...]} entries. Entries without questions use the dataset's questions."),
+    dataset_path: Path = typer.Option(config.TEST_SET_PATH, help="Dataset to pull record ids and questions from."),
+    output_path: Path = typer.Option(config.PREDICTIONS_DIR / "batch_answers.jsonl", help="JSONL file the answers are streamed to."),
+    max_workers: int = typer.Option(8, help="Number of conversations to run concurrently."),
+    limit: Optional[int] = typer.Option(None, help="Limit the number of conversations to run."),
+    metrics: bool = typer.Option(False, help="Collect timing and token metrics and export them to config.METRICS_DIR."),
+) -> None:
+    """Answer many conversations non-interactively and stream programs and results to JSONL."""
+    if metrics:
+        metrics_utils.enable()
+
+    # --- 1. Collect the conversations to run ---
+    try:
+        entries = _load_batch_entries(input_path, dataset_path, limit)
+    except (FileNotFoundError, json.JSONDecodeError, KeyError) as e:
+        rich_print(f"[bold red]Error: Could not load batch entries. {e}[/bold red]")
+        raise typer.Exit(code=1) from e
+
+    rich_print(f"[green]Running {len(entries)} conversations with {max_workers} workers.[/green]")
+
+    # --- 2. Run them concurrently with one shared client; stream results as they finish ---
+    from langchain_openai import ChatOpenAI
+    llm = ChatOpenAI(model=config.FINETUNED_OPENAI_MODEL, temperature=config.TEMPERATURE, max_tokens=config.MAX_TOKENS)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    num_failed = 0
+
+    with open(output_path, 'w', encoding='utf-8') as f_out, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_run_batch_conversation, llm, entry): entry for entry in entries}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # One bad entry must not cut the output file short
+                entry = futures[future]
+                result = {"id": entry.get('id') if isinstance(entry, dict) else None, "error": f"{type(e).__name__}: {e}"}
+            if 'error' in result:
+                num_failed += 1
+                rich_print(f"[bold red]{result['id']}: {result['error']}[/bold red]")
+            f_out.write(json.dumps(result) + '\n')
+            f_out.flush()
+
+    rich_print(f"[bold yellow]Batch complete: {len(entries) - num_failed} succeeded, {num_failed} failed. Answers saved to {output_path}[/bold yellow]")
+    metrics_path = metrics_utils.export("batch")
+    if metrics_path:
+        rich_print(f"[grey50]Metrics saved to {metrics_path}[/grey50]")
+
 
 @app.command()
 def myfunc() -> None:
@@ -0,0 +1,248 @@
+"""
+Lightweight run metrics: timed spans, counters, LLM token usage and cache hits.
+
+Metrics are disabled unless `CONVFINQA_METRICS=1` is set or `enable()` is called. While
+disabled every call returns immediately (spans are a shared no-op context manager), so the
+instrumentation stays in the hot paths. Collected metrics are exported as Prometheus text
+(file or HTTP endpoint) and as a JSON run summary; every LLM call's token usage (cached and
+uncached prompt tokens) and latency is also exported as one JSONL line.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Any, Dict, List, Literal, Optional, Tuple
+
+from . import config
+
+METRIC_PREFIX = "convfinqa"
+
+# (name, sorted (label, value) pairs)
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+_enabled = os.getenv("CONVFINQA_METRICS") == "1"
+_lock = threading.Lock()
+# Keyed by (name, sorted label items); spans hold [count, total seconds, max seconds]
+_counters: Dict[MetricKey, float] = {}
+_spans: Dict[MetricKey, List[float]] = {}
+_llm_calls: List[Dict[str, Any]] = []
+_NOOP_SPAN = nullcontext()
+# Name and duration of the last span closed on each thread, so an LLM call's usage can be paired with its latency
+_local = threading.local()
+
+
+def enable() -> None:
+    """Turns metric collection on for the rest of the process."""
+    global _enabled
+    _enabled = True
+
+
+def is_enabled() -> bool:
+    """Returns whether metrics are being collected."""
+    return _enabled
+
+
+def reset() -> None:
+    """Clears everything collected so far."""
+    with _lock:
+        _counters.clear()
+        _spans.clear()
+        _llm_calls.clear()
+
+
+def _key(name: str, labels: Dict[str, Any]) -> MetricKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels: Any) -> None:
+    """Adds `value` to the counter `name` with the given labels."""
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+class _Span:
+    __slots__ = ("key", "start")
+
+    def __init__(self, key: MetricKey):
+        self.key = key
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> Literal[False]:
+        elapsed = time.perf_counter() - self.start
+        _local.last_span = (self.key[0], elapsed)
+        with _lock:
+            stats = _spans.get(self.key)
+            if stats is None:
+                _spans[self.key] = [1, elapsed, elapsed]
+            else:
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+        return False
+
+
+def span(name: str, **labels: Any) -> Any:
+    """Returns a context manager that times its body under the span `name`."""
+    if not _enabled:
+        return _NOOP_SPAN
+    return _Span(_key(name, labels))
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    """Counts a lookup in the named cache as a hit or a miss."""
+    inc("cache_lookups_total", cache=cache, result="hit" if hit else "miss")
+
+
+def record_llm_usage(model: str, usage: Optional[Dict[str, Any]], **context: Any) -> None:
+    """
+    Counts one LLM request and its token usage. Accepts LangChain `usage_metadata`
+    (input_tokens, output_tokens, input_token_details.cache_read) or the raw OpenAI
+    `usage` object of a Batch API result (prompt_tokens, completion_tokens, ...).
+    The call is also logged with `context` (e.g. sample_id, turn) and, when it was timed
+    by an `llm_call` span just before, its latency.
+    """
+    if not _enabled:
+        return
+    usage = usage or {}
+    input_tokens = usage.get("input_tokens", usage.get("prompt_tokens", 0)) or 0
+    output_tokens = usage.get("output_tokens", usage.get("completion_tokens", 0)) or 0
+    details = usage.get("input_token_details") or usage.get("prompt_tokens_details") or {}
+    cached_tokens = details.get("cache_read", details.get("cached_tokens", 0)) or 0
+    inc("llm_requests_total", model=model)
+    inc("llm_input_tokens_total", input_tokens, model=model)
+    inc("llm_output_tokens_total", output_tokens, model=model)
+    inc("llm_cached_input_tokens_total", cached_tokens, model=model)
+
+    last_span = getattr(_local, "last_span", None)
+    _local.last_span = None
+    call = {
+        "model": model,
+        "input_tokens": input_tokens,
+        "cached_input_tokens": cached_tokens,
+        "uncached_input_tokens": input_tokens - cached_tokens,
+        "output_tokens": output_tokens,
+        "latency_s": last_span[1] if last_span and last_span[0] == "llm_call" else None,
+        **context,
+    }
+    with _lock:
+        _llm_calls.append(call)
+
+
+def llm_calls() -> List[Dict[str, Any]]:
+    """Returns the LLM calls logged so far (empty when disabled)."""
+    with _lock:
+        return list(_llm_calls)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    items = extra + labels
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def to_prometheus() -> str:
+    """Renders the collected metrics in the Prometheus text exposition format."""
+    with _lock:
+        counters = dict(_counters)
+        spans = {key: list(stats) for key, stats in _spans.items()}
+
+    lines = []
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {METRIC_PREFIX}_{name} counter")
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append(f"{METRIC_PREFIX}_{name}{_format_labels(labels)} {value}")
+    if spans:
+        lines.append(f"# TYPE {METRIC_PREFIX}_span_seconds summary")
+        for (name, labels), (count, total, _) in sorted(spans.items()):
+            lines.append(f"{METRIC_PREFIX}_span_seconds_count{_format_labels(labels, (('span', name),))} {count}")
+            lines.append(f"{METRIC_PREFIX}_span_seconds_sum{_format_labels(labels, (('span', name),))} {total:.6f}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_span_seconds_max gauge")
+        for (name, labels), (_, _, max_s) in sorted(spans.items()):
+            lines.append(f"{METRIC_PREFIX}_span_seconds_max{_format_labels(labels, (('span', name),))} {max_s:.6f}")
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> Dict[str, Any]:
+    """Returns {"counters": {...}, "spans": {...}} keyed by `name{labels}`."""
+    with _lock:
+        counters = dict(_counters)
+        spans = {key: list(stats) for key, stats in _spans.items()}
+    return {
+        "counters": {f"{name}{_format_labels(labels)}": value for (name, labels), value in sorted(counters.items())},
+        "spans": {
+            f"{name}{_format_labels(labels)}": {"count": count, "total_s": total, "mean_s": total / count, "max_s": max_s}
+            for (name, labels), (count, total, max_s) in sorted(spans.items())
+        },
+    }
+
+
+def export(run_name: str, output_dir: Optional[Path] = None) -> Optional[Path]:
+    """
+    Writes `<run_name>.prom` (Prometheus textfile format), `<run_name>.json` (run summary) and
+    `<run_name>_llm_calls.jsonl` (one line per LLM call) to `output_dir` (default
+    config.METRICS_DIR). Returns the JSON path, or None when disabled.
+    """
+    if not _enabled:
+        return None
+    output_dir = Path(output_dir or config.METRICS_DIR)
+    os.makedirs(output_dir, exist_ok=True)
+    # Write then rename, so a Prometheus textfile collector never reads a partial file
+    prom_path = output_dir / f"{run_name}.prom"
+    with open(f"{prom_path}.tmp", "w", encoding="utf-8") as f:
+        f.write(to_prometheus())
+    os.replace(f"{prom_path}.tmp", prom_path)
+    json_path = output_dir / f"{run_name}.json"
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump({"run": run_name, **summary()}, f, indent=4)
+    with open(output_dir / f"{run_name}_llm_calls.jsonl", "w", encoding="utf-8") as f:
+        for call in llm_calls():
+            f.write(json.dumps(call) + "\n")
+    return json_path
+
+
+def print_summary(top_n: int = 10) -> None:
+    """Prints the spans with the largest total time."""
+    if not _enabled:
+        return
+    spans = sorted(summary()["spans"].items(), key=lambda item: item[1]["total_s"], reverse=True)
+    print("\n--- Metrics: top spans by total time ---")
+    for name, stats in spans[:top_n]:
+        print(f"  {name:<48} {stats['count']:>8} calls  {stats['total_s']:9.3f}s total  {stats['mean_s'] * 1000:9.3f} ms mean")
+
+
+def serve_prometheus(port: int, host: str = "127.0.0.1") -> Any:
+    """
+    Serves the metrics at http://<host>:<port>/metrics from a daemon thread and returns the server.
+    Only local clients can connect by default; pass host="0.0.0.0" to let a remote Prometheus scrape it.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:  # noqa: N802 - name required by BaseHTTPRequestHandler
+            if not self.path.startswith("/metrics"):
+                self.send_error(404)
+                return
+            body = to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    enable()
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
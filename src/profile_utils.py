@@ -0,0 +1,114 @@
+"""
+Profiling switch shared by the scripts and the main CLI.
+
+A profiled run is traced by cProfile (saved as `.pstats`) while a background thread samples
+the stacks of all threads (saved as a `.collapsed` file, one `frame;frame;... count` line per
+stack, ready for flamegraph.pl or speedscope). The top functions by self time are printed at exit.
+"""
+import cProfile
+import datetime
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from types import FrameType
+from typing import Any, Counter as CounterType, Iterator, List, Optional
+
+from . import config
+
+SAMPLE_INTERVAL_S = 0.005
+DEFAULT_TOP_N = 20
+
+
+def add_profile_arguments(parser: Any) -> None:
+    """Adds the common `--profile` and `--profile_top` options to an argparse parser."""
+    parser.add_argument("--profile", action="store_true", help="Profile the run and write .pstats/.collapsed files to config.PROFILES_DIR.")
+    parser.add_argument("--profile_top", type=int, default=DEFAULT_TOP_N, help="Number of hot functions printed with --profile.")
+
+
+def _frame_label(frame: Any) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profiler:
+    """Runs cProfile on the calling thread and samples every thread's stack until `stop()`."""
+
+    def __init__(self, name: str, output_dir: Optional[Path] = None, interval: float = SAMPLE_INTERVAL_S, top_n: int = DEFAULT_TOP_N):
+        self.name = name
+        self.output_dir = Path(output_dir or config.PROFILES_DIR)
+        self.interval = interval
+        self.top_n = top_n
+        self.samples: CounterType[str] = Counter()
+        self._profile = cProfile.Profile()
+        self._stop_event = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    def _sample(self) -> None:
+        sampler_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, top_frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                stack: List[str] = []
+                frame: Optional[FrameType] = top_frame
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        """Starts tracing the calling thread and sampling all threads."""
+        self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+        self._sampler.start()
+        self._profile.enable()
+
+    def stop(self) -> Path:
+        """Stops profiling, writes the artifacts and prints the hot functions. Returns the .pstats path."""
+        self._profile.disable()
+        self._stop_event.set()
+        if self._sampler:
+            self._sampler.join()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        stem = f"{self.name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        pstats_path = self.output_dir / f"{stem}.pstats"
+        collapsed_path = self.output_dir / f"{stem}.collapsed"
+        self._profile.dump_stats(pstats_path)
+        with open(collapsed_path, 'w', encoding='utf-8') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+        self.print_hot_functions()
+        print(f"Profile saved to {pstats_path} (collapsed stacks: {collapsed_path})")
+        return pstats_path
+
+    def print_hot_functions(self) -> None:
+        """Prints the top functions by self time, with their call counts and cumulative time."""
+        # `Stats.stats` is the raw {function: (cc, nc, tt, ct, callers)} table, missing from the stubs
+        stats = pstats.Stats(self._profile).stats  # type: ignore[attr-defined]
+        rows = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:self.top_n]
+        print(f"\n--- Profile: top {len(rows)} functions by self time ---")
+        print(f"  {'self s':>9} {'cum s':>9} {'calls':>10}  function")
+        for (filename, lineno, func), (_, num_calls, self_time, cum_time, _) in rows:
+            location = f"{os.path.basename(filename)}:{lineno}" if lineno else filename
+            print(f"  {self_time:9.3f} {cum_time:9.3f} {num_calls:>10}  {func} ({location})")
+
+
+@contextmanager
+def profiled(name: str, enabled: bool = True, top_n: int = DEFAULT_TOP_N) -> Iterator[Optional[Profiler]]:
+    """Profiles the body when `enabled`; the artifacts are written even if the body raises or exits."""
+    if not enabled:
+        yield None
+        return
+    profiler = Profiler(name, top_n=top_n)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
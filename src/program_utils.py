@@ -1,5 +1,5 @@
 import re
-from sympy import simplify
+from typing import Any, Dict, List, Optional, Tuple
 
 all_ops = ["add", "subtract", "multiply", "divide", "exp", "greater"]
 
@@ -163,36 +163,166 @@ def dict_to_markdown_table(table_data: dict) -> str:
         print(f"Warning: Could not format table for a sample. Error: {e}")
         return str(table_data)
 
-def equal_program(program1, program2):
-    def symbol_recur(step, step_dict, sym_map):
+def _program_steps(program: List[str]) -> List[str]:
+    """Splits a tokenized program into its step strings (without the closing parenthesis)."""
+    return "|".join(program[:-1]).split(")")[:-1]
+
+def program_symbol_map(program: List[str]) -> Dict[str, str]:
+    """Maps each literal argument of a tokenized program to a sympy symbol name (a0, a1, ...)."""
+    sym_map: Dict[str, str] = {}
+    sym_ind = 0
+    for step in _program_steps(program):
+        step = step.strip() + ")"
+        op, args_str = step.split("(", 1)
+        args = args_str.strip(")").strip("|").strip().split("|")
+        for arg in args:
+            if "#" not in arg and arg not in sym_map: sym_map[arg] = f"a{sym_ind}"; sym_ind += 1
+    return sym_map
+
+def program_to_sympy(program: List[str], sym_map: Dict[str, str]) -> Any:
+    """
+    Returns the simplified sympy expression of a tokenized program's final step, with literals
+    replaced by the symbols in `sym_map`. Raises if the program is malformed or uses a literal
+    missing from `sym_map`.
+    """
+    # sympy is only needed for program equivalence; importing it here keeps it off the startup path
+    from sympy import simplify
+
+    def symbol_recur(step: str, step_dict: Dict[int, str]) -> str:
         op, args_str = step.split("(", 1)
         op = op.strip("|").strip()
         args = args_str.strip(")").strip("|").strip().split("|")
         arg1, arg2 = args[0].strip(), args[1].strip()
         
-        arg1_part = symbol_recur(step_dict[int(arg1[1:])], step_dict, sym_map) if "#" in arg1 else sym_map[arg1]
-        arg2_part = symbol_recur(step_dict[int(arg2[1:])], step_dict, sym_map) if "#" in arg2 else sym_map[arg2]
+        arg1_part = symbol_recur(step_dict[int(arg1[1:])], step_dict) if "#" in arg1 else sym_map[arg1]
+        arg2_part = symbol_recur(step_dict[int(arg2[1:])], step_dict) if "#" in arg2 else sym_map[arg2]
         
         op_map = {"add": "+", "subtract": "-", "multiply": "*", "divide": "/", "exp": "**", "greater": ">"}
         return f"( {arg1_part} {op_map[op]} {arg2_part} )"
 
-    try:
-        sym_map, sym_ind = {}, 0
-        p1_steps = "|".join(program1[:-1]).split(")")[:-1]
-        step_dict_1 = {i: s.strip() + ")" for i, s in enumerate(p1_steps)}
-
-        for step in step_dict_1.values():
-            op, args_str = step.split("(", 1)
-            args = args_str.strip(")").strip("|").strip().split("|")
-            for arg in args:
-                if "#" not in arg and arg not in sym_map: sym_map[arg] = f"a{sym_ind}"; sym_ind += 1
-        
-        p2_steps = "|".join(program2[:-1]).split(")")[:-1]
-        step_dict_2 = {i: s.strip() + ")" for i, s in enumerate(p2_steps)}
+    steps = _program_steps(program)
+    step_dict = {i: s.strip() + ")" for i, s in enumerate(steps)}
+    return simplify(symbol_recur(steps[-1] + ")", step_dict))
 
-        sym_prog1 = simplify(symbol_recur(p1_steps[-1] + ")", step_dict_1, sym_map))
-        sym_prog2 = simplify(symbol_recur(p2_steps[-1] + ")", step_dict_2, sym_map))
-        
-        return sym_prog1 == sym_prog2
+def equal_program(program1: List[str], program2: List[str]) -> bool:
+    """Checks whether two tokenized programs are symbolically equivalent, over program1's literals."""
+    try:
+        sym_map = program_symbol_map(program1)
+        return bool(program_to_sympy(program1, sym_map) == program_to_sympy(program2, sym_map))
     except Exception:
         return False
+
+# --- Program Repair ---
+# Deterministic fixes for slightly malformed model outputs, applied before execution so the
+# turn is not lost to eval_program's (1, "n/a").
+
+OP_CALL_PATTERN = re.compile(r"\b(" + "|".join(all_ops) + r")\s*\(", re.IGNORECASE)
+LEADING_VALUE_PATTERN = re.compile(r"^(?:-?\$?\s?\d[\d,]*(?:\.\d+)?%?|-?\.\d+%?|const_\w+)")
+LABEL_PATTERN = re.compile(r"^(?:correct\s+)?(?:program|answer)\s*:\s*", re.IGNORECASE)
+# ("call", op, arg1, arg2) or ("value", literal)
+Expression = Tuple[Any, ...]
+
+def _parse_program(text: str) -> Tuple[List[Expression], int]:
+    """
+    Parses a separator-normalized program into a list of expressions, where an expression is
+    ("call", op, arg1, arg2) with nested expressions allowed, or ("value", literal).
+    Returns (expressions, end) where `end` is where parsing stopped.
+    """
+    def parse_expr(pos: int) -> Tuple[Optional[Expression], int]:
+        match = OP_CALL_PATTERN.match(text, pos)
+        if match:
+            pos = match.end()
+            arg1, pos = parse_expr(pos)
+            if arg1 is None or not text.startswith(", ", pos):
+                return None, pos
+            arg2, pos = parse_expr(pos + 2)
+            if arg2 is None or not text.startswith(")", pos):
+                return None, pos
+            return ("call", match.group(1).lower(), arg1, arg2), pos + 1
+        end = pos
+        while end < len(text) and text[end] not in ",()":
+            end += 1
+        literal = text[pos:end].strip()
+        is_reference = literal.startswith("#") and literal[1:].isdigit()
+        if not literal or (not is_reference and str_to_num(literal) == "n/a"):
+            return None, pos
+        return ("value", literal), end
+
+    expressions: List[Expression] = []
+    pos = 0
+    while True:
+        expr, new_pos = parse_expr(pos)
+        if expr is None:
+            return expressions, pos
+        expressions.append(expr)
+        pos = new_pos
+        if not text.startswith(", ", pos):
+            return expressions, pos
+        pos += 2
+
+def _flatten_program(expressions: List[Expression]) -> str:
+    """Flattens nested calls into sequential `#n` steps, renumbering existing step references."""
+    steps: List[str] = []
+    step_map: Dict[int, int] = {}
+
+    def emit(expr: Expression) -> str:
+        if expr[0] == "value":
+            literal: str = expr[1]
+            if literal.startswith("#") and literal[1:].isdigit() and int(literal[1:]) in step_map:
+                return f"#{step_map[int(literal[1:])]}"
+            return literal
+        arg1, arg2 = emit(expr[2]), emit(expr[3])
+        steps.append(f"{expr[1]}({arg1}, {arg2})")
+        return f"#{len(steps) - 1}"
+
+    for index, expr in enumerate(expressions):
+        result = emit(expr)
+        if expr[0] == "value":
+            steps.append(result)
+        step_map[index] = len(steps) - 1
+    return ", ".join(steps)
+
+def repair_program(program_str: Any) -> Tuple[str, List[str]]:
+    """
+    Repairs common formatting mistakes in a predicted program: surrounding junk (code fences,
+    labels, trailing prose), non-standard separators, and nested calls, which are flattened
+    into `#n` steps. Returns (repaired_program, repairs) where `repairs` names the fixes that fired.
+    """
+    text = str(program_str).strip()
+
+    # --- 1. Strip code fences and labels; programs are a single line ---
+    stripped = LABEL_PATTERN.sub("", text.strip("`").strip()).strip("`").strip()
+    if stripped.lower().startswith("text\n"):
+        stripped = stripped[5:].strip()
+    stripped = stripped.splitlines()[0].strip() if stripped else stripped
+
+    first_call = OP_CALL_PATTERN.search(stripped)
+    if not first_call:
+        # A bare value: keep the leading number and drop any prose after it
+        value = LEADING_VALUE_PATTERN.match(stripped)
+        if not value:
+            return text, []
+        repaired = value.group(0).replace("$", "").strip()
+        return repaired, ["strip_junk"] if repaired != text else []
+
+    # --- 2. Normalize separators and operation names ---
+    candidate = stripped[first_call.start():]
+    normalized = re.sub(r"\s*,\s*", ", ", candidate)
+    normalized = re.sub(r"\(\s+", "(", normalized)
+    normalized = re.sub(r"\s+\)", ")", normalized)
+    normalized = OP_CALL_PATTERN.sub(lambda m: m.group(1).lower() + "(", normalized)
+
+    # --- 3. Parse, dropping trailing prose, and flatten nested calls ---
+    expressions, end = _parse_program(normalized)
+    if not expressions:
+        return text, []
+    repaired = _flatten_program(expressions)
+
+    repairs: List[str] = []
+    if first_call.start() > 0 or normalized[end:].strip() or stripped != text:
+        repairs.append("strip_junk")
+    if normalized != candidate:
+        repairs.append("normalize_separators")
+    if any(expr[0] == "call" and (expr[2][0] == "call" or expr[3][0] == "call") for expr in expressions):
+        repairs.append("flatten_nesting")
+    return repaired, repairs
@@ -0,0 +1,100 @@
+"""
+Prompt construction for the few-shot baseline models.
+
+Prompts are laid out for provider prefix caching: the static instructions and few-shot examples
+come first and are byte-identical for every call, then the document, which is identical for every
+turn of a conversation, and last the history and question. Each turn's prompt therefore starts
+with the previous turn's prompt up to the end of its history section.
+"""
+from typing import Any, List, Tuple
+
+def list_2d_to_markdown_table(table_data: List[List[str]]) -> str:
+    """
+    Converts a 2D table (list of lists) into markdown table format.
+    
+    Input: List of lists where first sublist is headers, rest are data rows
+    Example: [["Name", "Age"], ["Alice", "25"], ["Bob", "30"]]
+    
+    Output: Markdown-formatted table string
+    Example: "Name | Age\n--- | ---\nAlice | 25\nBob | 30"
+    """
+    if not table_data: return "No table provided."
+    try:
+        header = " | ".join(map(str, table_data[0]))
+        separator = " | ".join("---" for _ in table_data[0])
+        rows = [" | ".join(map(str, row)) for row in table_data[1:]]
+        return "\n".join([header, separator] + rows)
+    except Exception:
+        return "Error formatting table."
+
+def format_history_turn(turn_number: int, question: str, answer: Any, program: str) -> str:
+    """Formats one previous turn for the `Conversation History` section of the baseline prompt."""
+    return f"Turn {turn_number}:\nQ: {question}\nA: {answer}\nProgram: {program}\n\n"
+
+# --- Prompt Construction ---
+# Static part of the prompt: instructions and few-shot examples, identical for every call
+PROGRAM_GENERATION_INSTRUCTIONS = (
+    "You are a reasoning agent. Your task is to generate a single program string to answer the user's question based on the provided context and conversation history.\n\n"
+    "**CRITICAL RULES:**\n"
+    "1.  **Analyze Intent**: First, determine if the current question is a follow-up that uses the *result* of the previous turn, or if it is a new, independent question.\n"
+    "2.  **Program Construction**:\n"
+    "    - **If the question builds on the previous result** (e.g., 'what is the percentage change?'), you MUST copy the program from the previous turn (available in the history) and append the new operation.\n"
+    "    - **If the question is independent** (e.g., 'what about in 2008?'), you MUST start a new program from scratch.\n"
+    "3.  **Program Type**: Decide if the answer is a direct number from the text or requires a calculation.\n"
+    "    - If direct, the program is just the number (e.g., `306870`).\n"
+    "    - If calculation, you MUST use one of these 6 operations: `add`, `subtract`, `multiply`, `divide`, `exp`, `greater`.\n"
+    "4.  **Show Your Work**: Do NOT pre-calculate values. If the answer requires subtracting 50 from 100, the program must be `subtract(100, 50)`, not `50`.\n"
+    "5.  **Sequential Steps ONLY**: Do NOT nest operations. Programs must be a sequence of single operations separated by commas.\n"
+    "6.  **Use Step References**: For multi-step calculations, you MUST use the `#n` syntax to refer to the result of a previous step.\n"
+    "7.  **Subtraction Order**: The `subtract(a, b)` operation computes `a - b`. For 'the change from 2007 to 2008', if 2007 is 100 and 2008 is 120, the program is `subtract(120, 100)`.\n\n"
+    "**CORRECT, SEQUENTIAL FORMAT EXAMPLE:**\n"
+    "To calculate `(100 - 50) / 50`, the program MUST be: `subtract(100, 50), divide(#0, 50)`\n\n"
+    "**INCORRECT, NESTED FORMAT EXAMPLE:**\n"
+    "`divide(subtract(100, 50), 50)` <-- DO NOT DO THIS.\n\n"
+    "**INCORRECT, PRE-CALCULATED EXAMPLE:**\n"
+    "`divide(50, 50)` <-- DO NOT DO THIS.\n\n"
+    "--- FEW-SHOT EXAMPLES ---\n\n"
+    "**Example 1:**\n"
+    "Conversation History:\n"
+    "Turn 1:\nQ: what is the net change in rent expense from 2003 to 2004?\nA: 4785000.0\nProgram: subtract(118741000, 113956000)\n\n"
+    "Current Question: what percentage change does this represent?\n"
+    "Correct Program: subtract(118741000, 113956000), divide(#0, 113956000)\n\n"
+    "**Example 2:**\n"
+    "Conversation History:\n"
+    "Turn 1:\nQ: what was the total number of shares purchased in 11/07?\nA: 2891719.0\nProgram: 2891719\n\nTurn 2:\nQ: and the average price paid per share for that time?\nA: 44.16\nProgram: 44.16\n\nTurn 3:\nQ: so what was the total amount paid for these shares?\nA: 127698311.04\nProgram: multiply(2891719, 44.16)\n\n"
+    "Current Question: and converted to the hundreds?\n"
+    "Correct Program: multiply(2891719, 44.16), divide(#0, const_1000000)\n\n"
+    "--- END OF EXAMPLES ---\n\n"
+    "**YOUR TASK:**\n"
+    "Construct a single program string for the current turn. Your output MUST be ONLY the program string and nothing else.\n\n"
+)
+
+def format_document_context(pre_text: str, table_str: str, post_text: str) -> str:
+    """Formats the document part of the prompt, identical for every turn of a conversation."""
+    return (
+        f"== Pre-Table Context ==\n{pre_text}\n\n"
+        f"== Table Data ==\n{table_str}\n\n"
+        f"== Post-Table Context ==\n{post_text}\n\n"
+    )
+
+def format_turn_request(history: str, question: str) -> str:
+    """Formats the per-turn part of the prompt: the history so far and the current question."""
+    return (
+        f"== Conversation History (Question, Answer, and Program) ==\n{history if history else 'No history yet.'}\n\n"
+        f"== Current Question ==\n{question}\n\n"
+        "Program:"
+    )
+
+def construct_program_generation_prompt(pre_text: str, table_str: str, post_text: str, history: str, question: str) -> str:
+    return PROGRAM_GENERATION_INSTRUCTIONS + format_document_context(pre_text, table_str, post_text) + format_turn_request(history, question)
+
+def construct_program_generation_messages(pre_text: str, table_str: str, post_text: str, history: str, question: str) -> List[Tuple[str, str]]:
+    """
+    Same content as `construct_program_generation_prompt`, as (role, content) chat messages:
+    the instructions as the system message, then the document, then the history and question.
+    """
+    return [
+        ("system", PROGRAM_GENERATION_INSTRUCTIONS),
+        ("human", format_document_context(pre_text, table_str, post_text)),
+        ("human", format_turn_request(history, question)),
+    ]
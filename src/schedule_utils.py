@@ -0,0 +1,132 @@
+"""
+Document-locality scheduling of conversations.
+
+ConvFinQA ids such as `Single_JKHY/2009/page_28.pdf-1`, `-2` and `-3` are separate conversations
+over the same filing page, and so is `Double_JKHY/2009/page_28.pdf` when a type II conversation
+was written over that page too. Running them back to back on the same worker and client keeps the
+page's rendered prompt in the local `RenderCache` and its prompt prefix in the provider's cache.
+Callers reorder work with `group_by_document` and write outputs back in the original order, so
+scheduling never changes what is written.
+"""
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from . import metrics_utils
+
+CONVERSATION_SUFFIX_PATTERN = re.compile(r"-\d+$")
+CONVERSATION_TYPE_PATTERN = re.compile(r"^(?:Single|Double)_")
+
+
+def document_key(record_id: Any) -> str:
+    """
+    Returns the filing page of a conversation id, without its type prefix and conversation number:
+    'Single_JKHY/2009/page_28.pdf-3' and 'Double_JKHY/2009/page_28.pdf' -> 'JKHY/2009/page_28.pdf'.
+    """
+    return CONVERSATION_TYPE_PATTERN.sub("", CONVERSATION_SUFFIX_PATTERN.sub("", str(record_id)))
+
+
+def group_by_document(items: Iterable[Dict[str, Any]]) -> Dict[str, List[int]]:
+    """Maps each document key to the positions of its conversations, in order of first appearance."""
+    groups: Dict[str, List[int]] = {}
+    for position, item in enumerate(items):
+        groups.setdefault(document_key(item.get('id')), []).append(position)
+    return groups
+
+
+def locality_order(items: List[Dict[str, Any]]) -> List[int]:
+    """Positions of `items` with the conversations of each document next to each other."""
+    return [position for positions in group_by_document(items).values() for position in positions]
+
+
+class RenderCache:
+    """
+    LRU cache of the rendered document part of a prompt, keyed by the document's content.
+    Lookups are counted per document group, and as `prompt_render` cache hits in the metrics.
+    """
+
+    def __init__(self, render: Callable[[Dict[str, Any]], str], maxsize: int = 256):
+        self.render = render
+        self.maxsize = maxsize
+        self._cache: "OrderedDict[Tuple[str, str, str], str]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Document key -> [hits, lookups]
+        self.stats: Dict[Optional[str], List[int]] = defaultdict(lambda: [0, 0])
+
+    @staticmethod
+    def _key(doc: Dict[str, Any]) -> Tuple[str, str, str]:
+        return doc.get('pre_text', ''), doc.get('post_text', ''), repr(doc.get('table', {}))
+
+    def get(self, doc: Dict[str, Any], group: Optional[str] = None) -> str:
+        """Returns the rendered document, counting the lookup under `group` (a `document_key`)."""
+        key = self._key(doc)
+        with self._lock:
+            rendered = self._cache.get(key)
+            if rendered is not None:
+                self._cache.move_to_end(key)
+            stats = self.stats[group]
+            stats[0] += rendered is not None
+            stats[1] += 1
+        metrics_utils.record_cache("prompt_render", rendered is not None)
+        if rendered is None:
+            rendered = self.render(doc)
+            with self._lock:
+                self._cache[key] = rendered
+                if len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+        return rendered
+
+
+def locality_report(items: List[Dict[str, Any]], render_cache: Optional[RenderCache] = None) -> Dict[str, Any]:
+    """
+    Per-document-group render cache hits and, when metrics are on, LLM calls with their prompt
+    tokens and the share served from the provider's prefix cache. Groups of a single
+    conversation can only hit across turns; the gain of grouping shows in the larger ones.
+    """
+    calls_by_group: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for call in metrics_utils.llm_calls():
+        if call.get('sample_id') is not None:
+            calls_by_group[document_key(call['sample_id'])].append(call)
+
+    groups: Dict[str, Dict[str, Any]] = {}
+    for key, positions in group_by_document(items).items():
+        hits, lookups = render_cache.stats.get(key, (0, 0)) if render_cache else (0, 0)
+        calls = calls_by_group.get(key, [])
+        input_tokens = sum(call['input_tokens'] for call in calls)
+        cached_tokens = sum(call['cached_input_tokens'] for call in calls)
+        groups[key] = {
+            "conversations": len(positions),
+            "render_hits": hits,
+            "render_lookups": lookups,
+            "llm_calls": len(calls),
+            "input_tokens": input_tokens,
+            "cached_input_tokens": cached_tokens,
+            "cached_share": cached_tokens / input_tokens if input_tokens else 0.0,
+        }
+
+    def total(selected: List[Dict[str, Any]]) -> Dict[str, Any]:
+        summed = {name: sum(group[name] for group in selected) for name in ("conversations", "render_hits", "render_lookups", "llm_calls", "input_tokens", "cached_input_tokens")}
+        summed["groups"] = len(selected)
+        summed["render_hit_rate"] = summed["render_hits"] / summed["render_lookups"] if summed["render_lookups"] else 0.0
+        summed["cached_share"] = summed["cached_input_tokens"] / summed["input_tokens"] if summed["input_tokens"] else 0.0
+        return summed
+
+    return {
+        "total": total(list(groups.values())),
+        "multi_conversation_groups": total([group for group in groups.values() if group["conversations"] > 1]),
+        "single_conversation_groups": total([group for group in groups.values() if group["conversations"] == 1]),
+        "groups": groups,
+    }
+
+
+def print_locality_report(report: Dict[str, Any]) -> None:
+    """Prints the render hit rate and cached prompt share of all, multi- and single-conversation groups."""
+    print("\n--- Document Locality ---")
+    for name in ("total", "multi_conversation_groups", "single_conversation_groups"):
+        summary = report[name]
+        line = (f"  - {name.replace('_', ' ')}: {summary['groups']} groups, {summary['conversations']} conversations, "
+                f"render hit rate {summary['render_hit_rate'] * 100:.1f}%")
+        if summary["llm_calls"]:
+            line += f", {summary['llm_calls']} LLM calls, cached prompt tokens {summary['cached_share'] * 100:.1f}%"
+        print(line)
@@ -0,0 +1,220 @@
+"""
+Horizontal sharding of inference and evaluation runs across machines, without a coordinator.
+
+Records are assigned to shards by a stable hash of their document id (`document_key`: the id without
+its type prefix and conversation number), so every worker computes the same partition on its own and the
+conversations of a document stay on one worker. A shard is written to `<stem>.shard-<i>-of-<N><suffix>` next to the
+single-node output, and `scripts/merge_shards.py` combines the shard files into the single-node
+output. Instead of a fixed `--shard i/N`, workers can claim shards from a `ShardQueue`, a SQLite
+file on a shared filesystem whose leases expire when a worker stops renewing them, so idle
+workers pick up the shards of crashed or slow ones. A shard whose lease expires
+`max_attempts` times is marked failed rather than handed out again.
+"""
+import argparse
+import hashlib
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .schedule_utils import document_key
+
+Shard = Tuple[int, int]
+
+SHARD_SUFFIX_PATTERN = re.compile(r"\.shard-(\d+)-of-(\d+)$")
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+def parse_shard(spec: str) -> Shard:
+    """Parses 'i/N' (0 <= i < N) into (i, N)."""
+    match = re.fullmatch(r"(\d+)/(\d+)", spec.strip())
+    if not match:
+        raise ValueError(f"Invalid shard '{spec}', expected 'i/N'")
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{spec}', expected 0 <= i < N")
+    return index, count
+
+
+def shard_argument(spec: str) -> Shard:
+    """`parse_shard` as an argparse type, so an invalid --shard is reported as a usage error."""
+    try:
+        return parse_shard(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from e
+
+
+def shard_of(record_id: str, count: int) -> int:
+    """Returns the shard of a record id. Stable across processes and machines, unlike hash()."""
+    digest = hashlib.sha1(str(record_id).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def in_shard(record_id: str, shard: Optional[Shard]) -> bool:
+    """Checks whether a record belongs to `shard` (always true for a single-node run)."""
+    return shard is None or shard_of(document_key(record_id), shard[1]) == shard[0]
+
+
+def filter_shard(records: Iterable[Dict[str, Any]], shard: Optional[Shard]) -> List[Dict[str, Any]]:
+    """Keeps the records of one shard, in their original order."""
+    return [record for record in records if in_shard(record.get('id', ''), shard)]
+
+
+def shard_path(path: Any, shard: Optional[Shard]) -> Path:
+    """'preds.json' -> 'preds.shard-0-of-4.json'; unchanged when `shard` is None."""
+    output_path = Path(path)
+    if shard is None:
+        return output_path
+    return output_path.with_name(f"{output_path.stem}.shard-{shard[0]}-of-{shard[1]}{output_path.suffix}")
+
+
+def shard_from_path(path: Any) -> Optional[Shard]:
+    """Reads (i, N) back from a shard file name, or None if it is not one."""
+    match = SHARD_SUFFIX_PATTERN.search(Path(path).stem)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def check_complete(shards: List[Shard]) -> int:
+    """Checks that the shards are exactly 0..N-1 of the same N, and returns N."""
+    counts = {count for _, count in shards}
+    if len(counts) != 1:
+        raise ValueError(f"Shards come from different partitions: {sorted(shards)}")
+    count = counts.pop()
+    indexes = sorted(index for index, _ in shards)
+    if indexes != list(range(count)):
+        missing = sorted(set(range(count)) - set(indexes))
+        raise ValueError(f"Incomplete or duplicated shards of {count}: have {indexes}, missing {missing}")
+    return count
+
+
+class ShardQueue:
+    """
+    Work queue of the N shards of a run in a SQLite file. `claim()` leases the next pending shard,
+    or one whose lease has expired; the lease is renewed while the shard runs and the shard is
+    marked done when it finishes. A shard whose worker dies is claimed again after `lease_seconds`,
+    up to `max_attempts` claims in all; after that it is marked 'failed'.
+    """
+
+    def __init__(self, path: Any, num_shards: int, lease_seconds: float = DEFAULT_LEASE_SECONDS, worker_id: Optional[str] = None,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.path = str(path)
+        self.num_shards = num_shards
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS shards (shard INTEGER PRIMARY KEY, num_shards INTEGER NOT NULL, "
+                         "status TEXT NOT NULL, owner TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0)")
+            conn.executemany("INSERT OR IGNORE INTO shards (shard, num_shards, status) VALUES (?, ?, 'pending')",
+                             [(i, num_shards) for i in range(num_shards)])
+            other = conn.execute("SELECT DISTINCT num_shards FROM shards WHERE num_shards != ?", (num_shards,)).fetchone()
+        if other:
+            raise ValueError(f"Queue {self.path} was created for {other[0]} shards, not {num_shards}")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def claim(self) -> Optional[int]:
+        """Leases a shard to this worker and returns its index, or None when none is available."""
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            # A shard that keeps losing its workers (e.g. it crashes them) is not handed out forever
+            conn.execute("UPDATE shards SET status = 'failed', owner = NULL, lease_expires = NULL "
+                         "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?", (now, self.max_attempts))
+            row = conn.execute(
+                "SELECT shard FROM shards WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY status = 'leased', shard LIMIT 1", (now,)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE shards SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE shard = ?",
+                             (self.worker_id, now + self.lease_seconds, row[0]))
+            conn.execute("COMMIT")
+        return row[0] if row else None
+
+    def renew(self, shard: int) -> None:
+        """Extends this worker's lease on `shard`; a no-op if the lease has been lost."""
+        with closing(self._connect()) as conn:
+            conn.execute("UPDATE shards SET lease_expires = ? WHERE shard = ? AND owner = ? AND status = 'leased'",
+                         (time.time() + self.lease_seconds, shard, self.worker_id))
+
+    def complete(self, shard: int) -> bool:
+        """
+        Marks `shard` done if this worker still holds its lease. Returns False when the lease was
+        lost (it expired and the shard was claimed again, or marked failed); the shard is left as is.
+        """
+        with closing(self._connect()) as conn:
+            cursor = conn.execute("UPDATE shards SET status = 'done', lease_expires = NULL WHERE shard = ? AND owner = ? AND status = 'leased'",
+                                  (shard, self.worker_id))
+            return cursor.rowcount == 1
+
+    def status(self) -> Dict[str, int]:
+        """Returns the number of shards per status."""
+        with closing(self._connect()) as conn:
+            return {status: count for status, count in conn.execute("SELECT status, COUNT(*) FROM shards GROUP BY status")}
+
+    def claims(self) -> Iterator[Shard]:
+        """
+        Yields (i, N) for each shard this worker claims, renewing the lease from a background thread
+        while the caller works on it. A shard is marked done when the caller asks for the next one.
+        """
+        while True:
+            claimed = self.claim()
+            if claimed is None:
+                return
+            shard = claimed
+            stop = threading.Event()
+
+            def heartbeat(shard: int = shard, stop: threading.Event = stop) -> None:
+                while not stop.wait(self.lease_seconds / 3):
+                    self.renew(shard)
+
+            thread = threading.Thread(target=heartbeat, name=f"shard-lease-{shard}", daemon=True)
+            thread.start()
+            try:
+                yield shard, self.num_shards
+            finally:
+                stop.set()
+                thread.join()
+            if not self.complete(shard):
+                print(f"Warning: lost the lease on shard {shard}/{self.num_shards} before finishing it; another worker owns it now.")
+
+
+def add_shard_arguments(parser: Any) -> None:
+    """Adds the common `--shard`, `--shard_queue`, `--num_shards`, `--lease_seconds` and `--max_attempts` options."""
+    parser.add_argument("--shard", type=shard_argument, help="Process only shard i/N (0-based) of the records, partitioned by a hash of the document id.")
+    parser.add_argument("--shard_queue", type=str, help="SQLite work queue shared by workers; claim and process shards until none is left.")
+    parser.add_argument("--num_shards", type=int, help="Number of shards of a --shard_queue run.")
+    parser.add_argument("--lease_seconds", type=float, default=DEFAULT_LEASE_SECONDS, help="Seconds before a queued shard of an unresponsive worker can be claimed by another.")
+    parser.add_argument("--max_attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="Claims of a queued shard before it is marked failed instead of being handed out again.")
+
+
+def check_shard_arguments(parser: Any, args: Any) -> None:
+    """Rejects inconsistent `add_shard_arguments` options with a usage error."""
+    if args.shard and args.shard_queue:
+        parser.error("--shard and --shard_queue cannot be combined")
+    if args.shard_queue and not args.num_shards:
+        parser.error("--shard_queue requires --num_shards")
+    if args.num_shards is not None and args.num_shards < 1:
+        parser.error("--num_shards must be at least 1")
+
+
+def iter_shards(args: Any) -> Iterator[Optional[Shard]]:
+    """Yields the shards to process for parsed `add_shard_arguments` options (None for a single-node run)."""
+    if args.shard_queue:
+        queue = ShardQueue(args.shard_queue, args.num_shards, args.lease_seconds, max_attempts=args.max_attempts)
+        for shard in queue.claims():
+            print(f"Claimed shard {shard[0]}/{shard[1]} from {args.shard_queue}")
+            yield shard
+        print(f"No shards left to claim: {queue.status()}")
+    elif args.shard:
+        yield args.shard
+    else:
+        yield None
@@ -0,0 +1,71 @@
+import random
+
+import pytest
+
+from src.eval_utils import ConfidenceSequence, stratified_order, wilson_interval
+
+
+def bernoulli_sequence(p: float, n: int, seed: int) -> ConfidenceSequence:
+    rng = random.Random(seed)
+    sequence = ConfidenceSequence(0.0, 1.0)
+    for _ in range(n):
+        sequence.update(1.0 if rng.random() < p else 0.0)
+    return sequence
+
+
+def test_confidence_sequence_covers_the_mean_at_every_look() -> None:
+    misses = 0
+    for seed in range(100):
+        rng = random.Random(seed)
+        sequence = ConfidenceSequence(0.0, 1.0, alpha=0.05)
+        for _ in range(200):
+            sequence.update(1.0 if rng.random() < 0.3 else 0.0)
+            low, high = sequence.interval()
+            if not low <= 0.3 <= high:
+                misses += 1
+                break
+    # Anytime-valid at alpha = 0.05: at most ~5% of runs may ever exclude the mean
+    assert misses <= 5
+
+
+def test_confidence_sequence_intervals_only_shrink_and_stay_in_range() -> None:
+    rng = random.Random(0)
+    sequence = ConfidenceSequence(-1.0, 1.0)
+    previous = (-1.0, 1.0)
+    for _ in range(500):
+        sequence.update(rng.uniform(-0.2, 0.6))
+        low, high = sequence.interval()
+        assert previous[0] <= low <= high <= previous[1]
+        previous = (low, high)
+    assert sequence.count == 500
+    assert low <= sequence.mean <= high
+    assert high - low < 0.2
+
+
+def test_confidence_sequence_width_adapts_to_variance() -> None:
+    constant = ConfidenceSequence(0.0, 1.0)
+    for _ in range(300):
+        constant.update(0.5)
+    noisy = bernoulli_sequence(0.5, 300, seed=1)
+
+    constant_low, constant_high = constant.interval()
+    noisy_low, noisy_high = noisy.interval()
+    assert constant_high - constant_low < noisy_high - noisy_low
+
+
+def test_wilson_interval() -> None:
+    assert wilson_interval(0, 0) == (0.0, 1.0)
+    low, high = wilson_interval(50, 100)
+    assert low == pytest.approx(0.4038, abs=1e-4) and high == pytest.approx(0.5962, abs=1e-4)
+
+
+def test_stratified_order_is_seeded_and_keeps_strata_balanced() -> None:
+    items = [{"id": str(i), "features": {"num_dialogue_turns": 2 + i % 2, "has_type2_question": False}, "dialogue": {"turn_program": []}} for i in range(100)]
+
+    order = stratified_order(items, seed=3)
+    assert order == stratified_order(items, seed=3)
+    assert sorted(item["id"] for item in order) == sorted(item["id"] for item in items)
+    # Every prefix holds both strata in close to their 50/50 share
+    for prefix in (10, 20, 50):
+        three_turns = sum(item["features"]["num_dialogue_turns"] == 3 for item in order[:prefix])
+        assert abs(three_turns - prefix / 2) <= 1
@@ -0,0 +1,61 @@
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from src.history_utils import ConversationHistory
+
+
+def make_history(num_turns: int, keep_turns: int = 2, token_budget: int = 10_000) -> ConversationHistory:
+    history = ConversationHistory("Document text.", keep_turns=keep_turns, token_budget=token_budget)
+    for i in range(num_turns):
+        history.add_turn(f"What is value {i}?", f"add({i}, 1)", i + 1)
+    return history
+
+
+def test_recent_turns_verbatim_older_turns_summarized() -> None:
+    history = make_history(4, keep_turns=2)
+    messages = history.build_messages("Next question?")
+
+    assert isinstance(messages[0], SystemMessage)
+    assert messages[1].content == "Earlier turns (program = executed value):\nTurn 1: add(0, 1) = 1\nTurn 2: add(1, 1) = 2"
+    assert [type(m) for m in messages[2:]] == [HumanMessage, AIMessage, HumanMessage, AIMessage, HumanMessage]
+    assert [m.content for m in messages[2:]] == ["What is value 2?", "add(2, 1)", "What is value 3?", "add(3, 1)", "Next question?"]
+    assert history.last_stats["turns_verbatim"] == 2
+    assert history.last_stats["turns_summarized"] == 2
+    assert history.last_stats["turns_dropped"] == 0
+    assert history.last_stats["tokens_saved"] > 0
+
+
+def test_no_summary_when_all_turns_fit_the_window() -> None:
+    history = make_history(2, keep_turns=3)
+    messages = history.build_messages("Next question?")
+
+    assert len(messages) == 6
+    assert history.last_stats["tokens_saved"] == 0
+    assert history.last_stats["tokens_sent"] == history.last_stats["tokens_full"]
+
+
+def test_budget_summarizes_verbatim_turns_then_drops_oldest_summaries() -> None:
+    roomy = make_history(6, keep_turns=6)
+    roomy.build_messages("Next question?")
+    full = roomy.last_stats["tokens_full"]
+
+    # Tight enough that every turn is summarized
+    squeezed = make_history(6, keep_turns=6, token_budget=full - 1)
+    squeezed.build_messages("Next question?")
+    assert squeezed.last_stats["turns_verbatim"] < 6
+    assert squeezed.last_stats["tokens_sent"] <= full - 1
+
+    # Below the size of all summaries together: the oldest summary lines go first
+    minimal = make_history(6, keep_turns=6, token_budget=1)
+    messages = minimal.build_messages("Next question?")
+    assert minimal.last_stats["turns_verbatim"] == 0
+    assert minimal.last_stats["turns_dropped"] == 6
+    assert [type(m) for m in messages] == [SystemMessage, HumanMessage]
+
+
+def test_keep_turns_zero_sends_only_summaries() -> None:
+    history = make_history(3, keep_turns=0)
+    messages = history.build_messages("Next question?")
+
+    assert history.last_stats["turns_verbatim"] == 0
+    assert messages[1].content.endswith("Turn 3: add(2, 1) = 3")
+    assert messages[-1].content == "Next question?"
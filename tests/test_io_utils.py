@@ -0,0 +1,88 @@
+import gzip
+import json
+from pathlib import Path
+from typing import Any, List
+
+import pytest
+
+from src.io_utils import GoldIndex, iter_records
+
+RECORDS: List[Any] = [
+    {"id": "a-1", "value": 123456789.125, "nested": {"list": [1, 2, [3]], "text": "brackets ] and , commas"}},
+    {"id": "a-2", "value": -0.5, "nested": {}},
+    {"id": "b", "value": 1e-7, "unicode": "café – €"},
+]
+
+
+@pytest.fixture(params=[1, 3, 64, 1 << 20], ids=lambda size: f"chunk{size}")
+def chunk_size(request: pytest.FixtureRequest, monkeypatch: pytest.MonkeyPatch) -> int:
+    # Tiny chunks split numbers, strings and separators across buffer refills
+    monkeypatch.setattr("src.io_utils.CHUNK_SIZE", request.param)
+    return int(request.param)
+
+
+def test_json_list(tmp_path: Path, chunk_size: int) -> None:
+    path = tmp_path / "records.json"
+    path.write_text(json.dumps(RECORDS, indent=2), encoding="utf-8")
+
+    assert list(iter_records(path)) == RECORDS
+
+
+def test_json_dict_of_splits_yields_every_split_in_order(tmp_path: Path, chunk_size: int) -> None:
+    path = tmp_path / "splits.json"
+    path.write_text(json.dumps({"train": RECORDS[:2], "empty": [], "dev": RECORDS[2:]}), encoding="utf-8")
+
+    assert list(iter_records(path)) == RECORDS
+
+
+def test_empty_list(tmp_path: Path, chunk_size: int) -> None:
+    path = tmp_path / "empty.json"
+    path.write_text(" [ ] ", encoding="utf-8")
+
+    assert list(iter_records(path)) == []
+
+
+def test_jsonl_skips_blank_lines(tmp_path: Path) -> None:
+    path = tmp_path / "records.jsonl"
+    path.write_text("\n".join(json.dumps(record) for record in RECORDS) + "\n\n", encoding="utf-8")
+
+    assert list(iter_records(path)) == RECORDS
+
+
+def test_compressed_files(tmp_path: Path) -> None:
+    gz_path = tmp_path / "records.json.gz"
+    with gzip.open(gz_path, "wt", encoding="utf-8") as f:
+        json.dump(RECORDS, f)
+    assert list(iter_records(gz_path)) == RECORDS
+
+    zstandard = pytest.importorskip("zstandard")
+    zst_path = tmp_path / "records.jsonl.zst"
+    zst_path.write_bytes(zstandard.ZstdCompressor().compress("\n".join(json.dumps(r) for r in RECORDS).encode("utf-8")))
+    assert list(iter_records(zst_path)) == RECORDS
+
+
+def test_truncated_file_raises(tmp_path: Path) -> None:
+    path = tmp_path / "truncated.json"
+    path.write_text(json.dumps(RECORDS)[:-20], encoding="utf-8")
+
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_records(path))
+
+
+def test_gold_index_is_rebuilt_when_the_gold_file_changes(tmp_path: Path) -> None:
+    gold_path = tmp_path / "gold.json"
+    gold_path.write_text(json.dumps(RECORDS), encoding="utf-8")
+    index_path = tmp_path / "gold.sqlite"
+
+    index = GoldIndex(gold_path, index_path)
+    assert index.rebuilt and len(index) == 3 and index.get("b") == RECORDS[2] and index.get("missing") is None
+    index.close()
+
+    index = GoldIndex(gold_path, index_path)
+    assert not index.rebuilt
+    index.close()
+
+    gold_path.write_text(json.dumps(RECORDS[:1]), encoding="utf-8")
+    index = GoldIndex(gold_path, index_path)
+    assert index.rebuilt and len(index) == 1
+    index.close()
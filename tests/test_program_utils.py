@@ -0,0 +1,45 @@
+from typing import List
+
+import pytest
+
+from src.program_utils import eval_program, program_tokenization, repair_program
+
+
+def execute(program: str) -> object:
+    return eval_program(program_tokenization(program))[1]
+
+
+@pytest.mark.parametrize("program", ["subtract(5, 3), divide(#0, 3)", "add(1, 2)", "12.5", "const_100"])
+def test_well_formed_programs_are_unchanged(program: str) -> None:
+    assert repair_program(program) == (program, [])
+
+
+@pytest.mark.parametrize("raw, expected, repairs", [
+    ("Program: subtract(5,3)", "subtract(5, 3)", ["strip_junk", "normalize_separators"]),
+    ("```\nadd(1, 2)\n```", "add(1, 2)", ["strip_junk"]),
+    ("add(1, 2) and then some", "add(1, 2)", ["strip_junk"]),
+    ("Add( 1 , 2 )", "add(1, 2)", ["normalize_separators"]),
+    ("$ 12.5 million", "12.5", ["strip_junk"]),
+])
+def test_formatting_repairs(raw: str, expected: str, repairs: List[str]) -> None:
+    assert repair_program(raw) == (expected, repairs)
+
+
+def test_nested_calls_are_flattened_into_steps() -> None:
+    repaired, repairs = repair_program("divide(subtract(5, 3), 3)")
+
+    assert repaired == "subtract(5, 3), divide(#0, 3)"
+    assert repairs == ["flatten_nesting"]
+    assert execute(repaired) == execute("subtract(5, 3), divide(#0, 3)")
+
+
+def test_flattening_renumbers_existing_step_references() -> None:
+    repaired, _ = repair_program("subtract(5, 3), divide(#0, add(1, 2))")
+
+    assert repaired == "subtract(5, 3), add(1, 2), divide(#0, #1)"
+    assert execute(repaired) == pytest.approx(2 / 3, abs=1e-4)
+
+
+@pytest.mark.parametrize("raw", ["no idea", "The answer is 42", ""])
+def test_unrepairable_output_is_returned_as_is(raw: str) -> None:
+    assert repair_program(raw) == (raw, [])
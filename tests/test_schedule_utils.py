@@ -0,0 +1,44 @@
+from typing import Any, Dict
+
+from src.schedule_utils import RenderCache, document_key, group_by_document, locality_order, locality_report
+from src.shard_utils import shard_of
+
+
+def test_document_key_strips_type_prefix_and_conversation_number() -> None:
+    assert document_key("Single_JKHY/2009/page_28.pdf-3") == "JKHY/2009/page_28.pdf"
+    assert document_key("Double_JKHY/2009/page_28.pdf") == "JKHY/2009/page_28.pdf"
+    assert document_key("JKHY/2009/page_28.pdf") == "JKHY/2009/page_28.pdf"
+    # Only a trailing conversation number is a suffix
+    assert document_key("Single_ETR/2016/page_403.pdf-12") == "ETR/2016/page_403.pdf"
+    assert document_key("Single_A-B/2016/page_4.pdf") == "A-B/2016/page_4.pdf"
+
+
+def test_single_and_double_conversations_of_a_page_are_grouped_and_sharded_together() -> None:
+    items = [{"id": "Single_MAA/2017/page_89.pdf-1"}, {"id": "Single_X/2010/page_1.pdf-1"}, {"id": "Double_MAA/2017/page_89.pdf"}]
+
+    assert group_by_document(items) == {"MAA/2017/page_89.pdf": [0, 2], "X/2010/page_1.pdf": [1]}
+    assert locality_order(items) == [0, 2, 1]
+    assert shard_of(document_key(items[0]["id"]), 8) == shard_of(document_key(items[2]["id"]), 8)
+
+
+def test_render_cache_reuses_renders_and_reports_hits_per_group() -> None:
+    renders = []
+
+    def render(doc: Dict[str, Any]) -> str:
+        renders.append(doc)
+        return f"{doc['pre_text']}|{doc['table']}"
+
+    cache = RenderCache(render, maxsize=1)
+    page = {"pre_text": "p", "post_text": "", "table": {"a": {"b": 1}}}
+    other = {"pre_text": "q", "post_text": "", "table": {}}
+    items = [{"id": "Single_MAA/2017/page_89.pdf-1"}, {"id": "Double_MAA/2017/page_89.pdf"}, {"id": "Single_X/2010/page_1.pdf-1"}]
+    for item, doc in zip(items, [page, dict(page), other]):
+        cache.get(doc, document_key(item["id"]))
+    cache.get(page, "MAA/2017/page_89.pdf")
+
+    assert len(renders) == 3  # `other` evicted `page` from the one-entry cache
+    report = locality_report(items, cache)
+    assert report["groups"]["MAA/2017/page_89.pdf"]["render_hits"] == 1
+    assert report["groups"]["MAA/2017/page_89.pdf"]["render_lookups"] == 3
+    assert report["multi_conversation_groups"]["groups"] == 1
+    assert report["single_conversation_groups"]["render_lookups"] == 1
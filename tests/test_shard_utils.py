@@ -0,0 +1,123 @@
+import argparse
+import json
+import time
+from pathlib import Path
+from types import ModuleType
+from typing import Callable
+
+import pytest
+
+from src.shard_utils import (ShardQueue, add_shard_arguments, check_complete, check_shard_arguments, filter_shard, iter_shards,
+                             parse_shard, shard_from_path, shard_of, shard_path)
+
+
+def test_parse_shard() -> None:
+    assert parse_shard(" 2/4 ") == (2, 4)
+    for spec in ["4/4", "1", "a/b", "-1/2"]:
+        with pytest.raises(ValueError):
+            parse_shard(spec)
+
+
+def test_invalid_shard_options_are_usage_errors() -> None:
+    parser = argparse.ArgumentParser()
+    add_shard_arguments(parser)
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--shard", "4/4"])
+    with pytest.raises(SystemExit):
+        check_shard_arguments(parser, parser.parse_args(["--shard_queue", "queue.sqlite"]))
+    args = parser.parse_args(["--shard", "1/4"])
+    check_shard_arguments(parser, args)
+    assert list(iter_shards(args)) == [(1, 4)]
+
+
+def test_conversations_of_a_document_share_a_shard() -> None:
+    records = [{"id": f"Single_ABC/2010/page_{page}.pdf-{k}"} for page in range(50) for k in (1, 2, 3)]
+    shards = [filter_shard(records, (i, 4)) for i in range(4)]
+
+    assert all(shards)
+    assert sum(len(shard) for shard in shards) == len(records)
+    for shard in shards:
+        pages = {record["id"].rsplit("-", 1)[0] for record in shard}
+        assert len(shard) == 3 * len(pages)
+    # Stable across processes: a fixed digest, not hash()
+    assert shard_of("Single_ABC/2010/page_1.pdf", 1000) == shard_of("Single_ABC/2010/page_1.pdf", 1000)
+
+
+def test_shard_paths_round_trip_and_completeness() -> None:
+    path = shard_path("outputs/preds.json", (2, 4))
+    assert path.name == "preds.shard-2-of-4.json"
+    assert shard_from_path(path) == (2, 4)
+    assert shard_from_path("preds.json") is None
+    assert shard_path("preds.json", None) == Path("preds.json")
+
+    assert check_complete([(1, 3), (0, 3), (2, 3)]) == 3
+    with pytest.raises(ValueError):
+        check_complete([(0, 3), (2, 3)])
+    with pytest.raises(ValueError):
+        check_complete([(0, 2), (1, 3)])
+
+
+def test_queue_hands_out_each_shard_once(tmp_path: Path) -> None:
+    first = ShardQueue(tmp_path / "queue.sqlite", 3, worker_id="first")
+    second = ShardQueue(tmp_path / "queue.sqlite", 3, worker_id="second")
+
+    claimed = [first.claim(), second.claim(), first.claim()]
+    assert sorted(claimed) == [0, 1, 2]
+    assert second.claim() is None
+    assert first.complete(claimed[0]) and first.complete(claimed[2])
+    assert not first.complete(claimed[1])  # held by the second worker
+    assert first.status() == {"done": 2, "leased": 1}
+    with pytest.raises(ValueError):
+        ShardQueue(tmp_path / "queue.sqlite", 4)
+
+
+def test_expired_lease_is_reclaimed_and_the_stale_worker_cannot_complete(tmp_path: Path) -> None:
+    slow = ShardQueue(tmp_path / "queue.sqlite", 1, lease_seconds=0.05, worker_id="slow")
+    other = ShardQueue(tmp_path / "queue.sqlite", 1, lease_seconds=60, worker_id="other")
+
+    assert slow.claim() == 0
+    assert other.claim() is None
+    time.sleep(0.1)
+    assert other.claim() == 0
+    assert not slow.complete(0)
+    assert other.complete(0)
+    assert other.status() == {"done": 1}
+
+
+def test_shard_is_failed_after_max_attempts(tmp_path: Path) -> None:
+    queue = ShardQueue(tmp_path / "queue.sqlite", 1, lease_seconds=0.01, max_attempts=2)
+
+    assert queue.claim() == 0
+    time.sleep(0.03)
+    assert queue.claim() == 0
+    time.sleep(0.03)
+    assert queue.claim() is None
+    assert queue.status() == {"failed": 1}
+
+
+def test_claims_marks_each_shard_done(tmp_path: Path) -> None:
+    queue = ShardQueue(tmp_path / "queue.sqlite", 3)
+
+    assert [shard for shard in queue.claims()] == [(0, 3), (1, 3), (2, 3)]
+    assert queue.status() == {"done": 3}
+
+
+def test_merged_prediction_shards_follow_the_source_order(tmp_path: Path, load_script: Callable[[str], ModuleType]) -> None:
+    merge_shards = load_script("merge_shards")
+
+    source = [{"id": f"Single_X/2010/page_{page}.pdf-{k}"} for page in range(20) for k in (1, 2)]
+    source_path = tmp_path / "source.json"
+    source_path.write_text(json.dumps(source), encoding="utf-8")
+    output_path = tmp_path / "preds.json"
+    shard_paths = []
+    for i in range(3):
+        path = shard_path(output_path, (i, 3))
+        path.write_text(json.dumps([{"id": record["id"], "turn_program": []} for record in filter_shard(source, (i, 3))]), encoding="utf-8")
+        shard_paths.append(path)
+
+    merge_shards.merge_prediction_shards(shard_paths, source_path, output_path)
+    merged = json.loads(output_path.read_text(encoding="utf-8"))
+    assert [prediction["id"] for prediction in merged] == [record["id"] for record in source]
+
+    with pytest.raises(ValueError):
+        merge_shards.merge_prediction_shards(shard_paths[:2], source_path, output_path)
@@ -0,0 +1,22 @@
+from types import ModuleType
+from typing import Callable
+
+# Cold-start import budget for `main --help`, in milliseconds (same default as the script)
+STARTUP_BUDGET_MS = 500
+
+
+def test_parse_importtime_sums_top_level_imports(load_script: Callable[[str], ModuleType]) -> None:
+    stderr_text = (
+        "import time: self [us] | cumulative | imported package\n"
+        "import time:       100 |        100 |   _nested\n"
+        "import time:       200 |        300 | typer\n"
+        "import time:        50 |         50 | rich\n"
+    )
+    cumulative, total_us = load_script("check_startup_time").parse_importtime(stderr_text)
+
+    assert cumulative == {"_nested": 100, "typer": 300, "rich": 50}
+    assert total_us == 350
+
+
+def test_main_help_starts_within_import_budget(load_script: Callable[[str], ModuleType]) -> None:
+    assert load_script("check_startup_time").check_command(["--help"], STARTUP_BUDGET_MS, 1)
@@ -0,0 +1,15 @@
+from types import ModuleType
+from typing import Callable
+
+
+def test_record_ids_are_unique(load_script: Callable[[str], ModuleType]) -> None:
+    ids = [record["id"] for record in load_script("generate_synthetic_corpus").generate_records(5000, 42, 3)]
+
+    assert len(ids) == 5000
+    assert len(set(ids)) == len(ids)
+
+
+def test_generation_is_deterministic(load_script: Callable[[str], ModuleType]) -> None:
+    script = load_script("generate_synthetic_corpus")
+
+    assert list(script.generate_records(50, 7, 3)) == list(script.generate_records(50, 7, 3))